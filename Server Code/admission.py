@@ -0,0 +1,151 @@
+# 요청 수락(admission) 제어
+# 비싼 LLM/TTS 작업을 시작하기 전에 요청을 빠르게 거절할지 결정한다.
+# - API 키별 남은 토큰: sqlite에 저장하고 원자적으로 차감 (스레드/프로세스 간 안전, 재시작 후에도 유지)
+# - API 키별 token bucket 속도 제한 -> 429
+# - 전역 동시 처리 상한, foreground 대기열이 지연 SLO를 넘는 경우 -> 503
+# 거절 응답에는 Retry-After(초)를 함께 돌려준다.
+
+import math
+import time
+import sqlite3
+import threading
+
+
+class QuotaStore:
+    """
+    API 키별 남은 토큰 수를 sqlite에 보관합니다. 차감은 단일 UPDATE 문으로 원자적으로 수행됩니다.
+    """
+    def __init__(self, path, initial_quotas):
+        self.path = path
+        self.local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS quotas (api_key TEXT PRIMARY KEY, remaining INTEGER NOT NULL)")
+        # 이미 저장된 키의 남은 토큰은 덮어쓰지 않는다
+        conn.executemany("INSERT OR IGNORE INTO quotas (api_key, remaining) VALUES (?, ?)", list(initial_quotas.items()))
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def exists(self, api_key):
+        return self._conn().execute("SELECT 1 FROM quotas WHERE api_key = ?", (api_key,)).fetchone() is not None
+
+    def consume(self, api_key, amount=1):
+        """
+        토큰을 amount만큼 차감하고 남은 토큰 수를 반환합니다. 잔량이 부족하면 None을 반환합니다.
+        """
+        row = self._conn().execute(
+            "UPDATE quotas SET remaining = remaining - ? WHERE api_key = ? AND remaining >= ? RETURNING remaining",
+            (amount, api_key, amount)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def remaining(self, api_key):
+        row = self._conn().execute("SELECT remaining FROM quotas WHERE api_key = ?", (api_key,)).fetchone()
+        return None if row is None else row[0]
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, amount=1):
+        """
+        토큰 amount개를 꺼냅니다. 성공하면 0, 실패하면 필요한 토큰이 찰 때까지 기다려야 하는 시간(초)을 반환합니다.
+        burst보다 큰 요청은 영원히 수락되지 않으므로 burst개로 제한합니다.
+        """
+        amount = min(amount, self.burst)
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class AdmissionController:
+    def __init__(self, quota_store, rate_per_key=1.0, burst_per_key=5, max_concurrent=32,
+                 max_queue_depth=32, wait_slo=5.0, load_fn=None):
+        """
+        :param rate_per_key: API 키당 초당 허용 턴 수 (token bucket 보충 속도)
+        :param burst_per_key: API 키당 순간 허용 턴 수
+        :param max_concurrent: 동시에 처리 중인 턴 수의 상한
+        :param max_queue_depth: foreground 대기열이 이 길이를 넘으면 거절
+        :param wait_slo: 가장 오래 기다린 foreground 대기 작업의 대기 시간(초)이 이 값을 넘으면 거절
+        :param load_fn: () -> (대기열 길이, 가장 오래 기다린 대기 작업의 현재 대기 시간) 을 반환하는 함수
+                        (대기열이 비어 있으면 대기 시간은 0이어야 한다)
+        """
+        self.quotas = quota_store
+        self.rate_per_key, self.burst_per_key = rate_per_key, burst_per_key
+        self.max_concurrent = max_concurrent
+        self.max_queue_depth, self.wait_slo = max_queue_depth, wait_slo
+        self.load_fn = load_fn
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.in_flight = 0
+        self.rejected = {"invalid": 0, "rate_limited": 0, "overloaded": 0, "quota": 0}
+
+    def is_valid_key(self, api_key):
+        return bool(api_key) and self.quotas.exists(api_key)
+
+    def admit(self, api_key, cost=1):
+        """
+        요청을 수락하면 (remaining_tokens, None)을, 거절하면 (None, (error_message, status_code, retry_after))를 반환합니다.
+        수락된 요청은 처리가 끝난 뒤 반드시 같은 cost로 release(cost)를 호출해야 합니다.
+        :param cost: 턴 수 (여러 NPC를 한 번에 처리하는 요청은 NPC 수).
+                     남은 토큰 차감, 속도 제한, 동시 처리 슬롯 모두 이 수만큼 사용한다
+        """
+        if not self.is_valid_key(api_key):
+            return None, self._reject("invalid", 'Invalid or missing API key.', 401, None)
+
+        with self.lock:
+            bucket = self.buckets.get(api_key)
+            if bucket is None:
+                bucket = self.buckets[api_key] = TokenBucket(self.rate_per_key, self.burst_per_key)
+            wait = bucket.take(cost)
+        if wait > 0:
+            return None, self._reject("rate_limited", 'Too many requests for this API key.', 429, wait)
+
+        if self.load_fn is not None:
+            queue_depth, oldest_wait = self.load_fn()
+            if queue_depth >= self.max_queue_depth or oldest_wait > self.wait_slo:
+                return None, self._reject("overloaded", 'Server is overloaded.', 503, max(1.0, oldest_wait))
+
+        with self.lock:
+            # 상한보다 큰 요청도 다른 요청이 없을 때는 수락한다
+            if self.in_flight > 0 and self.in_flight + cost > self.max_concurrent:
+                overloaded = True
+            else:
+                overloaded = False
+                self.in_flight += cost
+        if overloaded:
+            return None, self._reject("overloaded", 'Server is overloaded.', 503, 1.0)
+
+        remaining = self.quotas.consume(api_key, cost)
+        if remaining is None:
+            self.release(cost)
+            return None, self._reject("quota", 'API key has no remaining tokens.', 403, None)
+        return remaining, None
+
+    def release(self, cost=1):
+        with self.lock:
+            self.in_flight -= cost
+
+    def _reject(self, reason, message, status, retry_after):
+        with self.lock:
+            self.rejected[reason] += 1
+        if retry_after is not None:
+            retry_after = int(math.ceil(retry_after))
+        return message, status, retry_after
+
+    def stats(self):
+        with self.lock:
+            return {"in_flight": self.in_flight, "max_concurrent": self.max_concurrent, "rejected": dict(self.rejected)}
@@ -2,9 +2,15 @@
 
 
 import ast
+import time
 import requests
+import threading
+import contextvars
 from time import sleep
+from concurrent.futures import Future, wait, FIRST_COMPLETED
 from openai import OpenAI
+import traffic
+import llm_usage
 
 
 class GPTagent:
@@ -16,9 +22,28 @@ class GPTagent:
             api_key=api_key,
         )
 
-    def generate(self, prompt, jsn = False, t = 0.7):
+    def generate(self, prompt, jsn = False, t = 0.7, timeout = None):
+        response, cost, _ = self.generate_with_usage(prompt, jsn, t, timeout)
+        return response, cost
+
+    def generate_with_usage(self, prompt, jsn = False, t = 0.7, timeout = None, retries = None, record = True):
+        """
+        generate와 같지만 이 호출의 토큰 사용량 {"prompt_tokens", "cached_tokens"}도 함께 반환합니다.
+        에이전트는 여러 요청 스레드가 공유하므로 호출별 사용량은 에이전트에 저장하지 않고 반환값으로 넘깁니다.
+        :param retries: OpenAI 클라이언트의 재시도 횟수 (None이면 클라이언트 기본값)
+        :param record: False이면 트래픽 녹화에 남기지 않는다 (hedged 요청은 채택된 응답만 호출한 쪽에서 녹화)
+        """
+        # 재생 스텁 모드에서는 녹화된 응답을 돌려준다 (비용 0)
+        if traffic.replay_stub is not None:
+            return traffic.replay_stub.llm(self.model, prompt), 0, {"prompt_tokens": 0, "cached_tokens": 0}
+        start = time.time()
+        # timeout이 주어지면 해당 시간 이후 HTTP 요청 자체를 포기한다 (hedge 패자 정리용)
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        client = self.client if retries is None else self.client.with_options(max_retries=retries)
         if jsn:
-            chat_completion = self.client.chat.completions.create(
+            chat_completion = client.chat.completions.create(
                 messages=[
                     {
                         "role": "system",
@@ -31,10 +56,11 @@ class GPTagent:
                 ],
                 model=self.model,
                 response_format={"type": "json_object"},
-                temperature=t
+                temperature=t,
+                **kwargs
             )
         else:
-            chat_completion = self.client.chat.completions.create(
+            chat_completion = client.chat.completions.create(
                 messages=[
                     {
                         "role": "system",
@@ -46,15 +72,22 @@ class GPTagent:
                     }
                 ],
                 model=self.model,
-                temperature=t
+                temperature=t,
+                **kwargs
             )
         response = chat_completion.choices[0].message.content
         prompt_tokens = chat_completion.usage.prompt_tokens
         completion_tokens = chat_completion.usage.completion_tokens
+        # prompt-prefix 캐시에 적중한 토큰 수 (지원하지 않는 모델은 None)
+        details = getattr(chat_completion.usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        llm_usage.record(self.model, prompt_tokens, cached_tokens, completion_tokens)
 
         cost = completion_tokens * 3 / 100000 + prompt_tokens * 1 / 100000
         self.total_amount += cost
-        return response, cost
+        if record:
+            traffic.record_llm(self.model, prompt, response, time.time() - start)
+        return response, cost, {"prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens}
 
     def item_processing_scores(self, observation, plan):
         prompt = (
@@ -75,3 +108,74 @@ class GPTagent:
         response, cost = self.generate(prompt, t=0.1)
         entities_dict = ast.literal_eval(response)
         return entities_dict, cost
+
+
+
+def start_call(func, *args):
+    """
+    func(*args)를 호출마다 새 데몬 스레드에서 실행하고 Future를 반환합니다.
+    공용 스레드 풀을 쓰면 취소할 수 없는 (이미 시작된) 패자 요청이 스레드를 잡고 있어 다음 턴의 주 요청이 그 뒤에 줄을 서므로
+    hedged 요청은 풀을 쓰지 않습니다. 현재 컨텍스트(녹화 중인 턴 캡처 등)를 새 스레드에서도 사용합니다.
+    """
+    future = Future()
+    context = contextvars.copy_context()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.run(func, *args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="hedge", daemon=True).start()
+    return future
+
+
+def generate_hedged(primary, hedge, prompt, validate, hedge_delay, deadline, jsn=False, t=0.7):
+    """
+    primary 에이전트로 먼저 요청하고, hedge_delay초 안에 유효한 응답이 없으면
+    hedge 에이전트(더 빠른 모델)로 두 번째 요청을 보냅니다.
+    validate(response)가 None이 아닌 값을 돌려주는 첫 응답을 채택하고 나머지는 취소합니다.
+    deadline초가 지나도록 유효한 응답이 없으면 None을 반환합니다.
+
+    :return: (validate 결과 또는 None, 채택된 모델 이름 또는 None, 채택된 응답의 토큰 사용량 또는 None)
+    """
+    start = time.time()
+    # 재생 스텁 모드에서는 녹화된 채택 응답이 채택까지 걸린 시간 그대로 돌아오므로 보조 요청을 보내지 않는다
+    if traffic.replay_stub is not None:
+        hedge = None
+    # 패자 요청도 deadline 이후에는 클라이언트 타임아웃으로 끊기도록 하고, 클라이언트 재시도는 끈다
+    # (실패 시 재시도 역할은 보조 요청이 맡으며, 버려진 요청이 재시도로 deadline 뒤까지 살아남지 않게 한다)
+    # 버려진 응답이 녹화되면 재생 때 그 응답이 대신 쓰이므로, 개별 요청은 녹화하지 않고 채택된 응답만 녹화한다
+    futures = {start_call(primary.generate_with_usage, prompt, jsn, t, deadline, 0, False): primary.model}
+    hedged = hedge is None
+    try:
+        while futures:
+            elapsed = time.time() - start
+            if elapsed >= deadline:
+                return None, None, None
+            wait_for = deadline - elapsed
+            if not hedged:
+                wait_for = max(0.0, min(wait_for, hedge_delay - elapsed))
+            done, _ = wait(list(futures), timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                model = futures.pop(future)
+                try:
+                    response, _, usage = future.result()
+                    parsed = validate(response)
+                except Exception:
+                    parsed = None
+                if parsed is not None:
+                    traffic.record_llm(model, prompt, response, time.time() - start)
+                    return parsed, model, usage
+            # 주 요청이 늦어지거나 실패하면 보조 요청을 발사
+            if not hedged and (time.time() - start >= hedge_delay or not futures):
+                remaining = max(0.1, deadline - (time.time() - start))
+                futures[start_call(hedge.generate_with_usage, prompt, jsn, t, remaining, 0, False)] = hedge.model
+                hedged = True
+        return None, None, None
+    finally:
+        # 이미 시작된 요청은 취소되지 않지만, 재시도 없이 자기 timeout(deadline 이내) 안에 끝나고 스레드도 함께 끝난다
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,39 @@
+# LLM 토큰 사용량 집계
+# 모든 LLM 호출(행동 선택, 상태 평가, planning, 아이템 추출, 그래프 트리플릿 추출)의 토큰 수를 모델별로 누적해
+# prompt-prefix 캐시 적중률(cached_tokens / prompt_tokens)을 /api/stats 에서 볼 수 있게 한다.
+# 여러 요청/백그라운드 스레드가 동시에 기록하므로 잠금으로 보호한다.
+
+import threading
+
+
+class UsageStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = {}   # 모델 이름 -> {"calls", "prompt_tokens", "cached_tokens", "completion_tokens"}
+
+    def record(self, model, prompt_tokens, cached_tokens, completion_tokens):
+        with self.lock:
+            totals = self.models.get(model)
+            if totals is None:
+                totals = self.models[model] = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+            totals["calls"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["cached_tokens"] += cached_tokens
+            totals["completion_tokens"] += completion_tokens
+
+    def stats(self):
+        with self.lock:
+            return {model: {**totals, "cache_hit_rate": round(totals["cached_tokens"] / totals["prompt_tokens"], 4)
+                                                         if totals["prompt_tokens"] else 0.0}
+                    for model, totals in self.models.items()}
+
+
+usage = UsageStats()
+
+
+def record(model, prompt_tokens, cached_tokens, completion_tokens):
+    usage.record(model, prompt_tokens, cached_tokens, completion_tokens)
+
+
+def stats():
+    return usage.stats()
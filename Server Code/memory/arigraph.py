@@ -2,9 +2,14 @@
 
 import os
 import re
+import sys
 import ast
 import json
+import hashlib
+import logging
+import threading
 import numpy as np
+import torch
 
 import re
 from time import time
@@ -17,12 +22,104 @@ from openai import OpenAI
 # from utils.utils import clear_triplet, check_conn, find_relation
 # (또한 prompt_extraction_current, prompt_refining_items, process_triplets, parse_triplets_removing,
 #  graph_retr_search, find_top_episodic_emb, top_k_obs 등 필요한 함수 및 상수들이 이미 정의되었다고 가정)
-from retriever import Retriever, graph_retr_search, find_top_episodic_emb
+from retriever import Retriever, graph_retr_search, find_top_episodic_emb, get_cached_embeddings
+from lexical import LexicalIndex, LayeredLexicalIndex
+from vector_index import make_index, LayeredIndex
 #from utils import clear_triplet, process_triplets, parse_triplets_removing, top_k_obs
 from prompt import prompt_refining_items, prompt_extraction_current
+import traffic
+import llm_usage
+from structured_logging import log_event
+
+# 같은 대상을 가리키는 엔티티 표기 -> 정규(canonical) 엔티티
+DEFAULT_ENTITY_ALIASES = {
+    "the user": "user",
+    "player": "user",
+    "the player": "user",
+    "사용자": "user",
+    "유저": "user",
+    "플레이어": "user",
+    "the npc": "npc",
+}
+
+class Triplet:
+    """
+    (subject, label, object) 트리플릿.
+    문자열은 sys.intern으로 공유하고, "subject, label, object" 문자열(key)과 해시는 생성 시 한 번만 계산합니다.
+    같은 key를 가진 트리플릿은 같은 트리플릿으로 취급합니다.
+    """
+    __slots__ = ("subject", "object", "label", "key", "hash")
+
+    def __init__(self, subject, obj, label):
+        self.subject = sys.intern(subject)
+        self.object = sys.intern(obj)
+        self.label = sys.intern(label)
+        self.key = sys.intern(subject + ", " + label + ", " + obj)
+        self.hash = hash(self.key)
+
+    def __eq__(self, other):
+        if not isinstance(other, Triplet):
+            return NotImplemented
+        return self.key == other.key
+
+    def __hash__(self):
+        return self.hash
+
+    def __repr__(self):
+        return f"Triplet({self.subject!r}, {self.object!r}, {self.label!r})"
+
+    def with_entities(self, subject, obj):
+        # 엔티티만 바꾼 트리플릿 (바뀐 것이 없으면 자기 자신)
+        if subject == self.subject and obj == self.object:
+            return self
+        return Triplet(subject, obj, self.label)
+
+class LayeredKeys:
+    """
+    world graph(base)의 트리플릿 문자열 목록 뒤에 overlay 목록을 이어 붙인 읽기 전용 시퀀스 (base 목록은 복사하지 않음).
+    position은 graph_retr_search에 넘기는 {문자열: 인덱스} 매핑이며, hidden인 base 트리플릿은 없는 것으로 취급합니다.
+    """
+    def __init__(self, base_keys, base_position, keys, hidden):
+        self.base_keys, self.keys = base_keys, keys
+        self.position = LayeredPosition(base_position, {key: len(base_keys) + i for i, key in enumerate(keys)}, hidden)
+
+    def __len__(self):
+        return len(self.base_keys) + len(self.keys)
+
+    def __getitem__(self, idx):
+        if idx < len(self.base_keys):
+            return self.base_keys[idx]
+        return self.keys[idx - len(self.base_keys)]
+
+
+class LayeredPosition:
+    def __init__(self, base_position, local_position, hidden):
+        self.base_position, self.local_position, self.hidden = base_position, local_position, hidden
+
+    def __contains__(self, key):
+        return key in self.local_position or (key not in self.hidden and key in self.base_position)
+
+    def __getitem__(self, key):
+        if key in self.local_position:
+            return self.local_position[key]
+        if key in self.hidden:
+            raise KeyError(key)
+        return self.base_position[key]
+
 
 class ContrieverGraph:
-    def __init__(self, model, system_prompt, api_key, device="cpu", debug=False):
+    def __init__(self, model, system_prompt, api_key, device="cpu", debug=False,
+                 max_active_triplets=400, max_archived_triplets=2000, compaction_interval=5, recency_decay=0.97,
+                 entity_merge_threshold=0.92, entity_aliases=None, retrieval_mode="dense",
+                 index_backend="exact", index_params=None, retriever=None, base=None):
+        """
+        :param retriever: 이미 로드된 Retriever를 공유할 때 전달 (None이면 새로 로드)
+        :param base: 공유 world graph (ContrieverGraph). 주어지면 이 그래프는 그 위의 overlay가 되어
+                     base의 트리플릿/임베딩/색인을 복사하지 않고 읽기만 하며,
+                     새 트리플릿은 자기 자신에, base 트리플릿 삭제는 hidden(tombstone)에 기록한다
+        """
+        self.base = base
+        self.hidden = set()     # 이 overlay에서 삭제된 base 트리플릿 key
         self.triplets = []
         self.items = []  # items 목록 초기화
         self.model, self.system_prompt = model, system_prompt
@@ -32,17 +129,62 @@ class ContrieverGraph:
         )
         self.total_amount = 0
 
-        self.retriever = Retriever(device)
+        self.retriever = retriever if retriever is not None else Retriever(device)
+        self.retrieval_mode = retrieval_mode    # "dense" / "lexical" / "hybrid" (retriever.RETRIEVAL_MODES)
+        self.lexical_index = LexicalIndex()     # 자기 트리플릿 문자열 BM25 색인 (memory_retrieve에서 증분 동기화)
         self.triplets_emb, self.items_emb = {}, {}
+        # world graph(base)로 쓰일 때 모든 overlay가 공유하는 (트리플릿 문자열 목록, {문자열: 인덱스}) (shared_search_view)
+        self.search_cache, self.search_lexical_synced = None, False
+        self.search_cache_lock = threading.Lock()
+        # 그래프 읽기/쓰기 잠금: memory_retrieve와 update_without_retrieve의 그래프 변경 부분이 동시에 실행되지 않게 한다
+        # (GameSession이 세션 상태(history/plan/prev_npc)에도 같은 잠금을 쓰므로 재진입 가능해야 함)
+        self.lock = threading.RLock()
         self.obs_episodic, self.obs_episodic_list, self.top_episodic_dict_list = {}, [], []
+        self.episodic_matrix = None     # obs_episodic 임베딩을 쌓은 행렬 캐시
+
+        # 트리플릿 임베딩 벡터 색인: "exact" 또는 "hnsw" (vector_index.VECTOR_INDEX_BACKENDS)
+        # triplets_emb와 함께 증분 추가/삭제되며, 첫 임베딩이 들어올 때 차원에 맞춰 생성된다
+        self.index_backend, self.index_params = index_backend, dict(index_params or {})
+        self.vector_index = None
+
+        # 메모리 통합(consolidation): 활성 트리플릿 수를 max_active_triplets 이하로 유지하고
+        # 중요도가 낮은 트리플릿은 archive(cold storage)로 옮겼다가 관련 엔티티가 다시 등장하면 복원한다
+        # archive도 임베딩을 들고 있으므로 max_archived_triplets를 넘으면 가장 먼저 archive된 것부터 완전히 잊는다
+        # (세션 메모리는 활성 + archive 트리플릿 수로 제한됨)
+        self.max_active_triplets = max_active_triplets
+        self.max_archived_triplets = max_archived_triplets
+        self.compaction_interval = compaction_interval
+        self.recency_decay = recency_decay
+        self.step = 0                   # memory_retrieve 호출 횟수 (논리 시계)
+        self.updates_since_compaction = 0
+        self.triplet_stats = {}         # 트리플릿 문자열 -> {"hits", "last_access", "created"}
+        self.archive = {}               # 트리플릿 문자열 -> (triplet, embedding, stats), archive된 순서
+        self.archive_by_entity = {}     # 엔티티 -> archive 키 집합
+
+        # 엔티티 정규화: alias 표 + items_emb 유사도가 entity_merge_threshold 이상이면 기존 엔티티로 통합
+        self.entity_merge_threshold = entity_merge_threshold
+        self.alias_table = dict(DEFAULT_ENTITY_ALIASES if entity_aliases is None else entity_aliases)
+        self.entity_names, self.entity_matrix = [], None   # items_emb의 정규화 행렬 캐시
 
     def clear(self):
         self.triplets = []
+        self.hidden = set()
         self.total_amount = 0
         self.triplets_emb, self.items_emb = {}, {}
         self.obs_episodic, self.obs_episodic_list, self.top_episodic_dict_list = {}, [], []
+        self.episodic_matrix = None
+        self.step, self.updates_since_compaction = 0, 0
+        self.triplet_stats, self.archive, self.archive_by_entity = {}, {}, {}
+        self.entity_names, self.entity_matrix = [], None
+        self.lexical_index = LexicalIndex()
+        self.vector_index = None
+        self.search_cache, self.search_lexical_synced = None, False
 
     def generate(self, prompt, jsn=False, t=0.7):
+        # 재생 스텁 모드에서는 녹화된 응답을 돌려준다 (비용 0)
+        if traffic.replay_stub is not None:
+            return traffic.replay_stub.llm(self.model, prompt), 0
+        start = time()
         if jsn:
             chat_completion = self.client.chat.completions.create(
                 messages=[
@@ -65,80 +207,398 @@ class ContrieverGraph:
         response = chat_completion.choices[0].message.content
         prompt_tokens = chat_completion.usage.prompt_tokens
         completion_tokens = chat_completion.usage.completion_tokens
+        # prompt-prefix 캐시에 적중한 토큰 수 (지원하지 않는 모델은 None)
+        details = getattr(chat_completion.usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        llm_usage.record(self.model, prompt_tokens, cached_tokens, completion_tokens)
 
         cost = completion_tokens * 3 / 100000 + prompt_tokens * 1 / 100000
         self.total_amount += cost
+        traffic.record_llm(self.model, prompt, response, time() - start)
         return response, cost
 
     def str(self, triplet):
-        return triplet[0] + ", " + triplet[2]["label"] + ", " + triplet[1]
+        return triplet.key
 
     def triplets_to_str(self, triplets):
-        return [self.str(triplet) for triplet in triplets]
+        return [triplet.key for triplet in triplets]
 
     def convert(self, triplets):
-        new_triplets = []
-        for triplet in triplets:
-            triplet = clear_triplet(triplet)
-            new_triplets.append(self.str(triplet))
-        return new_triplets
+        return [clear_triplet(triplet).key for triplet in triplets]
+
+    # --------------------------------------------------------------------
+    # world graph(base) + overlay 계층
+    # --------------------------------------------------------------------
+    def base_triplets(self):
+        # 이 overlay에서 보이는 base 트리플릿
+        if self.base is None:
+            return []
+        return [triplet for triplet in self.base.all_triplets() if triplet.key not in self.hidden]
+
+    def all_triplets(self):
+        # 검색 대상 전체: base(보이는 것) + 자기 트리플릿
+        if self.base is None:
+            return self.triplets
+        return self.base_triplets() + self.triplets
+
+    def in_base(self, key):
+        return self.base is not None and key not in self.hidden and self.base.has_triplet(key)
+
+    def has_triplet(self, key):
+        return key in self.triplet_stats or self.in_base(key)
+
+    def search_index(self):
+        if self.base is None:
+            return self.vector_index
+        return LayeredIndex(self.base.search_index(), self.vector_index, self.hidden)
+
+    def shared_search_view(self, lexical=False):
+        """
+        world graph(base)로 쓰일 때 (트리플릿 문자열 목록, {문자열: 인덱스})를 한 번만 만들어 모든 overlay가 공유합니다.
+        lexical이면 자기 BM25 색인도 한 번 동기화합니다. world graph는 add_world_facts 이후 바뀌지 않습니다.
+        """
+        with self.search_cache_lock:
+            if self.search_cache is None:
+                keys = self.triplets_to_str(self.triplets)
+                self.search_cache = (keys, {key: i for i, key in enumerate(keys)})
+                self.search_lexical_synced = False
+            if lexical and not self.search_lexical_synced:
+                self.lexical_index.sync(self.search_cache[0])
+                self.search_lexical_synced = True
+            return self.search_cache
+
+    def search_view(self):
+        """
+        memory_retrieve의 검색 대상: (트리플릿 문자열 시퀀스, {문자열: 인덱스} 또는 None, BM25 색인).
+        base가 있으면 base의 공유 목록/색인 위에 자기 트리플릿만 얹으므로 턴마다 world graph 크기만큼 복사하지 않습니다.
+        """
+        keys = self.triplets_to_str(self.triplets)
+        if self.retrieval_mode != "dense":
+            self.lexical_index.sync(keys)
+        if self.base is None:
+            return keys, None, self.lexical_index
+        base_keys, base_position = self.base.shared_search_view(lexical=self.retrieval_mode != "dense")
+        layered = LayeredKeys(base_keys, base_position, keys, self.hidden)
+        return layered, layered.position, LayeredLexicalIndex(self.base.lexical_index, self.lexical_index, self.hidden)
 
     def get_embedding_local(self, text):
         return self.retriever.embed([text])[0].cpu().detach().numpy()
 
+    def index_triplet(self, key, embedding):
+        # triplets_emb와 vector_index에 트리플릿 임베딩 추가
+        self.triplets_emb[key] = embedding
+        if self.vector_index is None:
+            self.vector_index = make_index(self.index_backend, len(embedding), **self.index_params)
+        self.vector_index.add([key], [embedding])
+
+    def unindex_triplet(self, key):
+        # triplets_emb와 vector_index에서 트리플릿 임베딩 제거 (제거된 임베딩 반환)
+        if self.vector_index is not None:
+            self.vector_index.remove([key])
+        return self.triplets_emb.pop(key, None)
+
     def add_triplets(self, triplets):
         for triplet in triplets:
             # 예시: label이 'free'이면 추가하지 않음
-            if triplet[2]["label"] == "free":
+            if triplet.label == "free":
+                continue
+            triplet = clear_triplet(triplet, self.canonical_entity)
+            if self.base is not None and triplet.key in self.hidden:
+                # overlay에서 지웠던 world 트리플릿이 다시 등장하면 tombstone만 제거 (재임베딩 없음)
+                self.hidden.discard(triplet.key)
+                continue
+            if self.in_base(triplet.key):
                 continue
-            triplet = clear_triplet(triplet)
-            if triplet not in self.triplets:
+            if triplet.key in self.archive:
+                self.restore_archived([triplet.key])
+                continue
+            # triplet_stats의 키 = 활성 트리플릿 집합 (리스트 전체 비교 대신 해시 조회)
+            if triplet.key not in self.triplet_stats:
                 self.triplets.append(triplet)
-                self.triplets_emb[self.str(triplet)] = self.get_embedding_local(self.str(triplet))
-                if triplet[0] not in self.items_emb:
-                    self.items_emb[triplet[0]] = self.get_embedding_local(triplet[0])
-                if triplet[1] not in self.items_emb:
-                    self.items_emb[triplet[1]] = self.get_embedding_local(triplet[1])
+                self.triplet_stats[triplet.key] = {"hits": 0, "last_access": self.step, "created": self.step}
+                self.index_triplet(triplet.key, self.get_embedding_local(triplet.key))
+                if triplet.subject not in self.items_emb:
+                    self.items_emb[triplet.subject] = self.get_embedding_local(triplet.subject)
+                if triplet.object not in self.items_emb:
+                    self.items_emb[triplet.object] = self.get_embedding_local(triplet.object)
 
     def delete_triplets(self, triplets, locations):
         for triplet in triplets:
-            if triplet[0] in locations and triplet[1] in locations:
+            if triplet.subject in locations and triplet.object in locations:
                 continue
-            if triplet in self.triplets:
+            if triplet.key in self.triplet_stats:
                 self.triplets.remove(triplet)
-                self.triplets_emb.pop(self.str(triplet), None)
+                self.unindex_triplet(triplet.key)
+                self.triplet_stats.pop(triplet.key, None)
+            elif self.in_base(triplet.key):
+                # 공유 world graph는 수정하지 않고 이 overlay에서만 가린다 (copy-on-write)
+                self.hidden.add(triplet.key)
 
     def exclude(self, triplets):
         new_triplets = []
         for triplet in triplets:
-            triplet = clear_triplet(triplet)
-            if triplet not in self.triplets:
+            triplet = clear_triplet(triplet, self.resolve_alias)
+            if not self.has_triplet(triplet.key):
                 new_triplets.append(triplet)
         return new_triplets
 
     def get_associated_triplets(self, items, steps=2):
-        items = deepcopy([string.lower() for string in items])
-        associated_triplets = []
+        items = deepcopy([self.resolve_alias(string.lower()) for string in items])
+        associated_triplets, seen = [], set()
+        all_triplets = self.all_triplets()
         for i in range(steps):
             now = set()
-            for triplet in self.triplets:
+            for triplet in all_triplets:
                 for item in items:
-                    if (item == triplet[0] or item == triplet[1]) and self.str(triplet) not in associated_triplets:
-                        associated_triplets.append(self.str(triplet))
-                        if item == triplet[0]:
-                            now.add(triplet[1])
-                        if item == triplet[1]:
-                            now.add(triplet[0])
+                    if (item == triplet.subject or item == triplet.object) and triplet.key not in seen:
+                        associated_triplets.append(triplet.key)
+                        seen.add(triplet.key)
+                        if item == triplet.subject:
+                            now.add(triplet.object)
+                        if item == triplet.object:
+                            now.add(triplet.subject)
                         break
             if "itself" in now:
                 now.remove("itself")
             items = now
         return associated_triplets
 
+    # --------------------------------------------------------------------
+    # 엔티티 정규화: alias 표와 items_emb 임베딩 유사도로 중복 노드 통합
+    # --------------------------------------------------------------------
+    def resolve_alias(self, entity):
+        # alias 표만 사용하는 가벼운 정규화 (임베딩 계산 없음)
+        if entity in self.alias_table or self.base is None:
+            return self.alias_table.get(entity, entity)
+        return self.base.resolve_alias(entity)
+
+    def nearest_entity(self, embedding):
+        if not self.items_emb:
+            return None, 0.0
+        if self.entity_matrix is None or len(self.entity_names) != len(self.items_emb):
+            self.entity_names = list(self.items_emb.keys())
+            matrix = np.stack([self.items_emb[name] for name in self.entity_names])
+            self.entity_matrix = matrix / (np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-9)
+        query = embedding / (np.linalg.norm(embedding) + 1e-9)
+        scores = self.entity_matrix @ query
+        best = int(np.argmax(scores))
+        return self.entity_names[best], float(scores[best])
+
+    def canonical_entity(self, entity):
+        """
+        새 엔티티 문자열을 기존 정규 엔티티로 매핑합니다.
+        alias 표에 없고 처음 보는 엔티티라면 임베딩해서 가장 가까운 기존 엔티티와 비교하고,
+        유사도가 entity_merge_threshold 이상이면 alias로 등록합니다. 아니면 새 엔티티로 items_emb에 추가합니다.
+        """
+        entity = self.resolve_alias(entity)
+        if entity in self.items_emb or entity == "itself":
+            return entity
+        if self.base is not None and entity in self.base.items_emb:
+            # world graph의 엔티티는 overlay에 임베딩을 복사하지 않는다
+            return entity
+        embedding = self.get_embedding_local(entity)
+        match, score = self.nearest_entity(embedding)
+        if self.base is not None:
+            base_match, base_score = self.base.nearest_entity(embedding)
+            if base_match is not None and base_score > score:
+                match, score = base_match, base_score
+        if match is not None and score >= self.entity_merge_threshold:
+            self.alias_table[entity] = match
+            return match
+        self.items_emb[entity] = embedding
+        self.entity_matrix = None
+        return entity
+
+    def merge_duplicate_entities(self):
+        """
+        이미 그래프에 있는 중복 엔티티를 통합합니다 (compaction 때 실행).
+        트리플릿에 많이 등장하는 엔티티를 대표로 삼고, 유사도가 임계값 이상인 엔티티를 대표로 치환합니다.
+        :return: 통합된 엔티티 수
+        """
+        degree = {}
+        for triplet in self.triplets:
+            for entity in (triplet.subject, triplet.object):
+                degree[entity] = degree.get(entity, 0) + 1
+        names = [name for name in sorted(degree, key=degree.get, reverse=True) if name in self.items_emb and name != "itself"]
+        if len(names) < 2:
+            return 0
+        matrix = np.stack([self.items_emb[name] for name in names])
+        matrix = matrix / (np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-9)
+        similarity = matrix @ matrix.T
+        mapping = {}
+        for i, name in enumerate(names):
+            if name in mapping:
+                continue
+            for j in np.nonzero(similarity[i, i + 1:] >= self.entity_merge_threshold)[0]:
+                other = names[i + 1 + j]
+                if other not in mapping:
+                    mapping[other] = name
+        if not mapping:
+            return 0
+
+        for alias, canonical in list(self.alias_table.items()):
+            self.alias_table[alias] = mapping.get(canonical, canonical)
+        self.alias_table.update(mapping)
+        for alias in mapping:
+            self.items_emb.pop(alias, None)
+        self.entity_matrix = None
+
+        # 트리플릿 재작성 (같아진 트리플릿은 하나로 합치고 통계는 더함)
+        merged_triplets = []
+        for triplet in self.triplets:
+            old_key = triplet.key
+            new_triplet = triplet.with_entities(mapping.get(triplet.subject, triplet.subject),
+                                                mapping.get(triplet.object, triplet.object))
+            new_key = new_triplet.key
+            embedding = self.unindex_triplet(old_key)
+            stats = self.triplet_stats.pop(old_key, None) or {"hits": 0, "last_access": self.step, "created": self.step}
+            if new_key in self.triplet_stats:
+                self.triplet_stats[new_key]["hits"] += stats["hits"]
+                self.triplet_stats[new_key]["last_access"] = max(self.triplet_stats[new_key]["last_access"], stats["last_access"])
+                continue
+            if new_key != old_key or embedding is None:
+                embedding = self.get_embedding_local(new_key)
+            self.index_triplet(new_key, embedding)
+            self.triplet_stats[new_key] = stats
+            merged_triplets.append(new_triplet)
+        self.triplets = merged_triplets
+        return len(mapping)
+
+    # --------------------------------------------------------------------
+    # 메모리 통합: 접근 통계, 중요도 기반 망각(archive), 복원
+    # --------------------------------------------------------------------
+    def touch(self, triplet_strs):
+        # 검색에 사용된 트리플릿의 접근 횟수/시점 갱신
+        for key in triplet_strs:
+            stats = self.triplet_stats.get(key)
+            if stats is not None:
+                stats["hits"] += 1
+                stats["last_access"] = self.step
+
+    def importance(self, key):
+        # 접근 횟수가 많고 최근에 사용된 트리플릿일수록 중요
+        stats = self.triplet_stats.get(key, {"hits": 0, "last_access": 0})
+        return (1 + stats["hits"]) * self.recency_decay ** (self.step - stats["last_access"])
+
+    def compact(self, protected=()):
+        """
+        활성 트리플릿이 max_active_triplets를 넘으면 중요도가 낮은 것부터 archive로 옮깁니다.
+        최근 추가된 트리플릿(protected)은 옮기지 않습니다.
+        :return: archive로 옮긴 트리플릿 수
+        """
+        self.updates_since_compaction = 0
+        self.merge_duplicate_entities()
+        overflow = len(self.triplets) - self.max_active_triplets
+        if overflow <= 0:
+            return 0
+        protected = set(protected)
+        candidates = [triplet for triplet in self.triplets if triplet.key not in protected]
+        candidates.sort(key=lambda triplet: self.importance(triplet.key))
+        evicted = candidates[:overflow]
+        for triplet in evicted:
+            key = triplet.key
+            self.archive[key] = (triplet, self.unindex_triplet(key), self.triplet_stats.pop(key, None))
+            for entity in (triplet.subject, triplet.object):
+                self.archive_by_entity.setdefault(entity, set()).add(key)
+        evicted_keys = {triplet.key for triplet in evicted}
+        self.triplets = [triplet for triplet in self.triplets if triplet.key not in evicted_keys]
+        return len(evicted)
+
+    def trim_archive(self):
+        """
+        archive가 max_archived_triplets를 넘으면 가장 먼저 archive된 트리플릿부터 임베딩과 함께 삭제합니다.
+        :return: 삭제한 트리플릿 수
+        """
+        overflow = len(self.archive) - self.max_archived_triplets
+        if overflow <= 0:
+            return 0
+        for key in list(self.archive)[:overflow]:
+            triplet, _, _ = self.archive.pop(key)
+            self._unlink_archived(triplet, key)
+        return overflow
+
+    def _unlink_archived(self, triplet, key):
+        for entity in (triplet.subject, triplet.object):
+            keys = self.archive_by_entity.get(entity)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.archive_by_entity[entity]
+
+    def restore_archived(self, keys):
+        # archive의 트리플릿을 저장된 임베딩과 함께 다시 활성화 (재임베딩 없음)
+        restored = 0
+        for key in keys:
+            entry = self.archive.pop(key, None)
+            if entry is None:
+                continue
+            triplet, embedding, stats = entry
+            self._unlink_archived(triplet, key)
+            # archive 이후 통합된 엔티티가 있으면 정규 엔티티로 바꿔서 복원
+            canonical = triplet.with_entities(self.resolve_alias(triplet.subject), self.resolve_alias(triplet.object))
+            if canonical is not triplet:
+                triplet, key, embedding = canonical, canonical.key, None
+            if key in self.triplet_stats:
+                continue
+            self.triplets.append(triplet)
+            self.index_triplet(key, embedding if embedding is not None else self.get_embedding_local(key))
+            stats = stats or {"hits": 0, "created": self.step}
+            stats["last_access"] = self.step
+            self.triplet_stats[key] = stats
+            restored += 1
+        return restored
+
+    def restore_by_entities(self, entities):
+        # 다시 등장한 엔티티와 연결된 archive 트리플릿 복원
+        keys = set()
+        entities = {self.resolve_alias(entity.lower().strip('''"'. `;:''')) for entity in entities}
+        # 정규 엔티티로 통합되기 전의 표기로 archive된 트리플릿도 함께 찾는다
+        entities |= {alias for alias, canonical in self.alias_table.items() if canonical in entities}
+        for entity in entities:
+            keys |= self.archive_by_entity.get(entity, set())
+        return self.restore_archived(keys)
+
+    # --------------------------------------------------------------------
+    # world graph 구성: 세계 지식 문장에서 트리플릿을 한 번만 추출/임베딩
+    # --------------------------------------------------------------------
+    def add_world_facts(self, texts, cache_path=None):
+        """
+        세계 지식 문장마다 트리플릿을 추출해 추가합니다.
+        추출 결과는 문장 내용의 해시를 키로 cache_path(JSON)에 저장해, 재시작 시 LLM 호출을 생략합니다.
+        :return: 추가 후 트리플릿 수
+        """
+        cache = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, encoding="utf-8") as f:
+                cache = json.load(f)
+        changed = False
+        for text in texts:
+            digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            if digest not in cache:
+                try:
+                    response, _ = self.generate(prompt_extraction_current.format(observation=text, example=[]), t=0.1)
+                except Exception as e:
+                    log_event("memory", "World fact extraction failed", level=logging.WARNING, error=f"{type(e).__name__}: {e}")
+                    continue
+                cache[digest] = [[triplet.subject, triplet.object, triplet.label] for triplet in process_triplets(response)]
+                changed = True
+            self.add_triplets([Triplet(*fields) for fields in cache[digest]])
+        if cache_path and changed:
+            tmp_path = cache_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(cache, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, cache_path)
+        self.search_cache = None
+        return len(self.triplets)
+
     # --------------------------------------------------------------------
     # update_without_retrieve: 트리플릿 추출/정제/추가 및 episodic memory 업데이트
     # --------------------------------------------------------------------
     def update_without_retrieve(self, observation, plan, prev_subgraph, locations, action, items1, log):
+        """
+        :param log: 트리플릿 목록/LLM 응답 같은 큰 메시지용 log(msg) 함수 (샘플링될 수 있음).
+                    복원/교체/compaction 같은 운영 메시지는 log_event로 항상 남긴다.
+        """
         #overall_start = time.time()
         if self.debug:
             print("=== DEBUG: 시작 update_without_retrieve ===")
@@ -160,44 +620,58 @@ class ContrieverGraph:
         #if self.debug:
         #    print(f"[Extraction] 트리플릿 파싱 시간: {time.time() - t2:.4f} sec")
 
-        #t3 = time.time()
-        new_triplets = self.exclude(new_triplets_raw)
-        #if self.debug:
-        #    print(f"[Extraction] 제외 및 변환 시간: {time.time() - t3:.4f} sec")
-
-        log("New triplets: " + str(self.convert(new_triplets_raw)))
-
-        # 2. 아이템 정제 및 기존 트리플릿 삭제
-        #t4 = time.time()
-        items_extracted = {triplet[0] for triplet in new_triplets_raw} | {triplet[1] for triplet in new_triplets_raw}
-        associated_subgraph = self.get_associated_triplets(items_extracted, steps=1)
+        # 그래프를 읽고 쓰는 부분만 잠근다 (LLM 호출 중에는 foreground 턴의 검색이 기다리지 않게)
+        with self.lock:
+            #t3 = time.time()
+            new_triplets = self.exclude(new_triplets_raw)
+            #if self.debug:
+            #    print(f"[Extraction] 제외 및 변환 시간: {time.time() - t3:.4f} sec")
+
+            log("New triplets: " + str(self.convert(new_triplets_raw)))
+
+            # 2. 아이템 정제 및 기존 트리플릿 삭제
+            #t4 = time.time()
+            items_extracted = {triplet.subject for triplet in new_triplets_raw} | {triplet.object for triplet in new_triplets_raw}
+            restored = self.restore_by_entities(items_extracted)
+            if restored:
+                log_event("memory", "Restored archived triplets", restored=restored)
+            associated_subgraph = self.get_associated_triplets(items_extracted, steps=1)
         prompt_refine = prompt_refining_items.format(ex_triplets=associated_subgraph, new_triplets=self.convert(new_triplets_raw))
         response_refine, _ = self.generate(prompt_refine, t=0.001)
         predicted_outdated = parse_triplets_removing(response_refine)
-        self.delete_triplets(predicted_outdated, locations)
-        #if self.debug:
-        #    print(f"[Refinement] 정제 및 삭제 시간: {time.time() - t4:.4f} sec")
-        log("Outdated triplets: " + response_refine)
-        log("NUMBER OF REPLACEMENTS: " + str(len(predicted_outdated)))
-
-        # 3. 새로운 트리플릿 추가
-        #t5 = time.time()
-        self.add_triplets(new_triplets_raw)
-        #if self.debug:
-        #    print(f"[Add Triplets] 추가 시간: {time.time() - t5:.4f} sec")
-
-        # 4. plan의 context를 episodic memory에 저장 (중복 추가 방지)
-        #t6 = time.time()
-        try:
-            plan_dict = json.loads(plan)
-            context_info = plan_dict.get("context_info", "")
-        except Exception as e:
-            context_info = ""
-        if context_info and context_info not in self.obs_episodic:
-            context_embedding = self.retriever.embed(context_info)
-            recent_triplets_str = self.triplets_to_str(self.triplets[-5:])  # 최근 5개의 트리플릿 사용
-            context_value = [recent_triplets_str, context_embedding]
-            self.obs_episodic[context_info] = context_value
+        with self.lock:
+            self.delete_triplets(predicted_outdated, locations)
+            #if self.debug:
+            #    print(f"[Refinement] 정제 및 삭제 시간: {time.time() - t4:.4f} sec")
+            log("Outdated triplets: " + response_refine)
+            log_event("memory", "Replaced outdated triplets", replacements=len(predicted_outdated))
+
+            # 3. 새로운 트리플릿 추가
+            #t5 = time.time()
+            self.add_triplets(new_triplets_raw)
+            #if self.debug:
+            #    print(f"[Add Triplets] 추가 시간: {time.time() - t5:.4f} sec")
+
+            # 4. plan의 context를 episodic memory에 저장 (중복 추가 방지)
+            #t6 = time.time()
+            try:
+                plan_dict = json.loads(plan)
+                context_info = plan_dict.get("context_info", "")
+            except Exception as e:
+                context_info = ""
+            if context_info and context_info not in self.obs_episodic:
+                context_embedding = self.retriever.embed(context_info)
+                recent_triplets_str = self.triplets_to_str(self.triplets[-5:])  # 최근 5개의 트리플릿 사용
+                context_value = [recent_triplets_str, context_embedding]
+                self.obs_episodic[context_info] = context_value
+
+            # 5. 주기적 메모리 통합 (background 업데이트 경로에서만 실행)
+            self.updates_since_compaction += 1
+            if self.updates_since_compaction >= self.compaction_interval:
+                archived = self.compact(protected=self.triplets_to_str(self.triplets[-5:]))
+                forgotten = self.trim_archive()
+                log_event("memory", "Compaction", archived=archived, forgotten=forgotten, active=len(self.triplets),
+                          archived_total=len(self.archive))
         #if self.debug:
         #    print(f"[Final] plan context 임베딩 및 업데이트 시간: {time.time() - t6:.4f} sec")
 
@@ -208,51 +682,79 @@ class ContrieverGraph:
     # --------------------------------------------------------------------
     # memory_retrieve: 최근 추가된 트리플릿과 현재 observation 기반 검색
     # --------------------------------------------------------------------
-    def memory_retrieve(self, observation, plan, prev_subgraph, recent_n=5, topk_episodic=2):
+    def memory_retrieve(self, observation, plan, prev_subgraph, recent_n=5, topk_episodic=2, retrieval_context=None):
+        """
+        :param retrieval_context: retriever.RetrievalContext - 같은 턴의 다른 검색과 observation 임베딩을 공유
+        """
         #overall_start = time.time()
         if self.debug:
             print("=== DEBUG: 시작 memory_retrieve ===")
 
-        # 1. 최근 n개의 트리플릿 기반 연관 서브그래프 재계산
-        #t0 = time.time()
-        triplets_str = self.triplets_to_str(self.triplets)  # 전체 트리플릿 목록(문자열)
-        associated_subgraph_new = set()
-        recent_triplets = self.triplets[-recent_n:]
-        recent_triplets_str = self.triplets_to_str(recent_triplets)
-        for trip in recent_triplets_str:
-            results = graph_retr_search(
-                trip, triplets_str, self.retriever,
-                max_depth=3,
-                topk=4,
-                post_retrieve_threshold=0.65,
-                verbose=2
-            )
-            associated_subgraph_new.update(results)
-        # 최근 추가된 트리플릿은 제외
-        associated_subgraph_new = [element for element in associated_subgraph_new if element not in recent_triplets_str]
-        #if self.debug:
-        #    print(f"[Retrieval] 최근 {recent_n}개 트리플릿 기반 연관 서브그래프 계산 시간: {time.time() - t0:.4f} sec")
-
-        # 2. Episodic memory 검색 (현재 observation 기반)
-        #t1 = time.time()
-        observation_embedding = self.retriever.embed(observation)
-        top_episodic_dict = find_top_episodic_emb(prev_subgraph, deepcopy(self.obs_episodic), observation_embedding, self.retriever)
-        top_episodic = top_k_obs(top_episodic_dict, k=topk_episodic)
-        #if self.debug:
-        #    print(f"[Episodic] top episodic 계산 시간: {time.time() - t1:.4f} sec")
-
-        #overall_time = time.time() - overall_start
-        #if self.debug:
-        #    print(f"=== DEBUG: 전체 memory_retrieve 소요 시간: {overall_time:.4f} sec ===")
-        return associated_subgraph_new, top_episodic
-
-
-
-
-def clear_triplet(triplet):
-    return [triplet[0].lower().strip('''"'. `;:'''),
-            triplet[1].lower().strip('''"'. `;:'''),
-            {"label": triplet[2]["label"].lower().strip('''"'. `;:''')}]
+        # foreground 턴의 검색과 background 업데이트가 같은 그래프를 동시에 읽고 쓰지 않도록 잠근다
+        with self.lock:
+            self.step += 1
+
+            # 1. 최근 n개의 트리플릿 기반 연관 서브그래프 재계산
+            #t0 = time.time()
+            triplets_str, position, lexical_index = self.search_view()  # 전체 트리플릿 목록(문자열, world graph 포함)
+            associated_subgraph_new = set()
+            recent_triplets = self.triplets[-recent_n:]
+            recent_triplets_str = self.triplets_to_str(recent_triplets)
+            for trip in recent_triplets_str:
+                results = graph_retr_search(
+                    trip, triplets_str, self.retriever,
+                    max_depth=3,
+                    topk=4,
+                    post_retrieve_threshold=0.65,
+                    verbose=2,
+                    mode=self.retrieval_mode,
+                    lexical_index=lexical_index,
+                    vector_index=self.search_index(),
+                    position=position
+                )
+                associated_subgraph_new.update(results)
+            # 최근 추가된 트리플릿은 제외
+            associated_subgraph_new = [element for element in associated_subgraph_new if element not in recent_triplets_str]
+            self.touch(recent_triplets_str)
+            self.touch(associated_subgraph_new)
+            #if self.debug:
+            #    print(f"[Retrieval] 최근 {recent_n}개 트리플릿 기반 연관 서브그래프 계산 시간: {time.time() - t0:.4f} sec")
+
+            # 2. Episodic memory 검색 (현재 observation 기반)
+            #t1 = time.time()
+            if retrieval_context is not None:
+                observation_embedding = retrieval_context.embed(observation, self.retriever)
+            else:
+                observation_embedding = self.retriever.embed(observation)
+            # episodic 임베딩 행렬은 obs_episodic이 늘어날 때만 다시 쌓는다 (obs_episodic은 추가만 됨)
+            # background 업데이트가 동시에 항목을 추가할 수 있으므로 얕은 복사본 기준으로 계산
+            episodes = dict(self.obs_episodic)
+            episodic_matrix = self.episodic_matrix
+            if episodes and (episodic_matrix is None or len(episodic_matrix) != len(episodes)):
+                episodic_matrix = self.episodic_matrix = torch.stack([value[1] for value in episodes.values()])
+            top_episodic_dict = find_top_episodic_emb(prev_subgraph, episodes, observation_embedding, self.retriever,
+                                                      key_embeddings=episodic_matrix)
+            top_episodic = top_k_obs(top_episodic_dict, k=topk_episodic)
+            #if self.debug:
+            #    print(f"[Episodic] top episodic 계산 시간: {time.time() - t1:.4f} sec")
+
+            #overall_time = time.time() - overall_start
+            #if self.debug:
+            #    print(f"=== DEBUG: 전체 memory_retrieve 소요 시간: {overall_time:.4f} sec ===")
+            return associated_subgraph_new, top_episodic
+
+
+
+
+def clear_triplet(triplet, resolve=None):
+    """
+    소문자화/구두점 제거한 트리플릿을 반환합니다. resolve가 있으면 엔티티에 적용합니다 (alias 정규화 등).
+    """
+    subject = triplet.subject.lower().strip('''"'. `;:''')
+    obj = triplet.object.lower().strip('''"'. `;:''')
+    if resolve is not None:
+        subject, obj = resolve(subject), resolve(obj)
+    return Triplet(subject, obj, triplet.label.lower().strip('''"'. `;:'''))
 
 def process_triplets(raw_triplets):
     raw_triplets = raw_triplets.split(";")
@@ -268,7 +770,7 @@ def process_triplets(raw_triplets):
         obj = obj.strip(''' '\n"''')
         if len(subj) == 0 or len(relation) == 0 or len(obj) == 0:
             continue
-        triplets.append([subj, obj, {"label": relation}])
+        triplets.append(Triplet(subj, obj, relation))
     return triplets
 
 
@@ -288,7 +790,7 @@ def parse_triplets_removing(text):
         subj = first_triplet[0].strip(''' '"\n''')
         rel = first_triplet[1].strip(''' '"\n''')
         obj = first_triplet[2].strip(''' '"\n''')
-        parsed_triplets.append([subj, obj, {"label": rel}])
+        parsed_triplets.append(Triplet(subj, obj, rel))
     return parsed_triplets
 
 
@@ -0,0 +1,229 @@
+# 임베딩 모델 추론 백엔드
+# MODEL_CONFIGS의 모델을 fp32 PyTorch 외의 CPU 백엔드로 로드한다.
+#   "torch"      - 기존 SentenceTransformer (fp32)
+#   "torch-int8" - torch 동적 int8 양자화 (nn.Linear)
+#   "onnx"       - ONNX Runtime (fp32), 최초 1회 export 후 EMBEDDING_CACHE_DIR에 저장
+#   "onnx-int8"  - ONNX Runtime + 동적 int8 양자화 (ONNX_QUANTIZATION_CONFIG 명령어 집합 기준)
+# ONNX 백엔드는 sentence-transformers>=3.2, optimum[onnxruntime]가 필요하다.
+# fp32 이외의 백엔드는 처음 로드할 때 fp32 모델과 코사인 유사도를 비교(parity check)하고,
+# 기준에 못 미치면 fp32 모델로 대체한다. 결과는 캐시 디렉터리의 parity.json에 기록된다.
+#
+# 벤치마크: python embedding_backends.py --model paraphrase-multilingual-mpnet-base-v2
+
+import os
+import json
+import time
+
+import torch
+import torch.nn.functional as F
+# sentence_transformers(transformers 포함)는 import 비용이 커서 모델을 실제로 로드할 때 import 한다
+
+EMBEDDING_BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+EMBEDDING_CACHE_DIR = os.environ.get(
+    "GOALLM_EMBEDDING_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "embedding_cache"))
+ONNX_QUANTIZATION_CONFIG = "avx2"   # "arm64" / "avx2" / "avx512" / "avx512_vnni"
+PARITY_THRESHOLD = 0.99             # fp32 대비 최소 코사인 유사도
+
+# parity check / 벤치마크용 문장 (트리플릿, 관찰, 지식 문단 길이를 섞음)
+SAMPLE_TEXTS = [
+    "apple, is a, fruit",
+    "user, is in, conference barracks",
+    "npc, gave, sword to user",
+    "The user is at the conference barracks",
+    "사용자가 대장간에 들어와 검을 수리해 달라고 부탁했다.",
+    "AI와 머신러닝의 최신 동향",
+    "인공지능은 현대 기술 발전의 핵심 동력입니다. 대규모 언어 모델과 임베딩 모델은 검색, 요약, 대화 등 "
+    "다양한 작업에 사용되며, 게임 NPC의 기억과 대화를 구성하는 데에도 활용됩니다.",
+    "The old blacksmith has lived in the village for forty years. He knows every traveller who passes "
+    "through the northern gate and keeps a ledger of debts that nobody dares to question.",
+]
+
+
+def build_sentence_transformer(config, device="cpu", backend="torch", model_kwargs=None):
+    """
+    MODEL_CONFIGS 항목으로 SentenceTransformer를 구성합니다.
+    load_direct가 아니면 Transformer + Pooling 조합으로 구성합니다.
+    """
+    from sentence_transformers import SentenceTransformer, models
+    backend_kwargs = {}
+    if backend != "torch":
+        backend_kwargs["backend"] = backend
+        if model_kwargs:
+            backend_kwargs["model_kwargs"] = model_kwargs
+    if config.get("load_direct", False):
+        # 이미 SentenceTransformer 형식인 모델이면 바로 로드
+        return SentenceTransformer(config["model_name"], device=device, **backend_kwargs)
+
+    transformer_kwargs = {}
+    if backend != "torch":
+        transformer_kwargs["backend"] = backend
+        if model_kwargs:
+            transformer_kwargs["model_args"] = model_kwargs
+    transformer = models.Transformer(
+        model_name_or_path=config["model_name"],
+        max_seq_length=config.get("max_seq_length", 256),
+        device=device,
+        **transformer_kwargs
+    )
+    pooling_mode = config.get("pooling", "mean")
+    if pooling_mode == "cls":
+        pooling = models.Pooling(
+            transformer.get_word_embedding_dimension(),
+            pooling_mode_cls_token=True
+        )
+    else:
+        # "mean" 및 알 수 없는 값은 평균 풀링
+        pooling = models.Pooling(
+            transformer.get_word_embedding_dimension(),
+            pooling_mode_mean_tokens=True,
+            pooling_mode_cls_token=False
+        )
+    return SentenceTransformer(modules=[transformer, pooling])
+
+
+def cache_path(model_key, backend):
+    return os.path.join(EMBEDDING_CACHE_DIR, f"{model_key}-{backend}")
+
+
+def load_onnx(model_key, config, quantize=False):
+    """
+    ONNX 모델을 캐시에서 로드합니다. 캐시가 없으면 export(및 int8 양자화) 후 저장합니다.
+    """
+    from sentence_transformers import SentenceTransformer
+    path = cache_path(model_key, "onnx-int8" if quantize else "onnx")
+    quantized_file = f"onnx/model_qint8_{ONNX_QUANTIZATION_CONFIG}.onnx"
+    exported = os.path.exists(os.path.join(path, "modules.json"))
+    if exported and quantize and not os.path.exists(os.path.join(path, quantized_file)):
+        exported = False
+    if not exported:
+        print(f"[Embedding] Exporting {model_key} to ONNX ({path})...")
+        model = build_sentence_transformer(config, "cpu", backend="onnx")
+        model.save_pretrained(path)
+        if quantize:
+            from sentence_transformers import export_dynamic_quantized_onnx_model
+            export_dynamic_quantized_onnx_model(model, ONNX_QUANTIZATION_CONFIG, path)
+    model_kwargs = {"file_name": quantized_file} if quantize else None
+    return SentenceTransformer(path, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+
+
+def quantize_torch(model):
+    # nn.Linear 가중치를 int8로 동적 양자화 (CPU 전용)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+@torch.no_grad()
+def check_parity(reference, candidate, texts=SAMPLE_TEXTS, threshold=PARITY_THRESHOLD):
+    """
+    같은 문장에 대해 두 모델 임베딩의 코사인 유사도를 비교합니다.
+    :return: {"passed", "min_cosine", "mean_cosine", "threshold"}
+    """
+    expected = reference.encode(texts, convert_to_tensor=True).float().cpu()
+    actual = candidate.encode(texts, convert_to_tensor=True).float().cpu()
+    cosine = F.cosine_similarity(expected, actual, dim=-1)
+    min_cosine, mean_cosine = cosine.min().item(), cosine.mean().item()
+    return {"passed": min_cosine >= threshold, "min_cosine": min_cosine, "mean_cosine": mean_cosine, "threshold": threshold}
+
+
+def read_parity_report(model_key, backend):
+    path = os.path.join(cache_path(model_key, backend), "parity.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_parity_report(model_key, backend, report):
+    path = cache_path(model_key, backend)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "parity.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_backend_model(model_key, config, backend):
+    if backend == "torch-int8":
+        return quantize_torch(build_sentence_transformer(config, "cpu"))
+    return load_onnx(model_key, config, quantize=backend == "onnx-int8")
+
+
+def load_embedder(model_key, config, device="cpu", backend="torch"):
+    """
+    model_key 모델을 지정한 백엔드로 로드합니다.
+    처음 로드할 때 fp32 모델과 parity check를 하고, 실패하면(또는 이전에 실패했으면) fp32 모델을 반환합니다.
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}'. Use one of {EMBEDDING_BACKENDS}.")
+    if backend == "torch":
+        return build_sentence_transformer(config, device)
+    if device != "cpu":
+        print(f"[Embedding] Backend '{backend}' runs on CPU only; using 'torch' on {device}.")
+        return build_sentence_transformer(config, device)
+
+    report = read_parity_report(model_key, backend)
+    if report is not None and not report["passed"]:
+        print(f"[Embedding] {model_key}/{backend} failed parity check earlier "
+              f"(min cosine {report['min_cosine']:.4f}); using fp32 torch.")
+        return build_sentence_transformer(config, device)
+
+    candidate = load_backend_model(model_key, config, backend)
+    if report is None:
+        reference = build_sentence_transformer(config, device)
+        report = check_parity(reference, candidate)
+        write_parity_report(model_key, backend, report)
+        print(f"[Embedding] {model_key}/{backend} parity: min cosine {report['min_cosine']:.4f}, "
+              f"mean {report['mean_cosine']:.4f} ({'passed' if report['passed'] else 'FAILED'})")
+        if not report["passed"]:
+            return reference
+    return candidate
+
+
+@torch.no_grad()
+def benchmark(embedders, texts=SAMPLE_TEXTS, repeats=5):
+    """
+    백엔드별 문장 1개 임베딩 지연(턴마다 발생하는 경로)과 배치 처리량을 측정합니다.
+    :param embedders: {백엔드 이름: SentenceTransformer}
+    :return: {백엔드 이름: {"per_text_ms", "batch_ms"}}
+    """
+    results = {}
+    for name, embedder in embedders.items():
+        embedder.encode(texts)  # warmup
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for text in texts:
+                embedder.encode([text])
+        per_text_ms = (time.perf_counter() - start) / (repeats * len(texts)) * 1000
+        start = time.perf_counter()
+        for _ in range(repeats):
+            embedder.encode(texts)
+        batch_ms = (time.perf_counter() - start) / repeats * 1000
+        results[name] = {"per_text_ms": per_text_ms, "batch_ms": batch_ms}
+    return results
+
+
+# ==== 백엔드 비교 벤치마크 ====
+if __name__ == "__main__":
+    import argparse
+    from retriever import MODEL_CONFIGS
+
+    parser = argparse.ArgumentParser(description="Compare embedding inference backends.")
+    parser.add_argument("--model", default="paraphrase-multilingual-mpnet-base-v2", choices=list(MODEL_CONFIGS))
+    parser.add_argument("--backends", nargs="+", default=list(EMBEDDING_BACKENDS), choices=EMBEDDING_BACKENDS)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    config = MODEL_CONFIGS[args.model]
+    reference = build_sentence_transformer(config, "cpu")
+    embedders = {}
+    for backend in args.backends:
+        embedders[backend] = reference if backend == "torch" else load_backend_model(args.model, config, backend)
+
+    print(f"=== {args.model} ===")
+    print(f"{'backend':<12} {'min cos':>8} {'mean cos':>9} {'ms/text':>9} {'batch ms':>9} {'speedup':>8}")
+    timings = benchmark(embedders, repeats=args.repeats)
+    baseline = timings.get("torch", next(iter(timings.values())))["per_text_ms"]
+    for backend, embedder in embedders.items():
+        report = check_parity(reference, embedder)
+        if backend != "torch":
+            write_parity_report(args.model, backend, report)
+        timing = timings[backend]
+        print(f"{backend:<12} {report['min_cosine']:>8.4f} {report['mean_cosine']:>9.4f} "
+              f"{timing['per_text_ms']:>9.2f} {timing['batch_ms']:>9.2f} {baseline / timing['per_text_ms']:>7.2f}x")
@@ -0,0 +1,246 @@
+# 임베딩 워커 프로세스 풀
+# Retriever(workers=N)는 임베딩 계산(토크나이즈 + 모델 추론)을 N개의 워커 프로세스에 맡긴다.
+# 웹 워커 스레드는 GIL을 잡고 있는 시간이 짧아지고, CPU 추론은 프로세스 수만큼 코어에 나뉘어 실행된다.
+# - 각 워커는 같은 모델/백엔드로 Retriever를 하나씩 로드하고, torch 연산 스레드 수(intra_op_threads)를 따로 정한다
+# - 요청 텍스트는 파이프로 보내고, 결과 벡터는 워커가 만든 공유 메모리 버퍼에 써서 부모가 그대로 복사해 간다 (pickle 없음)
+# - 한 워커는 한 번에 한 요청만 처리하며, 놀고 있는 워커가 없으면 요청 스레드가 기다린다 (CHECKOUT_TIMEOUT까지)
+# - 워커가 죽거나 EMBED_TIMEOUT 안에 응답하지 않으면 그 요청은 실패하고 (응답 없는 워커는 종료),
+#   교체 워커는 백그라운드 스레드에서 띄운다 (모델 로드를 요청 스레드가 기다리지 않음)
+# 워커로 옮기는 것은 임베딩 계산뿐이다. graph_retr_search/find_top_episodic_emb의 점수 계산(파이썬 루프 포함)은
+# 웹 프로세스에서 GIL을 잡은 채 실행되며, 이 풀로는 줄어들지 않는다.
+# 워커는 이 파일을 스크립트로 실행한 별도 프로세스이고, 부모의 Listener에 접속해 통신한다.
+# (multiprocessing spawn은 서버의 __main__ 모듈을 워커에서 다시 import 하므로 사용하지 않는다)
+
+import os
+import sys
+import time
+import queue
+import atexit
+import logging
+import threading
+import subprocess
+from multiprocessing import shared_memory
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BATCH_CAPACITY = 256      # 워커 공유 버퍼에 한 번에 담는 벡터 수 (넘는 요청은 나눠서 보낸다)
+START_TIMEOUT = 600.0     # 워커의 모델 로드를 기다리는 최대 시간 (초)
+EMBED_TIMEOUT = 60.0      # 임베딩 요청 하나(최대 BATCH_CAPACITY개)의 응답을 기다리는 최대 시간 (초), 넘으면 워커를 멈춘 것으로 본다
+CHECKOUT_TIMEOUT = 30.0   # 놀고 있는 워커를 기다리는 최대 시간 (초) - 교체 중이라 워커가 없을 때 요청이 무한정 멈추지 않도록
+RESTART_BACKOFF = (1.0, 60.0)  # 교체 워커 시작이 실패했을 때 재시도 간격 (처음, 최대; 실패할 때마다 두 배)
+
+
+def worker_main(conn, model_key, device, backend, intra_op_threads, capacity):
+    """
+    워커 프로세스 본체: 모델을 로드하고 공유 버퍼를 만든 뒤 텍스트 목록을 받아 임베딩을 버퍼에 씁니다.
+    """
+    import torch
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    try:
+        from retriever import Retriever
+        retriever = Retriever(device, model_key, backend)
+        dim = retriever.embed(["warmup"]).shape[-1]
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    shm = shared_memory.SharedMemory(create=True, size=capacity * dim * 4)
+    output = np.ndarray((capacity, dim), dtype=np.float32, buffer=shm.buf)
+    conn.send(("ready", shm.name, dim, retriever.max_seq_length))
+    try:
+        while True:
+            texts = conn.recv()
+            if texts is None:
+                break
+            try:
+                embeddings = retriever.embed(texts).float().cpu().numpy()
+                output[:len(embeddings)] = embeddings
+                conn.send(("ok", len(embeddings)))
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        del output
+        shm.close()
+        shm.unlink()
+
+
+class EmbeddingWorker:
+    def __init__(self, model_key, device, backend, intra_op_threads, capacity):
+        authkey = os.urandom(16)
+        self.listener = Listener(authkey=authkey)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(self.listener.address), model_key, device,
+             backend or "", str(intra_op_threads or 0), str(capacity)],
+            env={**os.environ, "GOALLM_EMBED_WORKER_AUTHKEY": authkey.hex()}
+        )
+        self.conn = None
+        self.shm = None
+        self.buffer = None
+
+    def accept(self, timeout):
+        # Listener.accept()에는 timeout이 없으므로 별도 스레드에서 기다리며 워커가 먼저 죽었는지 확인한다
+        accepted = []
+        thread = threading.Thread(target=lambda: accepted.append(self.listener.accept()), daemon=True)
+        thread.start()
+        deadline = time.time() + timeout
+        while thread.is_alive() and self.process.poll() is None and time.time() < deadline:
+            thread.join(0.5)
+        if not accepted:
+            self.process.kill()
+            raise RuntimeError("Embedding worker did not connect.")
+        self.listener.close()
+        return accepted[0]
+
+    def wait_ready(self, timeout):
+        start = time.time()
+        self.conn = self.accept(timeout)
+        try:
+            if not self.conn.poll(max(0.0, timeout - (time.time() - start))):
+                raise TimeoutError("Embedding worker did not start in time.")
+            message = self.conn.recv()
+        except (TimeoutError, EOFError):
+            self.process.kill()
+            raise
+        if message[0] != "ready":
+            self.process.wait()
+            raise RuntimeError(f"Embedding worker failed to start: {message[1]}")
+        _, name, dim, max_seq_length = message
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.buffer = np.ndarray((len(self.shm.buf) // (dim * 4), dim), dtype=np.float32, buffer=self.shm.buf)
+        return dim, max_seq_length
+
+    def embed(self, texts, timeout=EMBED_TIMEOUT):
+        self.conn.send(texts)
+        if not self.conn.poll(timeout):
+            # 응답 없는 워커는 종료한다 (풀이 교체 워커를 띄움)
+            self.process.kill()
+            raise TimeoutError("Embedding worker did not respond in time.")
+        status, value = self.conn.recv()
+        if status != "ok":
+            raise RuntimeError(f"Embedding worker failed: {value}")
+        return self.buffer[:value].copy()
+
+    def close(self):
+        try:
+            if self.conn is not None:
+                self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.buffer = None
+        if self.shm is not None:
+            self.shm.close()
+
+
+class EmbeddingPool:
+    def __init__(self, model_key, device="cpu", backend=None, workers=2, intra_op_threads=None,
+                 capacity=BATCH_CAPACITY, start_timeout=START_TIMEOUT):
+        """
+        :param workers: 워커 프로세스 수
+        :param intra_op_threads: 워커별 torch.set_num_threads 값 (None이면 torch 기본값; 보통 코어 수 / workers)
+        """
+        self.args = (model_key, device, backend, intra_op_threads, capacity)
+        self.device = device
+        self.capacity = capacity
+        self.start_timeout = start_timeout
+        self.lock = threading.Lock()
+        self.workers = [EmbeddingWorker(*self.args) for _ in range(workers)]
+        for worker in self.workers:
+            self.dim, self.max_seq_length = worker.wait_ready(start_timeout)
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.restarts, self.restart_failures, self.restarting = 0, 0, 0
+        self.closed = False
+        atexit.register(self.close)
+
+    def embed(self, texts):
+        """
+        Retriever.embed와 같은 계약: list[str] -> (num_texts, dim) 텐서, str -> 1차원 텐서.
+        """
+        import torch
+        if isinstance(texts, str):
+            return self.embed([texts])[0]
+        if not texts:
+            return torch.empty((0, self.dim), device=self.device)
+        try:
+            worker = self.idle.get(timeout=CHECKOUT_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError("No embedding worker became available (workers may be restarting).")
+        try:
+            chunks = [worker.embed(list(texts[start:start + self.capacity]))
+                      for start in range(0, len(texts), self.capacity)]
+        except (EOFError, OSError) as e:
+            # 연결이 끊기거나 응답하지 않은 (TimeoutError) 워커는 idle로 되돌리지 않는다
+            self._replace_in_background(worker)
+            raise RuntimeError(f"Embedding worker failed ({type(e).__name__}); a replacement is starting.")
+        except BaseException:
+            # 워커가 오류 응답을 보낸 경우 등: 워커는 살아 있으므로 되돌린다
+            self.idle.put(worker)
+            raise
+        self.idle.put(worker)
+        return torch.from_numpy(np.concatenate(chunks)).to(self.device)
+
+    def _replace_in_background(self, worker):
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+            self.restarting += 1
+        threading.Thread(target=self._replace, args=(worker,), name="embedding-restart", daemon=True).start()
+
+    def _replace(self, worker):
+        worker.close()
+        delay = RESTART_BACKOFF[0]
+        try:
+            while not self.closed:
+                replacement = EmbeddingWorker(*self.args)
+                try:
+                    replacement.wait_ready(self.start_timeout)
+                except Exception as e:
+                    replacement.close()
+                    with self.lock:
+                        self.restart_failures += 1
+                    logger.warning(f"Embedding worker restart failed ({type(e).__name__}: {e}); retrying in {delay:.0f}s")
+                    time.sleep(delay)
+                    delay = min(delay * 2, RESTART_BACKOFF[1])
+                    continue
+                with self.lock:
+                    if not self.closed:
+                        self.workers.append(replacement)
+                        self.restarts += 1
+                        self.idle.put(replacement)
+                        logger.info("Embedding worker replaced")
+                        return
+                # 시작하는 동안 풀이 닫힘
+                replacement.close()
+                return
+        finally:
+            with self.lock:
+                self.restarting -= 1
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.close()
+
+    def stats(self):
+        with self.lock:
+            return {"workers": len(self.workers), "idle": self.idle.qsize(), "restarting": self.restarting,
+                    "restarts": self.restarts, "restart_failures": self.restart_failures}
+
+
+if __name__ == "__main__":
+    # EmbeddingPool이 띄우는 워커 진입점: python embedding_pool.py <address> <model_key> <device> <backend> <threads> <capacity>
+    address, model_key, device, backend, threads, capacity = sys.argv[1:7]
+    connection = Client(address, authkey=bytes.fromhex(os.environ["GOALLM_EMBED_WORKER_AUTHKEY"]))
+    worker_main(connection, model_key, device, backend or None, int(threads) or None, int(capacity))
@@ -1,43 +1,154 @@
 
 import os
-import matplotlib.pyplot as plt
-import matplotlib.font_manager as fm
-import networkx as nx
-from adjustText import adjust_text
+import random
 import textwrap
+import threading
+# matplotlib / networkx / adjustText 및 폰트 탐색은 실제로 그림을 그릴 때 한 번만 수행한다 (서버 import 시간 단축)
 
-# Nanum 폰트가 설치된 디렉토리 내의 .ttf 파일 목록 가져오기
-nanum_font_paths = [os.path.join(root, file)
-                    for root, dirs, files in os.walk('/usr/share/fonts/truetype/nanum')
-                    for file in files if file.endswith('.ttf')]
+fonts_ready = False
 
-# 설치된 Nanum 폰트가 있는지 확인하고, 첫 번째 폰트를 사용하도록 설정
-if nanum_font_paths:
-    font_path = nanum_font_paths[0]
-    fm.fontManager.addfont(font_path)
-    font_name = fm.FontProperties(fname=font_path).get_name()
-    plt.rcParams['font.family'] = font_name
-    print(f"Using font: {font_name}")
-else:
-    print("Nanum 폰트를 찾을 수 없습니다. 다른 한글 폰트를 사용하세요.")
+def setup_fonts():
+    global fonts_ready
+    if fonts_ready:
+        return
+    import matplotlib.pyplot as plt
+    import matplotlib.font_manager as fm
 
-plt.rcParams['axes.unicode_minus'] = False  # 마이너스 기호 깨짐 방지
+    # Nanum 폰트가 설치된 디렉토리 내의 .ttf 파일 목록 가져오기
+    nanum_font_paths = [os.path.join(root, file)
+                        for root, dirs, files in os.walk('/usr/share/fonts/truetype/nanum')
+                        for file in files if file.endswith('.ttf')]
 
-def plot_contriever_graph(graph):
+    # 설치된 Nanum 폰트가 있는지 확인하고, 첫 번째 폰트를 사용하도록 설정
+    if nanum_font_paths:
+        font_path = nanum_font_paths[0]
+        fm.fontManager.addfont(font_path)
+        font_name = fm.FontProperties(fname=font_path).get_name()
+        plt.rcParams['font.family'] = font_name
+        print(f"Using font: {font_name}")
+    else:
+        print("Nanum 폰트를 찾을 수 없습니다. 다른 한글 폰트를 사용하세요.")
+
+    plt.rcParams['axes.unicode_minus'] = False  # 마이너스 기호 깨짐 방지
+    fonts_ready = True
+
+# 큰 그래프 시각화 설정
+MAX_VIEW_NODES = 150        # 샘플링 후 최대 노드 수
+COLD_LAYOUT_ITERATIONS = 100  # 캐시된 위치가 없을 때 spring_layout 반복 횟수
+WARM_LAYOUT_ITERATIONS = 15   # 이전 위치에서 이어서 계산할 때의 반복 횟수
+ADJUST_TEXT_MAX_NODES = 60    # 이보다 노드가 많으면 adjust_text(라벨 겹침 보정)를 생략
+
+
+class GraphView:
+    """
+    ContrieverGraph의 시각화용 NetworkX 그래프와 노드 위치를 보관합니다.
+    sync()는 바뀐 트리플릿만 반영하고, layout()은 이전 위치에서 이어서 계산하므로
+    같은 세션을 반복해서 조회해도 매번 전체 그래프를 처음부터 배치하지 않습니다.
     """
+    def __init__(self, max_nodes=MAX_VIEW_NODES):
+        import networkx as nx
+        self.G = nx.DiGraph()
+        self.max_nodes = max_nodes
+        self.edge_keys = {}     # 트리플릿 key -> (subject, object, label)
+        self.pair_keys = {}     # (subject, object) -> 그 에지를 이루는 트리플릿 key 집합 (DiGraph는 노드 쌍당 에지 1개)
+        self.positions = {}     # 노드 -> (x, y)
+        self.lock = threading.Lock()
+
+    def sync(self, graph):
+        """
+        graph.triplets와의 차이만 그래프에 반영합니다.
+        """
+        # overlay 그래프면 공유 world graph의 (가려지지 않은) 트리플릿도 함께 표시
+        triplets = {triplet.key: triplet for triplet in list(graph.all_triplets())}
+        for key in [key for key in self.edge_keys if key not in triplets]:
+            subject, obj, _ = self.edge_keys.pop(key)
+            remaining = self.pair_keys[(subject, obj)]
+            remaining.discard(key)
+            if remaining:
+                # 같은 노드 쌍의 다른 트리플릿이 남아 있으면 그 관계로 라벨만 바꾼다
+                self.G[subject][obj]["relation"] = self.edge_keys[next(iter(remaining))][2]
+                continue
+            del self.pair_keys[(subject, obj)]
+            self.G.remove_edge(subject, obj)
+            for node in (subject, obj):
+                if node in self.G and self.G.degree(node) == 0:
+                    self.G.remove_node(node)
+                    self.positions.pop(node, None)
+        for key, triplet in triplets.items():
+            if key in self.edge_keys:
+                continue
+            self.edge_keys[key] = (triplet.subject, triplet.object, triplet.label)
+            self.pair_keys.setdefault((triplet.subject, triplet.object), set()).add(key)
+            self.G.add_edge(triplet.subject, triplet.object, relation=triplet.label)
 
+    def sample_nodes(self, max_nodes):
+        # 연결 수가 많은 노드 위주로 샘플링
+        if self.G.number_of_nodes() <= max_nodes:
+            return list(self.G.nodes)
+        return sorted(self.G.nodes, key=self.G.degree, reverse=True)[:max_nodes]
+
+    def layout(self, nodes):
+        """
+        nodes로 이루어진 부분 그래프의 위치를 계산합니다. 이미 위치가 있는 노드는 그 위치에서 시작하고,
+        새 노드는 이웃 노드 근처에서 시작합니다.
+        """
+        import networkx as nx
+        subgraph = self.G.subgraph(nodes)
+        if subgraph.number_of_nodes() == 0:
+            return {}
+        initial = {}
+        for node in subgraph.nodes:
+            if node in self.positions:
+                initial[node] = self.positions[node]
+                continue
+            placed = [self.positions[neighbor] for neighbor in nx.all_neighbors(self.G, node) if neighbor in self.positions]
+            if placed:
+                x = sum(p[0] for p in placed) / len(placed) + random.uniform(-0.05, 0.05)
+                y = sum(p[1] for p in placed) / len(placed) + random.uniform(-0.05, 0.05)
+                initial[node] = (x, y)
+        warm = len(initial) == subgraph.number_of_nodes()
+        # spring_layout은 pos에 없는 노드를 무작위 위치에서 시작한다
+        pos = nx.spring_layout(subgraph, k=1.5, pos=initial or None, seed=42,
+                               iterations=WARM_LAYOUT_ITERATIONS if warm else COLD_LAYOUT_ITERATIONS)
+        positions = {node: (float(x), float(y)) for node, (x, y) in pos.items()}
+        self.positions.update(positions)
+        return positions
+
+    def export(self, graph, max_nodes=None):
+        """
+        클라이언트 측 렌더링용 JSON(dict)을 반환합니다: nodes(id, x, y, degree), edges(source, target, label).
+        """
+        with self.lock:
+            self.sync(graph)
+            nodes = self.sample_nodes(max_nodes or self.max_nodes)
+            positions = self.layout(nodes)
+            subgraph = self.G.subgraph(nodes)
+            return {
+                "nodes": [{"id": node, "x": positions[node][0], "y": positions[node][1], "degree": self.G.degree(node)}
+                          for node in subgraph.nodes],
+                "edges": [{"source": source, "target": target, "label": relation}
+                          for source, target, relation in subgraph.edges(data="relation")],
+                "total_nodes": self.G.number_of_nodes(),
+                "total_edges": self.G.number_of_edges(),
+                "sampled": subgraph.number_of_nodes() < self.G.number_of_nodes(),
+            }
+
+
+def plot_contriever_graph(graph, view=None, max_nodes=MAX_VIEW_NODES):
+    """
+    그래프를 matplotlib로 그립니다. 같은 view(GraphView)를 넘기면 이전 배치를 이어서 사용합니다.
     """
-    # Directed NetworkX 그래프 생성
-    G = nx.DiGraph()
-    for triplet in graph.triplets:
-        subject, obj, attrs = triplet
-        relation = attrs.get("label", "")
-        G.add_node(subject)
-        G.add_node(obj)
-        G.add_edge(subject, obj, relation=relation)
-
-    # spring_layout을 사용하여 노드들이 균일하게 분포되도록 설정 (k값과 반복 횟수를 조정)
-    pos = nx.spring_layout(G, k=1.5, iterations=100, seed=42)
+    import matplotlib.pyplot as plt
+    import networkx as nx
+    from adjustText import adjust_text
+    setup_fonts()
+
+    if view is None:
+        view = GraphView(max_nodes)
+    with view.lock:
+        view.sync(graph)
+        pos = view.layout(view.sample_nodes(max_nodes))
+        G = view.G.subgraph(pos.keys()).copy()
 
     # 고정된 큰 사이즈의 Figure 생성
     fig, ax = plt.subplots(figsize=(12, 12))
@@ -58,8 +169,9 @@ def plot_contriever_graph(graph):
                        color='black', ha='center', va='center')
         texts.append(text)
 
-    # adjust_text를 이용해 라벨 간의 겹침을 최소화
-    adjust_text(texts, arrowprops=dict(arrowstyle='->', color='gray', lw=0.5))
+    # adjust_text를 이용해 라벨 간의 겹침을 최소화 (노드가 많으면 비용이 커서 생략)
+    if len(texts) <= ADJUST_TEXT_MAX_NODES:
+        adjust_text(texts, arrowprops=dict(arrowstyle='->', color='gray', lw=0.5))
 
     # 에지 라벨을 에지 중간에 그리며, 긴 텍스트는 자동 줄바꿈 처리
     edge_labels = nx.get_edge_attributes(G, 'relation')
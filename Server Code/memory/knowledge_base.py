@@ -0,0 +1,249 @@
+# 외부 지식 베이스 (hot reload)
+# 지식 파일(JSONL/YAML)의 (주제, 내용) 항목을 네임스페이스별로 읽어 정규화된 임베딩 행렬과 BM25 색인을 만든다.
+# 파일이 바뀌면 추가/수정된 항목만(내용 해시 기준) 새로 임베딩하고, 바뀐 네임스페이스의 색인만 다시 만든 새 스냅샷으로
+# 참조 하나를 바꿔 끼운다. 검색은 호출 시점의 스냅샷 하나만 읽으므로 reload 중에도 잠금 없이 일관된 결과를 얻는다.
+#
+# JSONL: 한 줄에 {"subject": ..., "content": ..., "namespace": "npc:guard"}
+# YAML : [{subject, content, namespace}, ...] 또는 {"namespace": ..., "entries": [...]}  (PyYAML 필요)
+# namespace를 생략하면 파일의 기본 namespace, 그것도 없으면 DEFAULT_NAMESPACE("global", 모든 세션이 검색).
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from lexical import LexicalIndex
+
+DEFAULT_NAMESPACE = "global"
+KNOWLEDGE_EXTENSIONS = (".jsonl", ".yaml", ".yml")
+POLL_INTERVAL = 5.0  # 파일 변경 확인 간격 (초)
+
+
+def entry_text(subject, content):
+    # filter_items_by_similarity와 같은 "주제: 내용" 형식 (임베딩/BM25 문서 id)
+    return f"{subject}: {content}"
+
+
+class KnowledgeEntry:
+    __slots__ = ("subject", "content", "namespace", "text", "hash")
+
+    def __init__(self, subject, content, namespace=DEFAULT_NAMESPACE):
+        self.subject = str(subject)
+        self.content = str(content)
+        self.namespace = namespace or DEFAULT_NAMESPACE
+        self.text = entry_text(self.subject, self.content)
+        self.hash = hashlib.sha1(self.text.encode("utf-8")).hexdigest()
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        return None, [json.loads(line) for line in f if line.strip()]
+
+
+def read_yaml(path):
+    try:
+        import yaml
+    except ImportError:
+        raise ImportError(f"Reading {path} requires PyYAML (pip install pyyaml).")
+    with open(path, encoding="utf-8") as f:
+        document = yaml.safe_load(f) or []
+    if isinstance(document, dict):
+        return document.get("namespace"), document.get("entries") or []
+    return None, document
+
+
+def load_entries(path):
+    """
+    지식 파일 하나를 읽어 KnowledgeEntry 리스트를 반환합니다.
+    """
+    reader = read_jsonl if path.endswith(".jsonl") else read_yaml
+    file_namespace, items = reader(path)
+    entries = []
+    for item in items:
+        if "subject" not in item or "content" not in item:
+            raise ValueError(f"{path}: knowledge entries need 'subject' and 'content': {item}")
+        entries.append(KnowledgeEntry(item["subject"], item["content"], item.get("namespace") or file_namespace))
+    return entries
+
+
+class NamespaceIndex:
+    """
+    한 네임스페이스의 항목, 정규화된 키 행렬, BM25 색인. 만든 뒤에는 바꾸지 않습니다.
+    """
+    def __init__(self, entries, matrix):
+        self.entries = entries
+        self.data = [(entry.subject, entry.content) for entry in entries]
+        self.hashes = tuple(entry.hash for entry in entries)
+        self.matrix = matrix
+        self.lexical_index = LexicalIndex()
+        self.lexical_index.sync([entry.text for entry in entries])
+
+
+class KnowledgeSnapshot:
+    def __init__(self, version, namespaces):
+        self.version = version
+        self.namespaces = namespaces   # namespace -> NamespaceIndex
+        self.loaded_at = time.time()
+
+
+class KnowledgeBase:
+    def __init__(self, paths, builtin=None, poll_interval=POLL_INTERVAL):
+        """
+        :param paths: 지식 파일 또는 디렉터리 경로 목록 (디렉터리는 하위의 .jsonl/.yaml/.yml 파일 전체)
+        :param builtin: 파일과 함께 DEFAULT_NAMESPACE로 올릴 [(주제, 내용)] (system_prompt.predefined_knowledge)
+        """
+        self.paths = list(paths)
+        self.builtin = list(builtin or [])
+        self.poll_interval = poll_interval
+        self.retriever = None
+        self.embeddings = {}           # 내용 해시 -> 정규화된 임베딩 (현재 스냅샷에 있는 항목만 유지)
+        self.snapshot = KnowledgeSnapshot(0, {})
+        self.file_state = None
+        self.reload_lock = threading.Lock()
+        self.watcher = None
+        self.stop_watch = threading.Event()
+        self.reloads, self.embedded, self.errors = 0, 0, 0
+        self.last_error = None
+
+    def source_files(self):
+        files = []
+        for path in self.paths:
+            if os.path.isdir(path):
+                for root, _, names in os.walk(path):
+                    files.extend(os.path.join(root, name) for name in names if name.endswith(KNOWLEDGE_EXTENSIONS))
+            elif os.path.isfile(path):
+                files.append(path)
+        return sorted(files)
+
+    def current_file_state(self):
+        state = {}
+        for path in self.source_files():
+            stat = os.stat(path)
+            state[path] = (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    def collect_entries(self, files):
+        entries = [KnowledgeEntry(subject, content) for subject, content in self.builtin]
+        for path in files:
+            entries.extend(load_entries(path))
+        # 같은 네임스페이스 안의 중복 항목은 하나만 남긴다 (BM25/행렬 위치가 텍스트로 매핑되므로)
+        unique = OrderedDict()
+        for entry in entries:
+            unique.setdefault((entry.namespace, entry.hash), entry)
+        return list(unique.values())
+
+    def reload(self, retriever=None, force=False):
+        """
+        파일이 바뀌었으면 새 스냅샷을 만들어 바꿔 끼우고 True를 반환합니다.
+        새로 생기거나 내용이 바뀐 항목만 임베딩하고, 항목 목록이 그대로인 네임스페이스는 기존 색인을 재사용합니다.
+        """
+        import torch
+        import torch.nn.functional as F
+
+        with self.reload_lock:
+            if retriever is not None:
+                self.retriever = retriever
+            state = self.current_file_state()
+            if not force and state == self.file_state:
+                return False
+            entries = self.collect_entries(state)
+
+            new_entries = list({entry.hash: entry for entry in entries if entry.hash not in self.embeddings}.values())
+            if new_entries:
+                vectors = F.normalize(self.retriever.embed([entry.text for entry in new_entries]), p=2, dim=-1)
+                for entry, vector in zip(new_entries, vectors):
+                    self.embeddings[entry.hash] = vector
+                self.embedded += len(new_entries)
+
+            grouped = OrderedDict()
+            for entry in entries:
+                grouped.setdefault(entry.namespace, []).append(entry)
+            previous = self.snapshot.namespaces
+            namespaces = {}
+            for namespace, items in grouped.items():
+                old = previous.get(namespace)
+                if old is not None and old.hashes == tuple(entry.hash for entry in items):
+                    namespaces[namespace] = old
+                else:
+                    matrix = torch.stack([self.embeddings[entry.hash] for entry in items])
+                    namespaces[namespace] = NamespaceIndex(items, matrix)
+
+            # 참조 교체는 원자적이므로 검색 중인 요청은 이전 스냅샷을 끝까지 사용한다
+            self.snapshot = KnowledgeSnapshot(self.snapshot.version + 1, namespaces)
+            self.file_state = state
+            self.reloads += 1
+            live = {entry.hash for entry in entries}
+            for key in [key for key in self.embeddings if key not in live]:
+                del self.embeddings[key]
+            return True
+
+    def start_watching(self):
+        """
+        poll_interval마다 파일 변경을 확인해 reload 하는 백그라운드 스레드를 시작합니다.
+        파일이 잘못되었으면 이전 스냅샷을 유지하고 다음 확인 때 다시 시도합니다.
+        """
+        if self.watcher is not None:
+            return
+        self.stop_watch = threading.Event()
+        self.watcher = threading.Thread(target=self._watch, args=(self.stop_watch,), name="knowledge-watcher", daemon=True)
+        self.watcher.start()
+
+    def stop_watching(self, timeout=None):
+        """
+        감시 스레드를 멈추고, 진행 중인 reload가 있으면 끝날 때까지 (최대 timeout초) 기다립니다.
+        """
+        watcher, self.watcher = self.watcher, None
+        if watcher is None:
+            return
+        self.stop_watch.set()
+        watcher.join(timeout)
+
+    def _watch(self, stop):
+        while not stop.wait(self.poll_interval):
+            try:
+                self.reload()
+                self.last_error = None
+            except Exception as e:
+                self.errors += 1
+                self.last_error = f"{type(e).__name__}: {e}"
+
+    def entries(self, namespace=DEFAULT_NAMESPACE):
+        index = self.snapshot.namespaces.get(namespace)
+        return [] if index is None else list(index.data)
+
+    def search(self, query, namespaces, threshold, max_n, mode="dense", candidate_k=10, retrieval_context=None):
+        """
+        namespaces의 항목 중 query와 관련된 (주제, 내용, score)를 최대 max_n개 반환합니다 (filter_items_by_similarity 기준).
+        여러 네임스페이스의 결과는 score 순으로 합칩니다.
+        """
+        from retriever import filter_items_by_similarity
+        snapshot = self.snapshot
+        results, matched = [], 0
+        for namespace in dict.fromkeys(namespaces):
+            index = snapshot.namespaces.get(namespace)
+            if index is None:
+                continue
+            matched += 1
+            results.extend(filter_items_by_similarity(
+                index.data, query, threshold, self.retriever, max_n, mode=mode,
+                lexical_index=index.lexical_index, candidate_k=candidate_k,
+                retrieval_context=retrieval_context, key_matrix=index.matrix
+            ))
+        if matched > 1:
+            results.sort(key=lambda item: item[2], reverse=True)
+        return results[:max_n]
+
+    def stats(self):
+        snapshot = self.snapshot
+        return {
+            "version": snapshot.version,
+            "loaded_at": snapshot.loaded_at,
+            "namespaces": {namespace: len(index.entries) for namespace, index in snapshot.namespaces.items()},
+            "files": len(self.file_state or {}),
+            "reloads": self.reloads,
+            "embedded": self.embedded,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
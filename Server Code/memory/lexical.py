@@ -0,0 +1,167 @@
+# 어휘(lexical) 검색용 역색인
+# 한국어/영어 모두 띄어쓰기 단위가 불안정하므로 단어 + 문자 n-gram을 토큰으로 사용하고 BM25로 점수를 매긴다.
+# 흔한 n-gram(예: 조사, 어미)은 거의 모든 문서에 있어 검색마다 전체 문서를 점수 매기게 되므로,
+# 검색 시에는 문서 빈도가 NGRAM_MAX_DF 이하인 드문 n-gram만 사용한다 (단어 토큰은 항상 사용).
+# dense 검색 전에 후보를 줄이거나(prefilter), dense 결과와 순위를 합치는(hybrid) 용도로 사용한다.
+
+import re
+import math
+from collections import Counter, defaultdict
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+# hybrid 검색에서 BM25 1위를 dense 임계값 없이 채택하는 "강한 일치" 기준.
+# 문자 n-gram 때문에 거의 모든 쿼리가 어떤 문서와든 조금은 일치하므로 1위라는 것만으로는 채택하지 않는다.
+STRONG_MATCH_SCORE = 12.0      # 이 BM25 점수 이상이면 강한 일치
+EXACT_MATCH_MIN_CHARS = 2      # 단어 그대로 일치로 인정할 최소 글자 수
+EXACT_MATCH_MAX_DF = 0.1       # 단어 그대로 일치한 단어가 이 비율보다 많은 문서에 있으면 흔한 단어로 보고 무시
+NGRAM_MAX_DF = 0.05            # 검색에 쓰는 n-gram의 최대 문서 빈도 비율 (이보다 흔한 n-gram은 점수 계산에서 제외)
+NGRAM_MIN_DF_CAP = 5           # 작은 색인에서도 이 문서 수까지 나오는 n-gram은 사용
+
+
+def tokenize(text, ngram_sizes=(2, 3)):
+    """
+    소문자 단어와 각 단어의 문자 n-gram을 토큰으로 반환합니다.
+    예: "레온하르트 가문" -> ["레온하르트", "레온", "온하", ..., "가문", ...]
+    """
+    tokens = []
+    for word in WORD_PATTERN.findall(text.lower()):
+        tokens.append(word)
+        for n in ngram_sizes:
+            if len(word) > n:
+                tokens.extend(word[i:i + n] for i in range(len(word) - n + 1))
+    return tokens
+
+
+class LexicalIndex:
+    """
+    문서 id -> 텍스트를 보관하는 BM25 역색인. 문서 추가/삭제는 해당 문서의 토큰만 갱신합니다.
+    """
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1, self.b = k1, b
+        self.postings = defaultdict(dict)   # 토큰 -> {문서 id: 빈도}
+        self.doc_lengths = {}               # 문서 id -> 토큰 수
+        self.doc_texts = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_lengths
+
+    def add(self, doc_id, text):
+        if doc_id in self.doc_lengths:
+            self.remove(doc_id)
+        counts = Counter(tokenize(text))
+        for token, freq in counts.items():
+            self.postings[token][doc_id] = freq
+        length = sum(counts.values())
+        self.doc_lengths[doc_id] = length
+        self.doc_texts[doc_id] = text
+        self.total_length += length
+
+    def remove(self, doc_id):
+        if doc_id not in self.doc_lengths:
+            return
+        for token in set(tokenize(self.doc_texts[doc_id])):
+            posting = self.postings.get(token)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[token]
+        self.total_length -= self.doc_lengths.pop(doc_id)
+        del self.doc_texts[doc_id]
+
+    def sync(self, texts):
+        """
+        색인을 주어진 텍스트 목록과 같게 맞춥니다 (텍스트 자체를 문서 id로 사용).
+        바뀐 문서만 추가/삭제하므로 매 턴 호출해도 비용이 작습니다.
+        """
+        current = set(texts)
+        for doc_id in [doc_id for doc_id in self.doc_lengths if doc_id not in current]:
+            self.remove(doc_id)
+        for text in current:
+            if text not in self.doc_lengths:
+                self.add(text, text)
+
+    def search(self, query, topk=None):
+        """
+        :return: [(문서 id, BM25 점수)] 점수 내림차순
+        """
+        n_docs = len(self.doc_lengths)
+        if n_docs == 0:
+            return []
+        avg_length = self.total_length / n_docs
+        scores = defaultdict(float)
+        words = set(WORD_PATTERN.findall(query.lower()))
+        max_ngram_df = max(NGRAM_MIN_DF_CAP, NGRAM_MAX_DF * n_docs)
+        for token, query_freq in Counter(tokenize(query)).items():
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            if token not in words and len(posting) > max_ngram_df:
+                # 흔한 n-gram: 거의 모든 문서를 건드리면서 순위에는 거의 기여하지 않는다
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, freq in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                scores[doc_id] += idf * freq * (self.k1 + 1) / (freq + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked if topk is None else ranked[:topk]
+
+    def is_strong_match(self, doc_id, query, score):
+        """
+        search()가 돌려준 (doc_id, score)가 이름처럼 정확한 일치인지 판단합니다.
+        점수가 STRONG_MATCH_SCORE 이상이거나, 흔하지 않은 쿼리 단어가 문서에 단어 그대로 있으면 True.
+        """
+        if score >= STRONG_MATCH_SCORE:
+            return True
+        text = self.doc_texts.get(doc_id)
+        if text is None:
+            return False
+        max_df = max(1, EXACT_MATCH_MAX_DF * len(self.doc_lengths))
+        doc_words = set(WORD_PATTERN.findall(text.lower()))
+        for word in set(WORD_PATTERN.findall(query.lower())):
+            if len(word) >= EXACT_MATCH_MIN_CHARS and word in doc_words and len(self.postings.get(word, ())) <= max_df:
+                return True
+        return False
+
+
+class LayeredLexicalIndex:
+    """
+    공유 색인(base) 위에 세션 색인(overlay)을 얹은 읽기 전용 BM25 뷰 (vector_index.LayeredIndex와 같은 구조).
+    hidden에 있는 base 문서는 보이지 않습니다. 두 색인의 점수는 각자의 문서 통계로 계산된 BM25 점수를 그대로 합칩니다.
+    """
+    def __init__(self, base, overlay, hidden):
+        self.base, self.overlay, self.hidden = base, overlay, hidden
+
+    def __len__(self):
+        return len(self.base) + len(self.overlay)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.overlay or (doc_id not in self.hidden and doc_id in self.base)
+
+    def search(self, query, topk=None):
+        hits = self.overlay.search(query, topk)
+        # 가려진 문서만큼 더 가져와서 걸러낸다
+        base_topk = None if topk is None else topk + len(self.hidden)
+        hits += [hit for hit in self.base.search(query, base_topk) if hit[0] not in self.hidden]
+        ranked = sorted(hits, key=lambda item: item[1], reverse=True)
+        return ranked if topk is None else ranked[:topk]
+
+    def is_strong_match(self, doc_id, query, score):
+        index = self.overlay if doc_id in self.overlay else self.base
+        return index.is_strong_match(doc_id, query, score)
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    여러 순위 목록(문서 id 리스트)을 Reciprocal Rank Fusion으로 합칩니다.
+    :return: [(문서 id, 융합 점수)] 점수 내림차순
+    """
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused[doc_id] += 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
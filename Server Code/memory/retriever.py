@@ -1,42 +1,80 @@
 # https://github.com/AIRI-Institute/AriGraph/tree/main
 
+import threading
 import torch
 import torch.nn.functional as F
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 import numpy as np
-from sentence_transformers import SentenceTransformer, models
+from lexical import reciprocal_rank_fusion
+from embedding_backends import load_embedder
 
 # 전역 캐시 (LRU 방식)
 embedding_cache = OrderedDict()
 CACHE_SIZE = 100  # 캐싱할 최대 임베딩 개수
 
+# 정규화된 키 행렬 캐시 (predefined_knowledge처럼 턴마다 같은 후보 목록을 매번 다시 임베딩/정규화하지 않도록)
+key_matrix_cache = OrderedDict()
+KEY_MATRIX_CACHE_SIZE = 8
+
+# 검색 모드
+#   "dense"   - 모든 후보와 dense 유사도 계산 (기존 방식)
+#   "lexical" - LexicalIndex(BM25) 상위 candidate_k개 후보만 dense로 재점수
+#   "hybrid"  - dense 순위와 BM25 순위를 Reciprocal Rank Fusion으로 합침 (정확한 이름 일치를 보완)
+RETRIEVAL_MODES = ("dense", "lexical", "hybrid")
+
+# 길이 버킷: (버킷 최대 토큰 수, 배치 크기). 입력을 토큰 길이 순으로 정렬해 버킷별로 인코딩하므로
+# 짧은 트리플릿이 긴 관찰/지식 문단 길이만큼 패딩되지 않는다
+LENGTH_BUCKETS = [(32, 128), (128, 32), (512, 8), (None, 2)]
+TOKEN_LENGTH_CACHE_SIZE = 10000
+token_length_cache = {}  # model_key -> OrderedDict(text -> (토큰 수, 인코딩할 문자열))
+
+# 위 LRU 캐시들은 요청/background/warmup 스레드가 함께 쓰므로 조회·갱신·eviction을 이 잠금 안에서 한다
+# (임베딩/토크나이즈 계산 자체는 잠금 밖에서 실행)
+cache_lock = threading.Lock()
+
+# 최대 토큰 수를 넘는 입력의 truncation 정책
+#   "head"      - 앞부분만 유지 (SentenceTransformer 기본 동작)
+#   "head_tail" - 앞/뒤 절반씩 유지 (긴 문단의 결론부를 보존)
+TRUNCATION_POLICIES = ("head", "head_tail")
+
 # 각 모델별 설정 (Hugging Face Model Hub 기준)
+# backend: 추론 백엔드 (embedding_backends.EMBEDDING_BACKENDS)
+# max_tokens / truncation: 인코딩 전 입력 길이 상한과 truncation 정책 (기본: max_seq_length, "head")
 MODEL_CONFIGS = {
     "paraphrase-multilingual-mpnet-base-v2": {
         "load_direct": True,
-        "model_name": "paraphrase-multilingual-mpnet-base-v2"
+        "model_name": "paraphrase-multilingual-mpnet-base-v2",
+        "backend": "torch"
     },
     "LaBSE": {
         "load_direct": True,
-        "model_name": "sentence-transformers/LaBSE"
+        "model_name": "sentence-transformers/LaBSE",
+        "backend": "torch"
     },
     "multilingual-e5-large-instruct": {
         "load_direct": False,
         "model_name": "intfloat/multilingual-e5-large",
         "pooling": "mean",         # 평균 풀링 사용
-        "max_seq_length": 512      # 최대 시퀀스 길이
+        "max_seq_length": 512,     # 최대 시퀀스 길이
+        "backend": "torch"
     },
     "BGE-M3": {
         "load_direct": False,
         "model_name": "BAAI/bge-m3",
         "pooling": "cls",          # CLS 토큰 풀링 사용
-        "max_seq_length": 8192
+        "max_seq_length": 8192,
+        "max_tokens": 1024,        # 게임 내 텍스트에는 8192 토큰이 필요 없음
+        "truncation": "head_tail",
+        "backend": "torch"
     },
     "Nomic-Embed": {
         "load_direct": False,
         "model_name": "nomic-ai/nomic-embed-text-v1",
         "pooling": "mean",         # 평균 풀링 사용
-        "max_seq_length": 8192
+        "max_seq_length": 8192,
+        "max_tokens": 1024,        # 게임 내 텍스트에는 8192 토큰이 필요 없음
+        "truncation": "head_tail",
+        "backend": "torch"
     }
 }
 
@@ -46,49 +84,118 @@ class Retriever:
 
     모델은 MODEL_CONFIGS의 설정에 따라 Hugging Face Transformer와 Pooling을 조합하여 로드됩니다.
     """
-    def __init__(self, device='cpu', model_key='paraphrase-multilingual-mpnet-base-v2'):
+    def __init__(self, device='cpu', model_key='paraphrase-multilingual-mpnet-base-v2', backend=None,
+                 workers=0, intra_op_threads=None):
+        """
+        :param backend: 추론 백엔드 ("torch" / "torch-int8" / "onnx" / "onnx-int8").
+                        None이면 MODEL_CONFIGS[model_key]["backend"]를 사용합니다.
+        :param workers: 0보다 크면 embed()를 이 수만큼의 워커 프로세스(embedding_pool.EmbeddingPool)에 맡깁니다.
+        :param intra_op_threads: 워커 프로세스별 torch 연산 스레드 수 (None이면 torch 기본값)
+        """
         self.device = device
         config = MODEL_CONFIGS.get(model_key)
         if config is None:
             raise ValueError(f"Model key '{model_key}' is not defined in MODEL_CONFIGS.")
-        if config.get("load_direct", False):
-            # 이미 SentenceTransformer 형식인 모델이면 바로 로드
-            self.embedder = SentenceTransformer(config["model_name"], device=device)
+        self.backend = backend or config.get("backend", "torch")
+        self.pool = None
+        if workers > 0:
+            # 모델은 워커 프로세스에만 로드한다 (토크나이즈/truncation/길이 버킷도 워커의 Retriever가 처리)
+            from embedding_pool import EmbeddingPool
+            self.pool = EmbeddingPool(model_key, device, self.backend, workers, intra_op_threads)
+            self.embedder = None
+            self.max_seq_length = self.pool.max_seq_length
         else:
-            # Transformer + Pooling 조합으로 SentenceTransformer 구성
-            transformer = models.Transformer(
-                model_name_or_path=config["model_name"],
-                max_seq_length=config.get("max_seq_length", 256),
-                device=device
-            )
-            pooling_mode = config.get("pooling", "mean")
-            if pooling_mode == "mean":
-                pooling = models.Pooling(
-                    transformer.get_word_embedding_dimension(),
-                    pooling_mode_mean_tokens=True,
-                    pooling_mode_cls_token=False
-                )
-            elif pooling_mode == "cls":
-                pooling = models.Pooling(
-                    transformer.get_word_embedding_dimension(),
-                    pooling_mode_cls_token=True
-                )
-            else:
-                pooling = models.Pooling(
-                    transformer.get_word_embedding_dimension(),
-                    pooling_mode_mean_tokens=True,
-                    pooling_mode_cls_token=False
-                )
-            self.embedder = SentenceTransformer(modules=[transformer, pooling])
+            self.embedder = load_embedder(model_key, config, device, self.backend)
+            self.max_seq_length = self.embedder.max_seq_length
+
+        self.model_key = model_key
+        self.truncation = config.get("truncation", "head")
+        if self.truncation not in TRUNCATION_POLICIES:
+            raise ValueError(f"Unknown truncation policy '{self.truncation}'. Use one of {TRUNCATION_POLICIES}.")
+        self.max_tokens = min(config.get("max_tokens", self.max_seq_length), self.max_seq_length)
 
     def embed(self, texts):
         """
         주어진 문자열 리스트를 임베딩 텐서로 변환합니다.
-        :param texts: list[str]
+        입력을 토큰 길이 순으로 정렬해 LENGTH_BUCKETS별 배치 크기로 인코딩한 뒤 원래 순서로 되돌립니다.
+        :param texts: list[str] (str 하나를 주면 1차원 텐서를 반환)
         :return: torch.Tensor, shape: (num_texts, embed_dim)
         """
-        embeddings = self.embedder.encode(texts, convert_to_tensor=True, device=self.device)
-        return embeddings
+        if self.pool is not None:
+            return self.pool.embed(texts)
+        if isinstance(texts, str):
+            return self.embed([texts])[0]
+        if not texts:
+            return self.embedder.encode(texts, convert_to_tensor=True, device=self.device)
+
+        prepared = self.prepare_texts(texts)
+        order = sorted(range(len(texts)), key=lambda i: prepared[i][0])
+        results = [None] * len(texts)
+        for bucket, batch_size in self.length_buckets(order, prepared):
+            embeddings = self.embedder.encode([prepared[i][1] for i in bucket], batch_size=batch_size,
+                                              convert_to_tensor=True, device=self.device)
+            for i, embedding in zip(bucket, embeddings):
+                results[i] = embedding
+        return torch.stack(results)
+
+    def prepare_texts(self, texts):
+        """
+        각 문자열의 (토큰 수, truncation이 적용된 인코딩용 문자열)을 반환합니다. 결과는 모델별로 캐시됩니다.
+        """
+        entries, missing = {}, []
+        with cache_lock:
+            cache = token_length_cache.setdefault(self.model_key, OrderedDict())
+            for text in texts:
+                if text in entries:
+                    continue
+                entry = cache.get(text)
+                if entry is None:
+                    missing.append(text)
+                    entries[text] = None
+                else:
+                    cache.move_to_end(text)
+                    entries[text] = entry
+        if missing:
+            tokenizer = self.embedder.tokenizer
+            special_tokens = tokenizer.num_special_tokens_to_add()
+            for text, ids in zip(missing, tokenizer(missing, add_special_tokens=False)["input_ids"]):
+                entries[text] = self.truncate(text, ids, special_tokens)
+            with cache_lock:
+                for text in missing:
+                    cache[text] = entries[text]
+                while len(cache) > TOKEN_LENGTH_CACHE_SIZE:
+                    cache.popitem(last=False)
+        return [entries[text] for text in texts]
+
+    def truncate(self, text, ids, special_tokens):
+        length = len(ids) + special_tokens
+        if length <= self.max_tokens:
+            return length, text
+        budget = self.max_tokens - special_tokens
+        if self.truncation == "head":
+            if self.max_tokens == self.max_seq_length:
+                # SentenceTransformer가 같은 방식으로 잘라내므로 문자열은 그대로 둔다
+                return self.max_tokens, text
+            kept = ids[:budget]
+        else:
+            head = budget // 2
+            kept = ids[:head] + ids[len(ids) - (budget - head):]
+        return self.max_tokens, self.embedder.tokenizer.decode(kept, skip_special_tokens=True)
+
+    def length_buckets(self, order, prepared):
+        """
+        토큰 길이 순으로 정렬된 인덱스(order)를 LENGTH_BUCKETS에 따라 (인덱스 목록, 배치 크기)로 나눕니다.
+        """
+        buckets = []
+        position = 0
+        for max_length, batch_size in LENGTH_BUCKETS:
+            bucket = []
+            while position < len(order) and (max_length is None or prepared[order[position]][0] <= max_length):
+                bucket.append(order[position])
+                position += 1
+            if bucket:
+                buckets.append((bucket, batch_size))
+        return buckets
 
     @torch.no_grad()
     def search_in_embeds(self, key_embeds, query_embeds, topk: int = None, similarity_threshold: float = None,
@@ -110,9 +217,8 @@ class Retriever:
         num_q = scores.shape[0]
 
         if topk is not None:
-            sorted_idx = scores.argsort(dim=-1, descending=True)
-            selected_idx = sorted_idx[:, :topk]
-            selected_idx = selected_idx.tolist()
+            # 전체 정렬 대신 상위 topk개만 선택
+            selected_idx = scores.topk(min(topk, scores.shape[-1]), dim=-1).indices.tolist()
         else:
             selected_idx = [[] for _ in range(num_q)]
             nonzero_indices = (scores >= similarity_threshold).nonzero(as_tuple=False)
@@ -175,51 +281,152 @@ def get_cached_embeddings(texts, retriever):
     results = [None] * len(texts)
     texts_to_compute = []
     indices_to_compute = []
-    for i, text in enumerate(texts):
-        if text in embedding_cache:
-            embedding_cache.move_to_end(text)
-            results[i] = embedding_cache[text]
-        else:
-            texts_to_compute.append(text)
-            indices_to_compute.append(i)
+    with cache_lock:
+        for i, text in enumerate(texts):
+            if text in embedding_cache:
+                embedding_cache.move_to_end(text)
+                results[i] = embedding_cache[text]
+            else:
+                texts_to_compute.append(text)
+                indices_to_compute.append(i)
     if texts_to_compute:
         computed = retriever.embed(texts_to_compute)
-        for idx, text, emb in zip(indices_to_compute, texts_to_compute, computed):
-            results[idx] = emb
-            embedding_cache[text] = emb
-            if len(embedding_cache) > CACHE_SIZE:
-                embedding_cache.popitem(last=False)
+        with cache_lock:
+            for idx, text, emb in zip(indices_to_compute, texts_to_compute, computed):
+                results[idx] = emb
+                embedding_cache[text] = emb
+                if len(embedding_cache) > CACHE_SIZE:
+                    embedding_cache.popitem(last=False)
     return torch.stack(results)
 
 
+def get_key_matrix(texts, retriever):
+    """
+    texts 전체의 정규화된 임베딩 행렬을 반환합니다. 같은 모델/같은 목록이면 캐시된 행렬을 재사용합니다.
+    """
+    cache_key = (retriever.model_key, tuple(texts))
+    with cache_lock:
+        matrix = key_matrix_cache.get(cache_key)
+        if matrix is not None:
+            key_matrix_cache.move_to_end(cache_key)
+            return matrix
+    matrix = F.normalize(retriever.embed(list(texts)), p=2, dim=-1)
+    with cache_lock:
+        key_matrix_cache[cache_key] = matrix
+        if len(key_matrix_cache) > KEY_MATRIX_CACHE_SIZE:
+            key_matrix_cache.popitem(last=False)
+    return matrix
+
+
+class RetrievalContext:
+    """
+    한 턴 동안 쓰이는 쿼리 임베딩을 한 번만 계산해 공유하는 객체.
+    memory_retrieve, find_top_episodic_emb, filter_items_by_similarity에 같은 객체를 넘기면
+    같은 모델의 같은 쿼리 문자열은 다시 임베딩하지 않습니다 (background 업데이트의 재검색 포함).
+    """
+    def __init__(self):
+        self.embeddings = {}   # (model_key, text) -> 1차원 임베딩
+        self.normalized = {}   # (model_key, text) -> 정규화된 (1, dim) 임베딩
+
+    def embed(self, text, retriever):
+        key = (retriever.model_key, text)
+        embedding = self.embeddings.get(key)
+        if embedding is None:
+            embedding = self.embeddings[key] = retriever.embed(text)
+        return embedding
+
+    def store(self, text, retriever, embedding):
+        # 배치로 미리 계산한 임베딩 등록
+        self.embeddings[(retriever.model_key, text)] = embedding
+
+    def embed_normalized(self, text, retriever):
+        key = (retriever.model_key, text)
+        embedding = self.normalized.get(key)
+        if embedding is None:
+            embedding = self.normalized[key] = F.normalize(self.embed(text, retriever).reshape(1, -1), p=2, dim=-1)
+        return embedding
+
+
+def check_retrieval_mode(mode, lexical_index):
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode '{mode}'. Use one of {RETRIEVAL_MODES}.")
+    if mode != "dense" and lexical_index is None:
+        raise ValueError(f"Retrieval mode '{mode}' requires a lexical_index.")
+
+def lexical_candidates(query, lexical_index, position, candidate_k):
+    # BM25 상위 문서 중 현재 후보 목록(position)에 있는 것의 인덱스 (순위 순)
+    return lexical_ranking(query, lexical_index, position, candidate_k)[0]
+
+def lexical_ranking(query, lexical_index, position, candidate_k):
+    """
+    (BM25 상위 후보 인덱스 목록, dense 임계값 없이 채택할 BM25 1위 인덱스 또는 None)을 반환합니다.
+    1위는 LexicalIndex.is_strong_match(점수 하한 또는 단어 그대로 일치)를 통과할 때만 돌려줍니다.
+    """
+    hits = [(position[doc_id], doc_id, score) for doc_id, score in lexical_index.search(query, candidate_k)
+            if doc_id in position]
+    strong_top = None
+    if hits and lexical_index.is_strong_match(hits[0][1], query, hits[0][2]):
+        strong_top = hits[0][0]
+    return [idx for idx, _, _ in hits], strong_top
+
+def dense_rankings(query_embeds_norm, k, triplets, position, key_embeds_norm=None, vector_index=None):
+    """
+    쿼리마다 (dense 상위 k개 [(score, idx)], idx -> dense 점수 함수)를 반환합니다.
+    vector_index(vector_index.VectorIndex, triplets 문자열로 색인)가 있으면 전체 점수 행렬 대신 색인을 검색합니다.
+    """
+    rankings = []
+    if vector_index is not None:
+        queries = query_embeds_norm.cpu().numpy()
+        for query, hits in zip(queries, vector_index.search(queries, k)):
+            ranked = [(score, position[doc_id]) for doc_id, score in hits if doc_id in position]
+            score_of = lambda idx, query=query: float(vector_index.get_vector(triplets[idx]) @ query)
+            rankings.append((ranked, score_of))
+        return rankings
+    dense_scores = query_embeds_norm @ key_embeds_norm.transpose(-1, -2)
+    for row_scores in dense_scores:
+        values, indices = row_scores.topk(min(k, row_scores.shape[0]))
+        score_of = lambda idx, row_scores=row_scores: row_scores[idx].item()
+        rankings.append((list(zip(values.tolist(), indices.tolist())), score_of))
+    return rankings
+
 @torch.no_grad()
 def graph_retr_search(start_triplet, triplets, retriever, max_depth: int = 2,
                       topk: int = 3, post_retrieve_threshold: float = 0.7,
-                      verbose: int = 2):
+                      verbose: int = 2, mode: str = "dense", lexical_index=None,
+                      candidate_k: int = 50, vector_index=None, position=None):
     """
     시작 쿼리(triplet)를 기반으로 주어진 triplets에서 BFS 방식으로 관련 결과를 탐색합니다.
+    mode가 "lexical"/"hybrid"이면 lexical_index(triplets 문자열로 색인된 LexicalIndex)를 함께 사용합니다.
+    vector_index가 있으면 dense 후보를 색인에서 검색합니다 (triplets 임베딩 전체를 다시 모으지 않음).
+    position은 호출 측이 미리 만든 {문자열: triplets 인덱스} 매핑입니다 (없으면 triplets로 만듦).
     """
-    key_embeds = get_cached_embeddings(triplets, retriever)
+    check_retrieval_mode(mode, lexical_index)
+    if position is None:
+        position = {triplet: i for i, triplet in enumerate(triplets)}
+    # lexical 모드에서는 전체 triplets를 임베딩하지 않고 후보만 임베딩한다
+    key_embeds_norm = None
+    if mode != "lexical" and vector_index is None and triplets:
+        key_embeds_norm = F.normalize(get_cached_embeddings(triplets, retriever), p=2, dim=-1)
     current_level = [start_triplet]  # 탐색 시작 쿼리 리스트
     depth = {start_triplet: 0}         # 각 트리플릿의 탐색 깊이 기록
     result = set()                   # 최종 검색된 트리플릿 집합
     visited = set([start_triplet])   # 중복 검색 방지를 위한 집합
 
-    while current_level:
+    while current_level and triplets:
         query_embeds = get_cached_embeddings(current_level, retriever)
         if query_embeds.ndim == 1:
             query_embeds = query_embeds.unsqueeze(0)
         query_embeds_norm = F.normalize(query_embeds, p=2, dim=-1)
-        key_embeds_norm = F.normalize(key_embeds, p=2, dim=-1)
-        scores = query_embeds_norm @ key_embeds_norm.transpose(-1, -2)
-        effective_topk = min(topk, scores.shape[1])
-        topk_values, topk_indices = scores.topk(effective_topk, dim=1)
+        rankings = [([], None)] * len(current_level)
+        if mode != "lexical":
+            rankings = dense_rankings(query_embeds_norm, topk if mode == "dense" else candidate_k,
+                                      triplets, position, key_embeds_norm, vector_index)
         next_level = []
         for i, query in enumerate(current_level):
             current_depth = depth[query]
-            for score, idx in zip(topk_values[i].tolist(), topk_indices[i].tolist()):
-                if score < post_retrieve_threshold:
-                    continue
+            dense_ranked, score_of = rankings[i]
+            for score, idx in rank_graph_candidates(query, query_embeds_norm[i], dense_ranked, score_of, triplets, retriever,
+                                                    topk, post_retrieve_threshold, mode, lexical_index, position, candidate_k):
                 candidate_triplet = triplets[idx]
                 if candidate_triplet in visited:
                     continue
@@ -231,12 +438,47 @@ def graph_retr_search(start_triplet, triplets, retriever, max_depth: int = 2,
         current_level = next_level
     return list(result)
 
-def find_top_episodic_emb(A, B, obs_plan_embedding, retriever):
+def rank_graph_candidates(query, query_embed_norm, dense_ranked, score_of, triplets, retriever, topk, threshold,
+                          mode, lexical_index, position, candidate_k):
+    """
+    한 쿼리에 대해 (dense 점수, triplets 인덱스) 후보를 순위대로 반환합니다. 임계값을 넘지 못한 후보는 제외합니다.
+    dense_ranked/score_of는 dense_rankings()의 결과입니다 (lexical 모드에서는 사용하지 않음).
+    """
+    if mode == "dense":
+        return [(score, idx) for score, idx in dense_ranked[:topk] if score >= threshold]
+
+    lexical_ids, strong_top = lexical_ranking(query, lexical_index, position, candidate_k)
+    if mode == "lexical":
+        if not lexical_ids:
+            return []
+        candidate_embeds = F.normalize(get_cached_embeddings([triplets[idx] for idx in lexical_ids], retriever), p=2, dim=-1)
+        scores = (candidate_embeds @ query_embed_norm).tolist()
+        ranked = sorted(zip(scores, lexical_ids), reverse=True)[:topk]
+        return [(score, idx) for score, idx in ranked if score >= threshold]
+
+    # hybrid: dense 상위 candidate_k와 BM25 상위 candidate_k를 RRF로 합치고,
+    # dense 점수가 임계값 이상이거나 강하게 일치하는 BM25 1위(정확한 이름 일치)인 후보를 채택
+    dense_ids = [idx for _, idx in dense_ranked]
+    known_scores = {idx: score for score, idx in dense_ranked}
+    ranked = []
+    for idx, _ in reciprocal_rank_fusion([dense_ids, lexical_ids]):
+        score = known_scores[idx] if idx in known_scores else score_of(idx)
+        if score >= threshold or idx == strong_top:
+            ranked.append((score, idx))
+        if len(ranked) >= topk:
+            break
+    return ranked
+
+def find_top_episodic_emb(A, B, obs_plan_embedding, retriever, key_embeddings=None):
+    """
+    :param key_embeddings: B의 value[1]을 순서대로 쌓은 (N, embed_dim) 텐서 (호출 측에서 캐시한 경우)
+    """
     results = {}
     if not B:
         return results
     # B 딕셔너리의 각 value[1]을 스택하여 (N, embed_dim) 텐서 생성
-    key_embeddings = torch.stack([value[1] for value in B.values()])
+    if key_embeddings is None:
+        key_embeddings = torch.stack([value[1] for value in B.values()])
 
     # obs_plan_embedding이 1차원일 경우 2차원으로 변경
     if obs_plan_embedding.ndim == 1:
@@ -265,15 +507,18 @@ def find_top_episodic_emb(A, B, obs_plan_embedding, retriever):
     similarity_scores = [score / max_similarity_score if max_similarity_score else 0 for score in similarity_scores]
 
     # A의 요소와 B의 각 value_list 간의 매칭 횟수를 계산
-    match_counts = [sum(1 for element in A if element in value_list) for _, (value_list, _) in B.items()]
+    # (A의 각 요소가 value_list에 있으면 1: value_list의 서로 다른 값마다 A에서의 등장 횟수를 더한 것과 같다)
+    # 이 점수 계산은 웹 프로세스에서 GIL을 잡고 실행되므로, 에피소드마다 A 전체를 훑지 않게 한다
+    a_counts = Counter(A)
+    match_counts = np.array([sum(a_counts[element] for element in set(value_list)) for value_list, _ in B.values()],
+                            dtype=np.float64)
 
-    match_counts_relative = []
-    for i, values in enumerate(B.values()):
-        # values[0]는 에피소드의 요소 리스트라고 가정합니다.
-        match_counts_relative.append((match_counts[i] / (len(values[0]) + 1e-9)) * np.log((len(values[0]) + 1e-9)))
+    # values[0]는 에피소드의 요소 리스트라고 가정합니다.
+    lengths = np.array([len(values[0]) for values in B.values()], dtype=np.float64) + 1e-9
+    match_counts_relative = match_counts / lengths * np.log(lengths)
 
-    max_match_count = max(match_counts_relative, default=0)
-    normalized_match_scores = [count / max_match_count if max_match_count else 0 for count in match_counts_relative]
+    max_match_count = match_counts_relative.max()
+    normalized_match_scores = (match_counts_relative / max_match_count).tolist() if max_match_count else [0] * len(B)
 
     # 결과 딕셔너리에 각 에피소드의 정규화된 match score와 similarity score 할당
     for idx, (key, _) in enumerate(B.items()):
@@ -281,22 +526,48 @@ def find_top_episodic_emb(A, B, obs_plan_embedding, retriever):
     return results
 
 
-def filter_items_by_similarity(data, query, threshold, retriever, max_n):
+def filter_items_by_similarity(data, query, threshold, retriever, max_n, mode="dense", lexical_index=None, candidate_k=10,
+                               retrieval_context=None, key_matrix=None):
     """
     각 (주제, 내용) 항목을 "주제: 내용" 문자열로 결합하여 임베딩한 뒤,
     query와의 코사인 유사도가 threshold 이상인 항목을 (주제, 내용, score) 형태로 반환합니다.
     최대 max_n개 항목만 반환합니다.
+    mode가 "lexical"/"hybrid"이면 lexical_index("주제: 내용" 문자열로 색인된 LexicalIndex)를 함께 사용합니다.
+    retrieval_context(RetrievalContext)가 있으면 query 임베딩을 그 턴의 다른 검색과 공유합니다.
+    key_matrix가 있으면 data 순서대로 미리 계산된 정규화 임베딩 행렬(knowledge_base.NamespaceIndex)을 사용합니다.
     """
+    check_retrieval_mode(mode, lexical_index)
     texts = [f"{subject}: {content}" for subject, content in data]
-    key_embeds = get_cached_embeddings(texts, retriever)
-    query_embed = get_cached_embeddings([query], retriever)
-    key_embeds_norm = F.normalize(key_embeds, p=2, dim=-1)
-    query_embed_norm = F.normalize(query_embed, p=2, dim=-1)
+    position = {text: i for i, text in enumerate(texts)}
+    lexical_ids, strong_top = lexical_ranking(query, lexical_index, position, candidate_k) if mode != "dense" else ([], None)
+    candidate_ids = lexical_ids if mode == "lexical" else list(range(len(texts)))
+    if not candidate_ids:
+        return []
+    if key_matrix is not None:
+        key_embeds_norm = key_matrix[candidate_ids] if mode == "lexical" else key_matrix
+    elif mode == "lexical":
+        key_embeds_norm = F.normalize(get_cached_embeddings([texts[i] for i in candidate_ids], retriever), p=2, dim=-1)
+    else:
+        key_embeds_norm = get_key_matrix(texts, retriever)
+    if retrieval_context is not None:
+        query_embed_norm = retrieval_context.embed_normalized(query, retriever)
+    else:
+        query_embed_norm = F.normalize(get_cached_embeddings([query], retriever), p=2, dim=-1)
     similarities = (key_embeds_norm @ query_embed_norm.transpose(-1, -2)).squeeze(1).cpu().numpy()
+    scores = {idx: score for idx, score in zip(candidate_ids, similarities)}
+
+    if mode == "hybrid":
+        # dense 순위와 BM25 순위를 합친 순서대로, 임계값 이상이거나 강하게 일치하는 BM25 1위인 항목 채택
+        dense_ids = sorted(scores, key=scores.get, reverse=True)
+        filtered_items = [(data[idx][0], data[idx][1], scores[idx])
+                          for idx, _ in reciprocal_rank_fusion([dense_ids, lexical_ids])
+                          if scores[idx] >= threshold or idx == strong_top]
+        return filtered_items[:max_n]
+
     filtered_items = []
-    for i, score in enumerate(similarities):
+    for idx, score in scores.items():
         if score >= threshold:
-            filtered_items.append((data[i][0], data[i][1], score))
+            filtered_items.append((data[idx][0], data[idx][1], score))
     filtered_items = sorted(filtered_items, key=lambda x: x[2], reverse=True)
     return filtered_items[:max_n]
 
@@ -351,3 +622,21 @@ if __name__ == "__main__":
     print("임계치 이상의 항목:")
     for item in filtered:
         print(item)
+
+    # --- 4. hybrid 모드 (BM25 + dense) 예제 ---
+    print("\n=== filter_items_by_similarity (hybrid) 예제 ===")
+    from lexical import LexicalIndex
+    lexical_index = LexicalIndex()
+    lexical_index.sync([f"{subject}: {content}" for subject, content in data])
+    for item in filter_items_by_similarity(data, query, threshold, retriever, max_n=3, mode="hybrid", lexical_index=lexical_index):
+        print(item)
+
+    # --- 5. vector_index (exact / HNSW) 예제: 전체 행렬 검색과 결과 비교 ---
+    print("\n=== graph_retr_search (vector_index) 예제 ===")
+    from vector_index import make_index
+    exact_index = make_index("exact", retriever.embed(triplets[:1]).shape[-1])
+    exact_index.add(triplets, retriever.embed(triplets).cpu().numpy())
+    indexed_results = graph_retr_search(start_triplet, triplets, retriever, max_depth=3, topk=3,
+                                        post_retrieve_threshold=0.55, vector_index=exact_index)
+    print("matrix == exact index:", sorted(indexed_results) == sorted(graph_results))
+    # HNSW recall/지연 측정은 vector_index.py를 직접 실행: python vector_index.py
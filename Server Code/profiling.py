@@ -0,0 +1,304 @@
+# 턴 단위 on-demand 프로파일링
+# 요청 플래그({"profile": "sample" | "cprofile"}, GOALLM_PROFILE_REQUESTS=1일 때만) 또는 /api/profile 로 예약된 턴만
+# 프로파일링하고, 결과를 profile id 아래 PROFILE_DIR/<profile_id>/ 에 저장한다 (최근 PROFILE_HISTORY개만 디스크에 유지).
+#   collapsed.txt  - "frame;frame;frame count" 형식의 스택 (flamegraph.pl, speedscope 입력)
+#   cprofile.prof  - cProfile 통계 (mode="cprofile"일 때, python -m pstats / snakeviz로 확인)
+#   torch_ops.txt  - torch.profiler 연산별 시간 (torch가 이미 로드된 경우)
+#   meta.json      - 세션, 모드, 구간별 시간
+# 프로파일링 중인 턴이 없으면 section()은 ContextVar 조회 한 번만 하고 바로 실행한다.
+#
+# cProfile은 Python 3.12부터 sys.monitoring을 쓰므로 프로세스 전체에서 하나만 켤 수 있다 (모든 스레드를 기록).
+# 그래서 cprofile 턴은 한 번에 하나만 실행하고 (겹치는 턴은 sampling으로 대신), 3.12 이상에서는 턴마다 profiler 하나를
+# 켜서 구간은 시간만 기록한다. 3.11 이하에서는 cProfile이 스레드별이므로 구간을 실행하는 스레드마다 켠다.
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import cProfile
+import pstats
+import threading
+import contextvars
+from collections import Counter, OrderedDict
+
+PROFILE_DIR = os.environ.get("GOALLM_PROFILE_DIR", "profiles")
+PROFILE_MODES = ("sample", "cprofile")
+# 요청 본문의 "profile" 플래그 허용 여부 (기본 꺼짐: 아무 클라이언트나 프로파일링 비용을 일으키지 않도록)
+REQUEST_FLAG_ENABLED = os.environ.get("GOALLM_PROFILE_REQUESTS", "0") == "1"
+SAMPLE_INTERVAL = 0.005   # sampling 모드의 스택 샘플 간격 (초)
+MAX_STACK_DEPTH = 128
+PROFILE_HISTORY = 50      # 메모리와 디스크에 유지할 최근 프로파일 수 (오래된 것부터 삭제)
+TORCH_OPS_ROW_LIMIT = 40
+
+current_profile = contextvars.ContextVar("current_profile", default=None)
+
+# torch.profiler는 동시에 하나만 실행할 수 있다 (겹치는 턴은 torch 연산 시간 없이 프로파일링)
+torch_profiler_lock = threading.Lock()
+# cProfile도 동시에 한 턴만 (겹치는 턴은 sampling 모드로 프로파일링)
+cprofile_lock = threading.Lock()
+PER_THREAD_CPROFILE = sys.version_info < (3, 12)
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame, root):
+    stack = []
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        stack.append(frame_label(frame))
+        frame = frame.f_back
+    stack.append(root)
+    return ";".join(reversed(stack))
+
+
+class TurnProfile:
+    """
+    한 턴의 프로파일. 턴을 처리하는 스레드들(요청 스레드, foreground 작업 스레드)을 section()으로 등록하면
+    sampling 모드는 별도 스레드가 그 스레드들의 스택을 주기적으로 수집하고,
+    cprofile 모드는 턴 전체에 cProfile 하나를 켭니다 (3.11 이하에서는 스레드마다 켜서 끝난 뒤 합칩니다).
+    다른 턴이 cProfile을 쓰고 있거나 다른 프로파일러가 켜져 있으면 sampling 모드로 대신합니다 (meta의 requested_mode).
+    """
+    def __init__(self, mode="sample", session=None, profile_id=None):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{mode}'. Available: {', '.join(PROFILE_MODES)}")
+        self.profile_id = profile_id or uuid.uuid4().hex[:12]
+        self.mode = self.requested_mode = mode
+        self.session = session
+        self.lock = threading.Lock()
+        self.threads = {}             # thread id -> section 이름
+        self.stacks = Counter()
+        self.profiles = []
+        self.sections = []            # (이름, 초)
+        self.torch_ops = None
+        self.started = None
+        self.seconds = None
+        self.token = None
+        self.stop_event = threading.Event()
+        self.sampler = None
+        self.request_section = None
+        self.profiler = None          # 3.12 이상: 턴 전체의 cProfile
+        self.holds_cprofile = False
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.token = current_profile.set(self)
+        if self.mode == "cprofile":
+            self._start_cprofile()
+        if self.mode == "sample":
+            self.sampler = threading.Thread(target=self._sample, name=f"profile-{self.profile_id}", daemon=True)
+            self.sampler.start()
+        self.request_section = self._enter_section("request")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._exit_section("request", self.request_section)
+        current_profile.reset(self.token)
+        self.seconds = time.perf_counter() - self.started
+        if self.sampler is not None:
+            self.stop_event.set()
+            self.sampler.join()
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiles.append(self.profiler)
+        if self.holds_cprofile:
+            cprofile_lock.release()
+
+    def _start_cprofile(self):
+        if not cprofile_lock.acquire(blocking=False):
+            self.mode = "sample"
+            return
+        self.holds_cprofile = True
+        if PER_THREAD_CPROFILE:
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 다른 프로파일링 도구가 이미 켜져 있음
+            cprofile_lock.release()
+            self.holds_cprofile = False
+            self.mode = "sample"
+            return
+        self.profiler = profiler
+
+    def _sample(self):
+        while not self.stop_event.wait(SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            with self.lock:
+                threads = list(self.threads.items())
+            for thread_id, name in threads:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self.stacks[collapse_stack(frame, name)] += 1
+
+    def _enter_section(self, name):
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.threads[thread_id] = name
+        profiler = None
+        if self.mode == "cprofile" and PER_THREAD_CPROFILE:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return thread_id, profiler, time.perf_counter()
+
+    def _exit_section(self, name, state):
+        thread_id, profiler, start = state
+        if profiler is not None:
+            profiler.disable()
+        with self.lock:
+            self.threads.pop(thread_id, None)
+            self.sections.append((name, round(time.perf_counter() - start, 4)))
+            if profiler is not None:
+                self.profiles.append(profiler)
+
+    def run(self, name, func, *args):
+        state = self._enter_section(name)
+        try:
+            return self._run_with_torch_profiler(func, *args)
+        finally:
+            self._exit_section(name, state)
+
+    def _run_with_torch_profiler(self, func, *args):
+        # torch를 새로 import하지는 않는다 (아직 로드 전이면 torch 연산도 없음)
+        torch = sys.modules.get("torch")
+        if torch is None or not torch_profiler_lock.acquire(blocking=False):
+            return func(*args)
+        try:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            with torch.profiler.profile(activities=activities, record_shapes=True) as prof:
+                result = func(*args)
+            sort_by = "self_cuda_time_total" if len(activities) > 1 else "self_cpu_time_total"
+            self.torch_ops = prof.key_averages().table(sort_by=sort_by, row_limit=TORCH_OPS_ROW_LIMIT)
+            return result
+        finally:
+            torch_profiler_lock.release()
+
+    def collapsed(self):
+        if self.mode == "cprofile":
+            return cprofile_collapsed(self.merged_stats())
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def merged_stats(self):
+        if not self.profiles:
+            return None
+        stats = pstats.Stats(self.profiles[0])
+        for profiler in self.profiles[1:]:
+            stats.add(profiler)
+        return stats
+
+    def meta(self):
+        return {
+            "profile_id": self.profile_id,
+            "session": self.session,
+            "mode": self.mode,
+            "requested_mode": self.requested_mode,
+            "seconds": round(self.seconds, 4) if self.seconds is not None else None,
+            "sections": [{"name": name, "seconds": seconds} for name, seconds in self.sections],
+            "samples": sum(self.stacks.values()),
+            "torch_ops": self.torch_ops is not None,
+        }
+
+
+def cprofile_collapsed(stats):
+    """
+    cProfile은 호출 스택 전체가 아니라 caller -> callee 관계만 기록하므로,
+    "caller;callee 누적시간(us)" 두 단계 스택으로 근사합니다.
+    """
+    if stats is None:
+        return ""
+    lines = []
+    for func, (_, _, _, cumulative, callers) in stats.stats.items():
+        callee = f"{func[2]} ({os.path.basename(func[0])}:{func[1]})"
+        if not callers:
+            lines.append(f"{callee} {int(cumulative * 1e6)}")
+        for caller, caller_stats in callers.items():
+            caller_label = f"{caller[2]} ({os.path.basename(caller[0])}:{caller[1]})"
+            lines.append(f"{caller_label};{callee} {int(caller_stats[3] * 1e6)}")
+    return "\n".join(lines)
+
+
+def section(name, func, *args):
+    """
+    현재 컨텍스트에서 프로파일링 중인 턴이 있으면 func(*args)를 그 턴의 구간으로 프로파일링하고, 없으면 그냥 실행합니다.
+    """
+    profile = current_profile.get()
+    if profile is None:
+        return func(*args)
+    return profile.run(name, func, *args)
+
+
+class ProfileStore:
+    """
+    완료된 프로파일을 디스크에 저장하고 최근 PROFILE_HISTORY개의 메타데이터를 메모리에 유지합니다.
+    """
+    def __init__(self, directory=PROFILE_DIR, history=PROFILE_HISTORY):
+        self.directory = directory
+        self.history = history
+        self.lock = threading.Lock()
+        self.recent = OrderedDict()   # profile_id -> meta
+
+    def path(self, profile_id, name):
+        return os.path.join(self.directory, profile_id, name)
+
+    def save(self, profile):
+        os.makedirs(os.path.join(self.directory, profile.profile_id), exist_ok=True)
+        meta = profile.meta()
+        with open(self.path(profile.profile_id, "collapsed.txt"), "w", encoding="utf-8") as f:
+            f.write(profile.collapsed())
+        stats = profile.merged_stats()
+        if stats is not None:
+            stats.dump_stats(self.path(profile.profile_id, "cprofile.prof"))
+        if profile.torch_ops is not None:
+            with open(self.path(profile.profile_id, "torch_ops.txt"), "w", encoding="utf-8") as f:
+                f.write(profile.torch_ops)
+        with open(self.path(profile.profile_id, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        with self.lock:
+            self.recent[profile.profile_id] = meta
+            while len(self.recent) > self.history:
+                self.recent.popitem(last=False)
+            self.prune()
+        return meta
+
+    def prune(self):
+        """
+        디스크에 최근 history개의 프로파일만 남기고 오래된 디렉터리를 삭제합니다 (재시작 전에 저장된 것 포함).
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                entries.append((os.path.getmtime(path), name))
+        entries.sort()
+        for _, name in entries[:max(0, len(entries) - self.history)]:
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            self.recent.pop(name, None)
+
+    def load(self, profile_id):
+        """
+        저장된 프로파일의 메타데이터와 collapsed 스택, torch 연산 표를 반환합니다. 없으면 None.
+        """
+        # profile id는 파일 경로로 쓰이므로 저장할 때 만든 형식(16진수)만 허용한다
+        if not profile_id or not all(c in "0123456789abcdef" for c in profile_id):
+            return None
+        meta_path = self.path(profile_id, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            result = {"meta": json.load(f)}
+        for key, name in (("collapsed", "collapsed.txt"), ("torch_ops", "torch_ops.txt")):
+            path = self.path(profile_id, name)
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    result[key] = f.read()
+        return result
+
+    def list(self, session=None):
+        with self.lock:
+            return [meta for meta in self.recent.values() if session is None or meta["session"] == session]
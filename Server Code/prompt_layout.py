@@ -0,0 +1,32 @@
+# 프롬프트 조립 레이어
+# OpenAI의 자동 prompt-prefix 캐싱은 요청 앞부분이 이전 요청과 바이트 단위로 같을 때만 적용된다.
+# 따라서 프롬프트 섹션을 "변하지 않는 것 -> 세션 단위로 바뀌는 것 -> 매 턴 바뀌는 것" 순서로 배치한다.
+
+STATIC = 0    # 모든 세션/턴에서 동일 (출력 형식, 행동 목록 등)
+SESSION = 1   # 세션 안에서 가끔 바뀜 (plan, 관련 지식, 상태창)
+TURN = 2      # 매 턴 바뀜 (history, observation, 검색 결과)
+
+
+class PromptBuilder:
+    """
+    (안정도, 제목, 내용) 섹션을 모아 안정도 순으로 정렬된 프롬프트 문자열을 만듭니다.
+    같은 안정도 안에서는 추가한 순서를 유지하므로, 고정 섹션은 턴/세션이 바뀌어도 바이트 단위로 동일합니다.
+    """
+    def __init__(self):
+        self.sections = []
+
+    def add(self, stability, title, content):
+        self.sections.append((stability, len(self.sections), title, content))
+        return self
+
+    def build(self):
+        ordered = sorted(self.sections, key=lambda section: (section[0], section[1]))
+        lines = []
+        number = 0
+        for _, _, title, content in ordered:
+            if title:
+                number += 1
+                lines.append(f"{number}. {title}: {content}")
+            else:
+                lines.append(str(content))
+        return "\n" + "\n".join(lines) + "\n"
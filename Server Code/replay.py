@@ -0,0 +1,127 @@
+# 녹화된 트래픽 재생 (부하 테스트)
+# traffic.py로 녹화한 캡처 파일의 세션들을 원래 도착 간격대로(speed 배속) 서버에 다시 보내고
+# 처리량과 지연 백분위를 출력한다. 세션 안의 턴은 원래 순서대로, 이전 응답을 받은 뒤에 보낸다.
+#
+# 서버는 재생 스텁 모드로 띄운다 (LLM/TTS를 녹화된 응답과 지연으로 대체, 임베딩/검색은 실제로 실행):
+#   GOALLM_REPLAY_STUB=capture.jsonl python server.py
+#   python replay.py capture.jsonl --url http://127.0.0.1:5003 --api-key 1 --speed 4
+
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import Counter, defaultdict
+
+import requests
+
+from scheduler import percentile
+from traffic import load_capture
+
+
+def group_sessions(records):
+    """
+    캡처 레코드에서 턴 요청만 골라 세션별로 (offset 순서대로) 묶습니다.
+    """
+    sessions = defaultdict(list)
+    for record in records:
+        if record.get("type") == "turn" and "request" in record:
+            sessions[record["session"]].append(record)
+    for turns in sessions.values():
+        turns.sort(key=lambda record: record["offset"])
+    return sessions
+
+
+class ReplayResults:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.recorded = []
+        self.statuses = Counter()
+
+    def add(self, status, latency, recorded_latency):
+        with self.lock:
+            self.statuses[status] += 1
+            if status == 200:
+                self.latencies.append(latency)
+                if recorded_latency is not None:
+                    self.recorded.append(recorded_latency)
+
+
+def replay_session(url, api_key, client_id, turns, first_offset, started, speed, timeout, results):
+    http = requests.Session()
+    for record in turns:
+        # 원래 도착 시각(배속 적용)까지 기다린다. 이전 응답이 늦었으면 바로 보낸다.
+        delay = started + (record["offset"] - first_offset) / speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        payload = {**record["request"], "api_key": api_key, "client_id": client_id}
+        start = time.time()
+        try:
+            status = http.post(url, json=payload, timeout=timeout).status_code
+        except requests.RequestException:
+            status = "error"
+        results.add(status, time.time() - start, record.get("timings", {}).get("total"))
+
+
+def replay(records, url, api_key, speed=1.0, timeout=60.0, client_prefix="replay"):
+    sessions = group_sessions(records)
+    if not sessions:
+        raise ValueError("Capture has no turn records to replay.")
+    first_offset = min(turns[0]["offset"] for turns in sessions.values())
+    results = ReplayResults()
+    started = time.time()
+    threads = [
+        threading.Thread(target=replay_session, daemon=True,
+                         args=(url, api_key, f"{client_prefix}-{session}", turns, first_offset,
+                               started, speed, timeout, results))
+        for session, turns in sessions.items()
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    return report(results, len(sessions), elapsed, speed)
+
+
+def report(results, session_count, elapsed, speed):
+    latencies, recorded = results.latencies, results.recorded
+    total = sum(results.statuses.values())
+    return {
+        "sessions": session_count,
+        "turns": total,
+        "speed": speed,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(total / elapsed, 3) if elapsed > 0 else 0.0,
+        "statuses": {str(status): count for status, count in results.statuses.items()},
+        "latency": {f"p{int(q * 100)}": round(percentile(latencies, q), 3) for q in (0.5, 0.9, 0.95, 0.99)},
+        "latency_max": round(max(latencies, default=0.0), 3),
+        # 녹화 당시 서버가 잰 턴 처리 시간 (비교용)
+        "recorded_latency": {f"p{int(q * 100)}": round(percentile(recorded, q), 3) for q in (0.5, 0.95)},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured game traffic against a server.")
+    parser.add_argument("capture", help="capture file written with GOALLM_CAPTURE (.jsonl or .jsonl.gz)")
+    parser.add_argument("--url", default="http://127.0.0.1:5003", help="server base URL")
+    parser.add_argument("--api-key", required=True, help="API key to use for every replayed request")
+    parser.add_argument("--speed", type=float, default=1.0, help="arrival speed-up factor (1 = original pacing)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="per-request timeout in seconds")
+    parser.add_argument("--client-prefix", default="replay", help="prefix for replayed client ids")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    summary = replay(load_capture(args.capture), args.url.rstrip("/") + "/api/game", args.api_key,
+                     speed=args.speed, timeout=args.timeout, client_prefix=args.client_prefix)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"sessions: {summary['sessions']}  turns: {summary['turns']}  speed: {summary['speed']}x")
+        print(f"elapsed: {summary['elapsed']}s  throughput: {summary['throughput']} turns/s")
+        print("statuses: " + ", ".join(f"{status}={count}" for status, count in summary["statuses"].items()))
+        print("latency: " + "  ".join(f"{name}={value}s" for name, value in summary["latency"].items())
+              + f"  max={summary['latency_max']}s")
+        print("recorded latency: " + "  ".join(f"{name}={value}s" for name, value in summary["recorded_latency"].items()))
+    sys.exit(0 if summary["statuses"].get("200") == summary["turns"] else 1)
@@ -0,0 +1,230 @@
+# 턴 스케줄러
+# 지연에 민감한 foreground 턴(process_turn_return_update_params)과 무거운 background 메모리 업데이트
+# (continue_turn_processing)를 서로 다른 크기의 실행기로 분리한다.
+# - foreground 작업이 대기 중이면 background 워커는 새 작업을 시작하지 않는다 (엄격한 우선순위)
+# - background 작업은 세션별 큐에 순서대로 쌓이고, 세션당 한 번에 하나만 실행된다
+# - 세션 큐가 가득 차면 가장 오래된 작업을 버리고 그 자리에서 on_drop(가벼운 정리 작업)만 실행한다
+#   (on_drop도 세션 큐 순서대로 실행되므로 같은 세션의 다른 작업과 동시에 실행되지 않는다)
+#   버려진 작업은 항상 큐 앞쪽에 모이므로 바로 앞의 버려진 항목에 합쳐, 세션 큐는 per_session_queue + 1 항목을 넘지 않는다
+
+import time
+import itertools
+import threading
+import contextvars
+from collections import deque, defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+WAIT_SAMPLES = 1000  # 대기 시간 통계에 사용할 최근 샘플 수
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class TurnScheduler:
+    def __init__(self, foreground_workers=16, background_workers=4, per_session_queue=2):
+        self.per_session_queue = per_session_queue
+        self.lock = threading.Condition()
+
+        # foreground: 일반 스레드 풀 + 대기/실행 수 추적
+        self.foreground = ThreadPoolExecutor(max_workers=foreground_workers, thread_name_prefix="foreground")
+        self.foreground_pending = 0
+        self.foreground_running = 0
+        self.foreground_waits = deque(maxlen=WAIT_SAMPLES)
+        self.foreground_queued = OrderedDict()   # 아직 시작하지 않은 작업 id -> 제출 시각 (제출 순서)
+        self.foreground_ids = itertools.count()
+
+        # background: 세션별 큐 + 라운드로빈 워커
+        # key -> deque[(enqueued_at, func, args, on_drop, future, dropped)]
+        # 버려진 항목(dropped=True)은 func/on_drop/future 대신 args에 [(on_drop, args, future), ...]를 담는다
+        self.background_queues = defaultdict(deque)
+        self.background_ready = deque()              # 실행 가능한 작업이 있는 세션 키
+        self.background_active = set()               # 현재 작업이 실행 중인 세션 키
+        self.background_waits = deque(maxlen=WAIT_SAMPLES)
+        self.background_completed = 0
+        self.background_dropped = 0
+        self.background_failed = 0
+        self.stopped = False
+        for i in range(background_workers):
+            threading.Thread(target=self._background_worker, name=f"background-{i}", daemon=True).start()
+
+    # ------------------------------------------------------------
+    # foreground
+    # ------------------------------------------------------------
+    def run_foreground(self, func, *args):
+        """
+        foreground 실행기에서 func(*args)를 실행하고 결과를 기다려 반환합니다.
+        """
+        return self.submit_foreground(func, *args).result()
+
+    def submit_foreground(self, func, *args):
+        enqueued_at = time.time()
+        # 요청 스레드의 컨텍스트(예: 트래픽 녹화 중인 턴 캡처)를 foreground 작업에서도 그대로 사용한다
+        context = contextvars.copy_context()
+        with self.lock:
+            self.foreground_pending += 1
+            task_id = next(self.foreground_ids)
+            self.foreground_queued[task_id] = enqueued_at
+
+        def task():
+            with self.lock:
+                self.foreground_pending -= 1
+                self.foreground_running += 1
+                self.foreground_queued.pop(task_id, None)
+                self.foreground_waits.append(time.time() - enqueued_at)
+            try:
+                return context.run(func, *args)
+            finally:
+                with self.lock:
+                    self.foreground_running -= 1
+                    self.lock.notify_all()
+
+        future = self.foreground.submit(task)
+        future.add_done_callback(lambda f: f.cancelled() and self._forget_foreground(task_id))
+        return future
+
+    def _forget_foreground(self, task_id):
+        # 시작 전에 취소된 foreground 작업을 대기 목록에서 뺀다
+        with self.lock:
+            if self.foreground_queued.pop(task_id, None) is not None:
+                self.foreground_pending -= 1
+                self.lock.notify_all()
+
+    # ------------------------------------------------------------
+    # background
+    # ------------------------------------------------------------
+    def submit_background(self, key, func, *args, on_drop=None):
+        """
+        key(세션) 큐에 background 작업을 추가합니다. 같은 key의 작업은 제출 순서대로 하나씩 실행됩니다.
+        큐가 가득 차면 가장 오래된 대기 작업을 버리고, 그 작업 대신 on_drop(*args)을 같은 순서 자리에서 실행합니다.
+        """
+        future = Future()
+        with self.lock:
+            queue = self.background_queues[key]
+            while sum(1 for entry in queue if not entry[5]) >= self.per_session_queue:
+                self._drop_oldest(queue)
+            queue.append((time.time(), func, args, on_drop, future, False))
+            if key not in self.background_active and key not in self.background_ready:
+                self.background_ready.append(key)
+            self.lock.notify_all()
+        return future
+
+    def _drop_oldest(self, queue):
+        # self.lock을 잡은 상태에서 호출: 가장 오래된 (아직 버려지지 않은) 작업을 on_drop 작업으로 바꾼다
+        # 바로 앞 항목이 이미 버려진 항목이면 새 항목을 만들지 않고 그 on_drop 목록 뒤에 붙인다
+        for i, (enqueued_at, func, args, on_drop, future, dropped) in enumerate(queue):
+            if dropped:
+                continue
+            self.background_dropped += 1
+            if on_drop is None:
+                del queue[i]
+                future.cancel()
+            elif i > 0:
+                del queue[i]
+                queue[i - 1][2].append((on_drop, args, future))
+            else:
+                queue[i] = (enqueued_at, None, [(on_drop, args, future)], None, None, True)
+            return
+
+    def _background_worker(self):
+        while True:
+            with self.lock:
+                # foreground 대기 작업이 있으면 background는 양보한다
+                while not self.background_ready or self.foreground_pending > 0:
+                    if self.stopped and not self.background_ready:
+                        return
+                    self.lock.wait(timeout=1.0)
+                key = self.background_ready.popleft()
+                enqueued_at, func, args, _, future, dropped = self.background_queues[key].popleft()
+                self.background_active.add(key)
+                self.background_waits.append(time.time() - enqueued_at)
+            failed = False
+            if dropped:
+                # 버려진 작업들: on_drop만 순서대로 실행하고 future는 취소 상태로 둔다
+                for on_drop, drop_args, drop_future in args:
+                    try:
+                        on_drop(*drop_args)
+                        drop_future.cancel()
+                    except Exception as e:
+                        failed = True
+                        drop_future.set_exception(e)
+            elif future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except Exception as e:
+                    failed = True
+                    future.set_exception(e)
+            with self.lock:
+                self.background_active.discard(key)
+                if failed:
+                    self.background_failed += 1
+                elif not dropped:
+                    self.background_completed += 1
+                if self.background_queues[key]:
+                    self.background_ready.append(key)
+                else:
+                    del self.background_queues[key]
+                self.lock.notify_all()
+
+    def shutdown(self, timeout=None):
+        """
+        실행 중이거나 대기 중인 foreground/background 작업이 끝나기를 (최대 timeout초) 기다린 뒤 실행기를 닫습니다.
+        남은 작업 없이 끝났으면 True를 반환합니다. 시간이 지나면 아직 시작하지 않은 foreground 작업은 취소합니다.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while self._busy():
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.lock.wait(timeout=remaining)
+            drained = not self._busy()
+            self.stopped = True
+            self.lock.notify_all()
+        self.foreground.shutdown(wait=drained, cancel_futures=not drained)
+        return drained
+
+    def _busy(self):
+        # self.lock을 잡은 상태에서 호출
+        return bool(self.foreground_pending or self.foreground_running or self.background_queues or self.background_active)
+
+    def foreground_load(self):
+        """
+        admission 제어용 가벼운 부하 지표: (foreground 대기열 길이, 가장 오래 기다린 대기 작업의 현재 대기 시간)
+        대기 시간은 지금 시각 기준이므로 대기열이 비면 바로 0이 된다 (지난 부하가 남아 계속 거절하지 않음).
+        """
+        with self.lock:
+            if not self.foreground_queued:
+                return self.foreground_pending, 0.0
+            return self.foreground_pending, time.time() - next(iter(self.foreground_queued.values()))
+
+    # ------------------------------------------------------------
+    # 통계
+    # ------------------------------------------------------------
+    def stats(self):
+        with self.lock:
+            background_depths = [len(queue) for queue in self.background_queues.values()]
+            foreground_waits = list(self.foreground_waits)
+            background_waits = list(self.background_waits)
+            return {
+                "foreground": {
+                    "pending": self.foreground_pending,
+                    "running": self.foreground_running,
+                    "wait_p50": percentile(foreground_waits, 0.5),
+                    "wait_p95": percentile(foreground_waits, 0.95),
+                },
+                "background": {
+                    "pending": sum(background_depths),
+                    "running": len(self.background_active),
+                    "sessions_queued": len(background_depths),
+                    "max_session_depth": max(background_depths, default=0),
+                    "completed": self.background_completed,
+                    "dropped": self.background_dropped,
+                    "failed": self.background_failed,
+                    "wait_p50": percentile(background_waits, 0.5),
+                    "wait_p95": percentile(background_waits, 0.95),
+                },
+            }
@@ -1,36 +1,42 @@
 api_key = ''
 # https://github.com/AIRI-Institute/AriGraph/tree/main
 
+import time
+server_import_started = time.perf_counter()
+
+import sys
 import json
-import torch
-import torch.nn.functional as F
-from time import time
-import getpass
 from collections import OrderedDict
-import time
 import uuid
+import random
+import threading
 import logging
-import traceback
+import importlib
+import contextlib
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from pyngrok import ngrok
+from flask_sock import Sock, ConnectionClosed
 
 
 # (GPTagent, ContrieverGraph, Retriever, get_cached_embeddings, 그리고 system_prompt 등 필요한 모듈/상수들은 이미 정의되었다고 가정)
-from agent import GPTagent
-from system_prompt import default_system_prompt, system_plan_agent, system_action_agent, completed_plan_prompt, exception_plan_prompt, turn_count_plan_prompt,system_status_agent, predefined_knowledge, energy_prompts, trust_prompts, status_prompts
-from memory.arigraph import ContrieverGraph
-from memory.graph_plot import plot_contriever_graph
-from memory.retriever import filter_items_by_similarity, Retriever
+from agent import GPTagent, generate_hedged
+from system_prompt import default_system_prompt, system_plan_agent, system_action_agent, completed_plan_prompt, exception_plan_prompt, turn_count_plan_prompt,system_status_agent, predefined_knowledge, energy_prompts, trust_prompts, status_prompts, fallback_action_responses, action_output_format
+from prompt_layout import PromptBuilder, STATIC, SESSION, TURN
+from state_delta import StatusTracker
+from scheduler import TurnScheduler
+from admission import QuotaStore, AdmissionController
+from warmup import Warmup
+import traffic
+import profiling
+import llm_usage
+from structured_logging import setup_logging, log_event, category_logger, turn_context, new_turn_id, current_turn, LARGE_PAYLOAD_SAMPLE
+from structured_logging import stats as logging_stats, restart_after_fork as restart_logging_after_fork
+from memory.knowledge_base import KnowledgeBase, DEFAULT_NAMESPACE
 from tts import generate_tts_audio
+# torch / sentence_transformers를 끌어오는 memory.arigraph, memory.retriever는 warmup 스레드에서 처음 import 되고,
+# 이후 사용하는 함수 안에서 import 한다 (서버는 모델 로드를 기다리지 않고 바로 포트를 연다)
 
-def Logger(log_file):
-    def log_func(msg):
-        print(msg)
-    return log_func
-
-log_file = "goallm_v7"
 default_model = "gpt-4o-2024-11-20"
 mini_model = "gpt-4o-mini-2024-07-18"
 good_model = "chatgpt-4o-latest"
@@ -39,6 +45,11 @@ good_model = "chatgpt-4o-latest"
 n_prev, topk_episodic = 5, 2
 max_steps, n_attempts = 20, 1  # 최대 턴 수를 20으로 설정 (예시)
 
+# choose_action deadline 설정: hedge_delay초 후 빠른 모델로 보조 요청, action_deadline초에 템플릿 응답으로 대체
+hedge_model = mini_model
+action_hedge_delay = 2.5
+action_deadline = 8.0
+
 curr_location = "Inside the Operations Conference Barracks"
 observation = "A user and an NPC are talking inside the Operations Conference Barracks. They are sitting at the same table."
 valid_actions = [
@@ -50,12 +61,12 @@ valid_actions = [
 #    "Sit chair, Turn on pos"
                  ]
 
-log = Logger(log_file)
 
 # -- 에이전트 생성 --
 agent = GPTagent(model=default_model, system_prompt=default_system_prompt, api_key=api_key)
 agent_plan = GPTagent(model=default_model, system_prompt=system_plan_agent, api_key=api_key)
 agent_action = GPTagent(model=good_model, system_prompt=system_action_agent, api_key=api_key)
+agent_action_fast = GPTagent(model=hedge_model, system_prompt=system_action_agent, api_key=api_key)
 agent_status = GPTagent(model=default_model, system_prompt=system_status_agent, api_key=api_key)
 
 # 초기 plan_agent 출력 예시 (최초 계획)
@@ -93,8 +104,84 @@ def mark_completed_step(plan_json, step_number):
 # 최근 5턴 동안의 관련 지식을 중복 주제 없이 보관 (OrderedDict 사용)
 recent_knowledge = OrderedDict()
 
-# 지식 검색용 Retriever (Retriever 클래스가 정의되어 있다고 가정)
-knowledge_retriever = Retriever(device='cpu')
+# 지식 검색 및 세션 메모리 그래프가 함께 쓰는 Retriever는 warmup 단계에서 로드 (get_knowledge_retriever())
+
+# 검색 모드: "dense" / "lexical" (BM25 후보만 dense 재점수) / "hybrid" (dense + BM25 순위 융합)
+retrieval_mode = "hybrid"
+
+# 지식 베이스: predefined_knowledge(global) + knowledge_dir 아래의 JSONL/YAML 파일.
+# 파일이 바뀌면 바뀐 항목만 다시 임베딩해 서버 재시작 없이 반영한다 (memory/knowledge_base.py)
+knowledge_dir = "knowledge"
+knowledge_base = KnowledgeBase([knowledge_dir], builtin=predefined_knowledge)
+
+# 트리플릿 메모리 벡터 색인: "exact" (정확 검색) / "hnsw" (근사 검색, hnswlib 필요 - 그래프가 수천 개 이상일 때)
+# hnsw 파라미터: M, ef_construction (색인 품질), ef (검색 폭; 클수록 recall 증가, 지연 증가)
+vector_index_backend = "exact"
+vector_index_params = {}
+
+# ----------------------------------------------------------------
+# warmup: 무거운 import와 모델 로드를 백그라운드에서 순서대로 실행 (/api/ready로 진행 상황 확인)
+# ----------------------------------------------------------------
+# 임베딩 워커 프로세스 수 (0이면 서버 프로세스 안에서 계산). 워커를 쓰면 보통 intra-op 스레드 = 코어 수 / 워커 수
+embedding_workers = 0
+embedding_intra_op_threads = None
+
+def load_knowledge_retriever():
+    from memory.retriever import Retriever
+    return Retriever(device='cpu', workers=embedding_workers, intra_op_threads=embedding_intra_op_threads)
+
+def get_knowledge_retriever():
+    # warmup이 아직 로드 중이면 끝날 때까지 기다린다
+    return warmup.get("load retriever")
+
+def warm_embeddings():
+    # 첫 encode 호출 비용을 첫 요청 전에 치른다
+    get_knowledge_retriever().embed(["warmup"])
+
+def load_knowledge_base():
+    # 전체 지식 항목을 한 번 임베딩하고, 이후에는 파일 변경을 감시하며 바뀐 항목만 반영
+    knowledge_base.reload(get_knowledge_retriever(), force=True)
+    knowledge_base.start_watching()
+    return knowledge_base
+
+def get_knowledge_base():
+    return warmup.get("load knowledge base")
+
+# 공유 world graph: global 지식에서 추출한 세계 지식 트리플릿/임베딩을 모든 세션(NPC)이 읽기 전용으로 공유하고,
+# 세션 그래프는 그 위의 overlay로 개인 기억과 삭제(tombstone)만 보관한다.
+# 추출 결과는 world_facts_cache_path에 내용 해시로 캐시되어 재시작 시 LLM을 다시 호출하지 않는다.
+world_facts_cache_path = "world_facts_cache.json"
+
+def load_world_graph():
+    from memory.arigraph import ContrieverGraph
+    world_graph = ContrieverGraph(
+        default_model,
+        system_prompt="You are a helpful assistant",
+        api_key=api_key,
+        device='cpu',
+        retrieval_mode=retrieval_mode,
+        index_backend=vector_index_backend,
+        index_params=vector_index_params,
+        retriever=get_knowledge_retriever()
+    )
+    # 시작 시점의 global 지식으로 만든다 (이후 지식 파일 변경은 지식 검색에만 반영되고 world graph는 재시작 때 갱신)
+    count = world_graph.add_world_facts([f"{subject}: {content}" for subject, content in get_knowledge_base().entries()],
+                                        cache_path=world_facts_cache_path)
+    log_event("startup", "World graph loaded", triplets=count)
+    return world_graph
+
+def get_world_graph():
+    return warmup.get("load world graph")
+
+warmup = Warmup()
+warmup.add("import torch", lambda: importlib.import_module("torch"))
+warmup.add("import sentence_transformers", lambda: importlib.import_module("sentence_transformers"))
+warmup.add("import memory", lambda: importlib.import_module("memory.arigraph"))
+warmup.add("import pydub", lambda: importlib.import_module("pydub"))
+warmup.add("load retriever", load_knowledge_retriever)
+warmup.add("warm embeddings", warm_embeddings)
+warmup.add("load knowledge base", load_knowledge_base)
+warmup.add("load world graph", load_world_graph)
 
 #########################################################
 # 1. 상태 관리 agent (get_status) 구현
@@ -111,7 +198,8 @@ def get_status(history_context):
          "current_task": "대화"
       }
     """
-    prompt = system_status_agent + "\n" + history_context
+    # system_status_agent는 이미 system prompt로 전달되므로 사용자 메시지에는 history만 넣는다
+    prompt = history_context
     status_output, cost_status = agent_status.generate(prompt, jsn=True, t=0.5)
     try:
         status_json = json.loads(status_output)
@@ -121,7 +209,7 @@ def get_status(history_context):
             "user_trust": "높음",
             "current_task": "대화"
         }
-    log("Status: "+str(status_json))
+    log_event("status", "Status", status=status_json)
     return status_json
 
 
@@ -143,31 +231,85 @@ def planning(condition, observations, observation, relevant_episodes, related_to
     - 현재 작업: {status['current_task']}
 추가 Planning 지침: {status_prompts[status['current_task']]['planning']}"""
 
-    prompt = f"""
-1. State: {status_info}
-2. History: {observations}
-3. Current observation: {observation}
-4. Relevant episodes: {relevant_episodes}
-5. Related topics: {related_topics}
-6. Previous plan: {previous_plan_json}
-7. Predefined Knowledge: {related_knowledge}
-"""
     if condition == 'count 5':
-        prompt += turn_count_plan_prompt
+        condition_prompt = turn_count_plan_prompt
     elif condition == 'excepsion':
-        prompt += exception_plan_prompt
+        condition_prompt = exception_plan_prompt
     else:
-        prompt += completed_plan_prompt
+        condition_prompt = completed_plan_prompt
+
+    # 고정 지침 -> 세션 단위 정보 -> 턴 단위 정보 순서 (prompt-prefix 캐싱)
+    prompt = (PromptBuilder()
+              .add(STATIC, None, condition_prompt.strip())
+              .add(SESSION, "Predefined Knowledge", related_knowledge)
+              .add(SESSION, "Previous plan", previous_plan_json)
+              .add(SESSION, "State", status_info)
+              .add(TURN, "Related topics", related_topics)
+              .add(TURN, "Relevant episodes", relevant_episodes)
+              .add(TURN, "History", observations)
+              .add(TURN, "Current observation", observation)
+              .build())
 
     plan_output, cost_plan = agent_plan.generate(prompt, jsn=True, t=0.6)
-    log("Plan Agent Response: " + plan_output)
+    log_event("plan", "Plan agent response", level=logging.DEBUG, plan=plan_output)
     return plan_output
 
 #########################################################
 # 3. choose_action 함수 수정: 상태창 정보를 프롬프트에 포함
 #    (에너지와 신뢰도 보충 설명 추가)
 #########################################################
-def choose_action(observations, observation_with_conversation, relevant_episodes, related_topics, current_plan, valid_actions, related_knowledge, status):
+# 세션별로 최근 유효했던 행동 응답을 보관하는 캐시 크기 (사용자 입력 기준, LRU 방식) - deadline 초과 시 재사용
+ACTION_CACHE_SIZE = 100
+
+class ActionCache:
+    """
+    한 세션의 최근 유효한 행동 응답. 다른 세션/NPC의 응답이 섞이지 않도록 GameSession마다 하나씩 둡니다.
+    foreground 작업 스레드 여러 개가 동시에 읽고 쓰므로 잠금으로 보호합니다.
+    """
+    def __init__(self, size=ACTION_CACHE_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            action_json = self.items.get(key)
+            return None if action_json is None else dict(action_json)
+
+    def put(self, key, action_json):
+        with self.lock:
+            self.items[key] = action_json
+            self.items.move_to_end(key)
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+def parse_action_output(action_output):
+    """
+    agent_action 응답을 검증하여 필요한 키가 모두 있는 dict를 반환합니다.
+    형식이 맞지 않으면 None을 반환합니다 (generate_hedged의 validate로 사용).
+    """
+    try:
+        action_json = json.loads(action_output)
+    except Exception:
+        return None
+    required = ["npc_response", "translated_npc_response", "action", "facial_expression", "completed_step", "exception_flag"]
+    if not isinstance(action_json, dict) or any(key not in action_json for key in required):
+        return None
+    return action_json
+
+def fallback_action(action_cache, cache_key):
+    """
+    같은 세션에서 같은 입력에 대해 캐시된 응답이 있으면 그것을, 없으면 템플릿 응답을 반환합니다.
+    fallback 응답은 plan 진행이나 exception을 발생시키지 않습니다.
+    """
+    action_json = action_cache.get(cache_key) if action_cache is not None and cache_key else None
+    if action_json is None:
+        action_json = dict(random.choice(fallback_action_responses))
+    action_json["completed_step"] = -1
+    action_json["exception_flag"] = False
+    return action_json
+
+def choose_action(observations, observation_with_conversation, relevant_episodes, related_topics, current_plan, valid_actions, related_knowledge, status, action_cache=None, cache_key=None):
     supplementary_energy = energy_prompts.get(status["mental_energy"], "")
     supplementary_trust = trust_prompts.get(status["user_trust"], "")
 
@@ -177,44 +319,37 @@ def choose_action(observations, observation_with_conversation, relevant_episodes
     - 현재 작업: {status['current_task']}
 추가 행동 지침: {status_prompts[status['current_task']]['action']}"""
 
-    prompt = f"""
-1. State: {status_info}
-2. History: {observations}
-3. Latest observation: {observation_with_conversation}
-4. Relevant episodes: {relevant_episodes}
-5. Related topics: {related_topics}
-6. Current plan (Focus on not-completed step!): {current_plan}
-7. Predefined Knowledge: {related_knowledge}
-8. Possible actions: {valid_actions}
-Use context, reactive plan, and any additional information as needed.
-Generate a JSON object exactly in the following format:
-{{
-  "action": "One selected action from the provided list.",
-  "npc_response": "A concise dialogue line that is context-aware.",
-  "translated_npc_response": "Korean version of npc_response. All letters must be Korean.",
-  "facial_expression": "One of neutral, fun, surprised, angry, joy, sorrow.",
-  "completed_step": <number>,
-  "exception_flag": <boolean>
-}}
-Do not write anything else.
-"""
+    # 고정 지침/행동 목록 -> 세션 단위 정보 -> 턴 단위 정보 순서 (prompt-prefix 캐싱)
+    prompt = (PromptBuilder()
+              .add(STATIC, None, action_output_format)
+              .add(STATIC, "Possible actions", valid_actions)
+              .add(SESSION, "Predefined Knowledge", related_knowledge)
+              .add(SESSION, "Current plan (Focus on not-completed step!)", current_plan)
+              .add(SESSION, "State", status_info)
+              .add(TURN, "Related topics", related_topics)
+              .add(TURN, "Relevant episodes", relevant_episodes)
+              .add(TURN, "History", observations)
+              .add(TURN, "Latest observation", observation_with_conversation)
+              .build())
     t = 1
-    action_output, cost_action = agent_action.generate(prompt, jsn=True, t=t)
-    try:
-        action_json = json.loads(action_output)
-        npc_response = action_json["npc_response"]
-        translated_npc_response = action_json["translated_npc_response"]
-        action = action_json["action"]
-        facial_expression = action_json["facial_expression"]
-        completed_step = action_json["completed_step"]
-        exception_flag = action_json["exception_flag"]
-    except Exception as e:
-        log("!!!INCORRECT ACTION CHOICE!!!")
-        npc_response = "죄송합니다, 이해하지 못했어요."
-        facial_expression = "sorrow"
-        action = "look"
-        completed_step = -1
-        exception_flag = False
+    action_json, model, usage = generate_hedged(
+        agent_action, agent_action_fast, prompt, parse_action_output,
+        hedge_delay=action_hedge_delay, deadline=action_deadline, jsn=True, t=t
+    )
+    if action_json is None:
+        log_event("turn", "Action deadline exceeded - using fallback", level=logging.WARNING)
+        action_json = fallback_action(action_cache, cache_key)
+    else:
+        log_event("turn", "Action selected", model=model,
+                  cached_tokens=usage["cached_tokens"], prompt_tokens=usage["prompt_tokens"])
+        if action_cache is not None and cache_key:
+            action_cache.put(cache_key, action_json)
+    npc_response = action_json["npc_response"]
+    translated_npc_response = action_json["translated_npc_response"]
+    action = action_json["action"]
+    facial_expression = action_json["facial_expression"]
+    completed_step = action_json["completed_step"]
+    exception_flag = action_json["exception_flag"]
     return npc_response, translated_npc_response, action, facial_expression, completed_step, exception_flag
 
 
@@ -223,31 +358,49 @@ Do not write anything else.
 # ----------------------------------------------------------------
 # 로깅 설정
 # ----------------------------------------------------------------
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
+# 구조화 JSON 로그를 큐 핸들러로 비동기 출력 (카테고리별 레벨은 GOALLM_LOG_LEVELS, 자세한 내용은 structured_logging.py)
+setup_logging()
 logger = logging.getLogger(__name__)
-
-def Logger(log_file):
-    def log_func(msg):
-        print(msg)
-    return log_func
-log = Logger(log_file)
+# ContrieverGraph.update_without_retrieve에 넘기는 log(msg) 함수 (새/낡은 트리플릿 목록 등 큰 메시지만 샘플링;
+# compaction/복원/교체 수 같은 운영 메시지는 arigraph가 log_event로 샘플링 없이 남긴다)
+memory_log = category_logger("memory", level=logging.DEBUG, sample=LARGE_PAYLOAD_SAMPLE)
 
 # ----------------------------------------------------------------
 # Flask App, CORS, Ngrok 준비
 # ----------------------------------------------------------------
 app = Flask(__name__)
 CORS(app)
+sock = Sock(app)
+
+@app.before_request
+def start_turn_log():
+    # 이 요청에서 남기는 로그에 correlation id(turn_id)를 붙인다 (WebSocket은 턴마다 새로 붙임)
+    current_turn.set(new_turn_id())
+ws_heartbeat_interval = 15  # 클라이언트 메시지가 없을 때 heartbeat 프레임을 보내는 간격 (초)
+
+# foreground 턴과 background 메모리 업데이트를 분리된 실행기에서 처리 (foreground 우선)
+foreground_workers, background_workers = 16, 4
+background_queue_per_session = 2  # 세션당 대기 가능한 업데이트 수, 넘치면 오래된 것부터 가벼운 처리만 하고 버림
+scheduler = TurnScheduler(foreground_workers, background_workers, background_queue_per_session)
 
-# API 키 검증 및 토큰 관리 (예시)
+# API 키 검증 및 토큰 관리 (예시) - 처음 quota DB를 만들 때의 초기값
 API_KEYS = {
     "1": 10000,
     "2": 5000,
 }
 
+# 요청 수락 제어: 남은 토큰은 quota_db_path(sqlite)에 원자적으로 차감/저장
+quota_db_path = "api_quota.db"
+admission = AdmissionController(
+    QuotaStore(quota_db_path, API_KEYS),
+    rate_per_key=1.0,         # API 키당 초당 턴 수
+    burst_per_key=5,
+    max_concurrent=foreground_workers * 2,
+    max_queue_depth=foreground_workers,
+    wait_slo=5.0,             # 가장 오래 기다린 foreground 대기 작업의 대기 시간이 이 값(초)을 넘으면 503
+    load_fn=scheduler.foreground_load
+)
+
 
 # ----------------------------------------------------------------
 # 클라이언트별 GameSession 관리
@@ -259,13 +412,22 @@ client_sessions = {}  # key: client_id, value: GameSession instance
 # ----------------------------------------------------------------
 def get_or_create_session(client_id, client_api):
     if client_id not in client_sessions:
-        logger.debug(f"Creating new session for client {client_id}")
+        log_event("request", "Creating new session", client_id=client_id)
         session = GameSession(client_api)
         client_sessions[client_id] = session
     else:
         session = client_sessions[client_id]
     return session
 
+SESSION_OWNER_ERROR = 'client_id belongs to a session of another API key.'
+
+def owns_session(client_id, client_api):
+    """
+    client_id의 세션이 없거나 client_api가 만든 세션이면 True. 다른 API 키의 세션(기록, 재개 프레임)에는 붙을 수 없습니다.
+    """
+    session = client_sessions.get(client_id)
+    return session is None or session.client_api == client_api
+
 # ----------------------------------------------------------------
 # GameSession 클래스: 한 클라이언트의 전체 게임 상태를 관리
 # ----------------------------------------------------------------
@@ -286,72 +448,139 @@ class GameSession:
         self.prev_npc = ""            # 이전 턴의 NPC 발화
         self.count = 0
         self.recent_knowledge = OrderedDict()
+        self.action_cache = ActionCache()  # deadline 초과 시 재사용할 이 세션의 최근 행동 응답
+        self.knowledge_namespaces = [DEFAULT_NAMESPACE]  # 지식 검색 대상 (global + 요청의 knowledge_namespaces)
+        # 마지막 npc_status/world_status를 기억하고 바뀐 필드만 프롬프트에 넣는다 (history 길이마다 전체 스냅샷)
+        self.status_tracker = StatusTracker(snapshot_interval=n_prev)
+        self.last_turn_frames = []    # WebSocket 재연결 시 재전송할 마지막 턴 프레임
+        self.graph_view = None        # /api/graph 조회 시 생성 (memory.graph_plot.GraphView, 배치 캐시)
+        self.profile_mode = None      # /api/profile 로 예약된 프로파일링 모드와 남은 턴 수
+        self.profile_turns = 0
+        from memory.arigraph import ContrieverGraph
         self.graph = ContrieverGraph(
             default_model,
             system_prompt="You are a helpful assistant",
             api_key=self.api_key,
             device='cpu',
-            debug=False
+            debug=False,
+            retriever=get_knowledge_retriever(),
+            base=get_world_graph(),
+            retrieval_mode=retrieval_mode,
+            index_backend=vector_index_backend,
+            index_params=vector_index_params
         )
+        # 세션 상태(history/plan/prev_npc/count/subgraph)와 그래프를 함께 보호하는 잠금 (그래프와 같은 RLock)
+        # foreground 턴은 검색하는 동안, background 업데이트는 상태/그래프를 바꾸는 동안만 잡는다 (LLM 호출 중에는 잡지 않음)
+        self.lock = self.graph.lock
+
+    def take_profile_mode(self, requested=None):
+        """
+        이번 턴의 프로파일링 모드를 반환합니다. 요청 플래그가 우선이고, 없으면 /api/profile 로 예약된 턴을 하나 소비합니다.
+        요청 플래그는 profiling.REQUEST_FLAG_ENABLED(GOALLM_PROFILE_REQUESTS=1)일 때만 따릅니다.
+        """
+        if requested and profiling.REQUEST_FLAG_ENABLED:
+            return requested if requested in profiling.PROFILE_MODES else "sample"
+        if self.profile_turns > 0:
+            self.profile_turns -= 1
+            return self.profile_mode
+        return None
 
     def process_turn_return_update_params(self, user_input, game_status):
-        turn_start = time.time()
-        self.count += 1
-        log(f"Turn {self.count}")
+        context = traffic.timed("retrieve", self.retrieve_turn_context, user_input, game_status)
+        return traffic.timed("select_action", self.select_turn_action, user_input, game_status, context)
 
-        log(f"Input: {user_input}")
-        log(f"Game Status: {game_status}")
-        # 1. input_with_status 구성 (이전 NPC 발화 포함)
+    def observation_for(self, user_input):
+        # input_with_status 구성 (이전 NPC 발화 포함)
         observation_with_conversation = ""
         if self.prev_npc:
             observation_with_conversation += self.prev_npc
         observation_with_conversation += user_input
+        return observation_with_conversation
 
-        # 2. 메모리 retrieval
-        retrieved_subgraph, top_episodic = self.graph.memory_retrieve(
-            observation_with_conversation, self.plan0, self.subgraph,
-            recent_n=5, topk_episodic=topk_episodic
-        )
-        log("Retrieved associated subgraph: " + str(retrieved_subgraph))
-        log("Retrieved top episodic memory: " + str(top_episodic))
-
-        # 3. 사전 정의된 지식과 관련된 지식 갱신
-        related_knowledge_items = filter_items_by_similarity(
-            predefined_knowledge,
-            observation_with_conversation,
-            threshold=0.37,
-            retriever=knowledge_retriever,
-            max_n=3
-        )
-        for subject, content, score in related_knowledge_items:
-            self.recent_knowledge[subject] = content
-            self.recent_knowledge.move_to_end(subject)
-            log("Related knowledge: " + str(subject) + " " + str(content) + " (score: " + str(score) + ")")
-        while len(self.recent_knowledge) > 5:
-            self.recent_knowledge.popitem(last=False)
-        combined_knowledge_str = "; ".join([f"{subj}: {cont}" for subj, cont in self.recent_knowledge.items()])
+    def retrieve_turn_context(self, user_input, game_status, retrieval_context=None):
+        """
+        턴의 앞부분 (메모리/지식 검색, 임베딩 위주의 CPU 작업)을 수행하고 choose_action에 필요한 컨텍스트를 반환합니다.
+        :param retrieval_context: 쿼리 임베딩을 미리 채워 둔 RetrievalContext (scene 배치 처리 시)
+        """
+        # background 업데이트(continue_turn_processing)가 같은 세션의 그래프/상태를 바꾸는 중에 읽지 않도록 잠근다
+        with self.lock:
+            turn_start = time.time()
+            self.count += 1
+            log_event("turn", "Turn started", count=self.count, input=user_input)
+            log_event("turn", "Game status", level=logging.DEBUG, sample=LARGE_PAYLOAD_SAMPLE, game_status=game_status)
+            # 1. input_with_status 구성 (이전 NPC 발화 포함)
+            observation_with_conversation = self.observation_for(user_input)
+
+            from memory.retriever import RetrievalContext
+
+            # 2. 메모리 retrieval (observation 임베딩은 retrieval_context로 이 턴의 모든 검색이 공유)
+            if retrieval_context is None:
+                retrieval_context = RetrievalContext()
+            retrieved_subgraph, top_episodic = self.graph.memory_retrieve(
+                observation_with_conversation, self.plan0, self.subgraph,
+                recent_n=5, topk_episodic=topk_episodic, retrieval_context=retrieval_context
+            )
+            log_event("memory", "Retrieved memory", level=logging.DEBUG, sample=LARGE_PAYLOAD_SAMPLE,
+                      subgraph=retrieved_subgraph, episodic=top_episodic)
+
+            # 3. 사전 정의된 지식과 관련된 지식 갱신
+            related_knowledge_items = get_knowledge_base().search(
+                observation_with_conversation,
+                self.knowledge_namespaces,
+                threshold=0.37,
+                max_n=3,
+                mode=retrieval_mode,
+                retrieval_context=retrieval_context
+            )
+            for subject, content, score in related_knowledge_items:
+                self.recent_knowledge[subject] = content
+                self.recent_knowledge.move_to_end(subject)
+                log_event("knowledge", "Related knowledge", level=logging.DEBUG, subject=subject, score=score)
+            while len(self.recent_knowledge) > 5:
+                self.recent_knowledge.popitem(last=False)
+            combined_knowledge_str = "; ".join([f"{subj}: {cont}" for subj, cont in self.recent_knowledge.items()])
+            return {
+                "turn_start": turn_start,
+                "observation_with_conversation": observation_with_conversation,
+                "retrieved_subgraph": retrieved_subgraph,
+                "top_episodic": top_episodic,
+                "combined_knowledge_str": combined_knowledge_str,
+                "retrieval_context": retrieval_context
+            }
+
+    def select_turn_action(self, user_input, game_status, context):
+        """
+        retrieve_turn_context 결과로 choose_action(LLM I/O)을 실행하고 (turn_result, update_params)를 반환합니다.
+        """
+        turn_start = context["turn_start"]
+        observation_with_conversation = context["observation_with_conversation"]
+        retrieved_subgraph = context["retrieved_subgraph"]
+        top_episodic = context["top_episodic"]
+        combined_knowledge_str = context["combined_knowledge_str"]
+        # LLM 호출 동안 background 업데이트가 바꾸지 못하도록 세션 상태의 스냅샷을 쓴다
+        with self.lock:
+            history, plan, status = list(self.history), self.plan0, dict(self.current_status)
 
         # 4. 행동 선택: choose_action 실행
         npc_response, translated_npc_response, action, facial_expression, completed_step, exception_flag = choose_action(
-            self.history,
+            history,
             observation_with_conversation + game_status,
             top_episodic,
             retrieved_subgraph,
-            self.plan0,
+            plan,
             valid_actions,
             related_knowledge=combined_knowledge_str,
-            status=self.current_status
+            status=status,
+            action_cache=self.action_cache,
+            cache_key=user_input
         )
         action_selection_time = time.time() - turn_start
-        log("NPC: " + npc_response)
-        log("Translated Talk: " + translated_npc_response)
-        log("Action: " + action)
-        log("Facial expression: " + facial_expression)
-        log("Completed step: " + str(completed_step))
-        log(f"Time for action selection: {action_selection_time:.2f} sec")
+        log_event("turn", "Action", npc=npc_response, action=action, expression=facial_expression,
+                  completed_step=completed_step, seconds=round(action_selection_time, 3))
 
         # 5. 업데이트에 사용할 파라미터 구성 (이후 continue_turn_processing에 사용)
         update_params = {
+            "turn_id": current_turn.get(),
             "observation_with_conversation": observation_with_conversation,
             "npc_response": npc_response,
             "action": action,
@@ -359,7 +588,9 @@ class GameSession:
             "exception_flag": exception_flag,
             "top_episodic": top_episodic,
             "retrieved_subgraph": retrieved_subgraph,
-            "combined_knowledge_str": combined_knowledge_str
+            "combined_knowledge_str": combined_knowledge_str,
+            "game_status": game_status,
+            "retrieval_context": context.get("retrieval_context")
         }
 
         # 6. 응답 반환에 사용할 결과 구성
@@ -373,109 +604,150 @@ class GameSession:
         }
         return turn_result, update_params
 
+    def record_turn(self, observation_with_conversation, npc_response, action, completed_step, game_status=""):
+        """
+        턴 결과를 history/plan/prev_npc에 반영하는 가벼운 처리.
+        background 큐가 넘쳐 무거운 업데이트가 버려질 때도 이 부분은 항상 실행됩니다.
+        """
+        with self.lock:
+            # 기록 업데이트
+            # 델타 인코딩된 상태는 history에 남겨 두어야 이후 턴에서 전체 상태를 복원할 수 있다
+            combined_entry = f"Observation: {observation_with_conversation}{game_status}\nNPC: {npc_response}\nAction: {action}"
+            self.history.append(combined_entry)
+            if len(self.history) > n_prev:
+                self.history = self.history[-n_prev:]
+
+            if completed_step != -1:
+                log_event("plan", "Plan step completed", step=completed_step)
+                plan_current = json.loads(self.plan0)
+                plan_current = mark_completed_step(plan_current, completed_step)
+                self.plan0 = json.dumps(plan_current)
+
+            self.prev_npc = "NPC Talk: " + npc_response + "\n NPC Action: " + action + "\n"
+
     def continue_turn_processing(self, observation_with_conversation, npc_response, action,
                                  completed_step, exception_flag,
-                                 top_episodic, retrieved_subgraph, combined_knowledge_str):
+                                 top_episodic, retrieved_subgraph, combined_knowledge_str, game_status="",
+                                 retrieval_context=None):
         """
         choose_action 이후의 남은 처리를 진행하는 기존 함수
         """
-        # 기록 업데이트
-        combined_entry = f"Observation: {observation_with_conversation}\nNPC: {npc_response}\nAction: {action}"
-        self.history.append(combined_entry)
-        if len(self.history) > n_prev:
-            self.history = self.history[-n_prev:]
-
-        if completed_step != -1:
-            log(f"Plan step {completed_step} completed. Marking as completed in the plan.")
-            plan_current = json.loads(self.plan0)
-            plan_current = mark_completed_step(plan_current, completed_step)
-            self.plan0 = json.dumps(plan_current)
-
-        current_plan_json = json.loads(self.plan0)
+        self.record_turn(observation_with_conversation, npc_response, action, completed_step, game_status)
+
+        # LLM 호출(상태 평가/planning) 동안은 잠금을 잡지 않도록 세션 상태의 스냅샷을 쓴다
+        with self.lock:
+            history, plan0, count = list(self.history), self.plan0, self.count
+        current_plan_json = json.loads(plan0)
         all_steps_completed = all(step.get("status") == "completed" for step in current_plan_json.get("plan_steps", []))
-        if (self.count >= 5) or exception_flag or all_steps_completed:
-            history_context = "\n".join(self.history)
+        if (count >= 5) or exception_flag or all_steps_completed:
+            history_context = "\n".join(history)
             new_status = get_status(history_context)
-            log(f"Updated status (from planning): {new_status}")
-            if self.count >= 5:
+            log_event("status", "Updated status (from planning)", status=new_status)
+            if count >= 5:
                 condition = 'count 5'
             elif exception_flag:
                 condition = 'exception'
             elif all_steps_completed:
                 condition = 'finish plan'
-            log(f"Plan Agent 재실행 (조건: {condition})")
+            log_event("plan", "Re-planning", condition=condition)
             plan_response = planning(
                 condition,
-                self.history,
+                history,
                 observation_with_conversation,
                 top_episodic,
                 retrieved_subgraph,
-                self.plan0,
+                plan0,
                 related_knowledge=combined_knowledge_str,
                 status=new_status
             )
-            self.plan0 = plan_response
-            self.count = 0
+            with self.lock:
+                self.plan0 = plan_response
+                self.count = 0
 
         observed_items, _ = agent.item_processing_scores(observation_with_conversation, self.plan0)
         items = {key.lower(): value for key, value in observed_items.items()}
-        log("Crucial items: " + str(items))
+        log_event("memory", "Crucial items", level=logging.DEBUG, items=items)
 
         self.graph.update_without_retrieve(
             observation_with_conversation, self.plan0, self.subgraph,
-            list(self.locations), action, items, log
+            list(self.locations), action, items, memory_log
         )
         # 업데이트 후 최신 subgraph를 재획득하는 예시(필요 시)
         updated_subgraph, _ = self.graph.memory_retrieve(
             observation_with_conversation, self.plan0, [],
-            recent_n=5, topk_episodic=topk_episodic
+            recent_n=5, topk_episodic=topk_episodic, retrieval_context=retrieval_context
         )
         self.subgraph = updated_subgraph
 
-        self.prev_npc = "NPC Talk: " + npc_response + "\n NPC Action: " + action + "\n"
+# ----------------------------------------------------------------
+# HTTP / WebSocket 공용 턴 처리 함수
+# ----------------------------------------------------------------
+def error_response(error):
+    message, status, retry_after = error
+    response = jsonify({'error': message})
+    response.status_code = status
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
 
-@app.route('/api/game', methods=['POST'])
-def handle_game_state():
-    try:
-        data = request.json
-        logger.debug(f"Received data: {data}")
+NAMESPACES_ERROR = 'knowledge_namespaces must be a list of strings.'
 
-        # API 키 검증 및 토큰 차감
-        client_api = data.get('api_key')
-        if not client_api or client_api not in API_KEYS:
-            return jsonify({'error': 'Invalid or missing API key.'}), 401
-        if API_KEYS[client_api] <= 0:
-            return jsonify({'error': 'API key has no remaining tokens.'}), 403
-        API_KEYS[client_api] -= 1
-        remaining_tokens = API_KEYS[client_api]
-
-        # client_id로 GameSession 가져오기
-        client_id = data.get('client_id') or str(uuid.uuid4())
-        session = get_or_create_session(client_id, client_api)
-
-        # 요청 파라미터 파싱
-        user_input = data.get('userInput', '')
-        request_situation = data.get('request_situation', '')
-        npc_status = data.get('npc_status', {})
-        world_status = data.get('world_status', {})
-
-        input = "User Talk: " + user_input + "\n" + "Request Situation: " + request_situation + "\n"
-        game_status = "NPC Status: " + str(npc_status) + "\n" + "World Status: " + str(world_status) + "\n"
-
-        # process_turn_return_update_params()로 즉시 처리 결과와 업데이트 파라미터 획득
-        turn_result, update_params = session.process_turn_return_update_params(input, game_status)
-
-        response = jsonify({
-            'client_id': client_id,
-            'audio_file': generate_tts_audio(turn_result["translated_npc_response"]),
-            'Expression': turn_result["facial_expression"],
-            'Talk': turn_result["npc_response"],
-            'Action': turn_result["action"],
-            'remaining_tokens': remaining_tokens
-        })
+def invalid_namespaces(value):
+    # 문자열 하나를 그대로 받으면 글자 단위로 쪼개져 모든 네임스페이스 검색이 빗나가므로 문자열 리스트만 허용
+    return value is not None and (not isinstance(value, list) or not all(isinstance(item, str) for item in value))
 
-        # 응답 전송 완료 후 업데이트 실행
-        def update_callback():
+STATUS_ERROR = 'npc_status and world_status must be JSON objects.'
+
+def invalid_status(data):
+    # 상태 델타 인코더는 dict만 다룰 수 있으므로 다른 타입은 500 대신 400으로 거절
+    return any(data.get(key) is not None and not isinstance(data[key], dict) for key in ('npc_status', 'world_status'))
+
+def build_turn_input(session, data):
+    """
+    요청 데이터에서 사용자 입력 문자열과 (델타 인코딩된) 게임 상태 문자열을 만듭니다.
+    """
+    user_input = data.get('userInput', '')
+    request_situation = data.get('request_situation', '')
+    npc_status = data.get('npc_status') or {}
+    world_status = data.get('world_status') or {}
+    # status_delta가 true이면 클라이언트가 바뀐 필드만 보낸 것, reset이면 저장된 상태를 버리고 스냅샷으로 시작
+    status_delta = bool(data.get('status_delta', False))
+    reset = bool(data.get('reset', False))
+    # knowledge_namespaces가 오면 이후 턴의 지식 검색 대상으로 기억한다 (global은 항상 포함)
+    if data.get('knowledge_namespaces') is not None:
+        session.knowledge_namespaces = list(dict.fromkeys([DEFAULT_NAMESPACE, *data['knowledge_namespaces']]))
+
+    input = "User Talk: " + user_input + "\n" + "Request Situation: " + request_situation + "\n"
+    game_status = session.status_tracker.update(npc_status, world_status, is_delta=status_delta, reset=reset)
+    return input, game_status
+
+def capture_turn(record_type, client_id, data=None):
+    """
+    트래픽 녹화(GOALLM_CAPTURE)가 켜져 있으면 이 턴의 캡처를 시작합니다. 꺼져 있으면 아무것도 하지 않습니다.
+    """
+    if traffic.recorder is None or client_id is None:
+        return contextlib.nullcontext()
+    fields = {}
+    if data is not None:
+        fields["request"] = {key: value for key, value in data.items() if key != 'api_key'}
+    return traffic.recorder.start(record_type, client_id, **fields)
+
+# 턴 프로파일 결과 저장소 (profiles/<profile_id>/)
+profile_store = profiling.ProfileStore()
+
+def profile_turn(mode, client_id):
+    """
+    mode가 주어지면 이 턴을 프로파일링합니다. 아니면 아무것도 하지 않습니다.
+    """
+    if mode is None:
+        return contextlib.nullcontext()
+    return profiling.TurnProfile(mode, session=client_id)
+
+def run_update(session, update_params):
+    # background 업데이트의 로그도 원래 턴의 turn_id로 묶는다
+    # 결과 Future는 아무도 읽지 않으므로 실패는 여기서 traceback과 함께 남긴다
+    with turn_context(update_params.get("turn_id")), capture_turn("update", update_params.get("capture_session")):
+        try:
             session.continue_turn_processing(
                 update_params["observation_with_conversation"],
                 update_params["npc_response"],
@@ -484,14 +756,93 @@ def handle_game_state():
                 update_params["exception_flag"],
                 update_params["top_episodic"],
                 update_params["retrieved_subgraph"],
-                update_params["combined_knowledge_str"]
+                update_params["combined_knowledge_str"],
+                update_params["game_status"],
+                update_params.get("retrieval_context")
+            )
+        except Exception:
+            logger.exception("Background memory update failed")
+            raise
+
+def drop_update(session, update_params):
+    with turn_context(update_params.get("turn_id")):
+        log_event("turn", "Background queue full - skipping memory update for a stale turn", level=logging.WARNING)
+        try:
+            session.record_turn(
+                update_params["observation_with_conversation"],
+                update_params["npc_response"],
+                update_params["action"],
+                update_params["completed_step"],
+                update_params["game_status"]
             )
+        except Exception:
+            logger.exception("Recording a dropped turn failed")
+            raise
+
+def schedule_update(session, update_params):
+    """
+    세션별 background 큐에 메모리 업데이트를 넣습니다. 같은 세션의 업데이트는 순서대로 하나씩 실행됩니다.
+    """
+    return scheduler.submit_background(session, run_update, session, update_params, on_drop=drop_update)
+
+@app.route('/api/game', methods=['POST'])
+def handle_game_state():
+    try:
+        data = request.json
+        log_event("request", "Received turn", level=logging.DEBUG, sample=LARGE_PAYLOAD_SAMPLE, data=data)
+        if invalid_namespaces(data.get('knowledge_namespaces')):
+            return jsonify({'error': NAMESPACES_ERROR}), 400
+        if invalid_status(data):
+            return jsonify({'error': STATUS_ERROR}), 400
+
+        # API 키 검증 및 토큰 차감
+        client_api = data.get('api_key')
+        if not owns_session(data.get('client_id'), client_api):
+            return jsonify({'error': SESSION_OWNER_ERROR}), 403
+        remaining_tokens, error = admission.admit(client_api)
+        if error:
+            return error_response(error)
+
+        try:
+            # client_id로 GameSession 가져오기
+            client_id = data.get('client_id') or str(uuid.uuid4())
+            session = get_or_create_session(client_id, client_api)
+
+            # 요청의 "profile" 플래그 또는 /api/profile 예약이 있으면 이 턴을 프로파일링
+            with profile_turn(session.take_profile_mode(data.get('profile')), client_id) as profile, \
+                    capture_turn("turn", client_id, data):
+                # 요청 파라미터 파싱
+                input, game_status = build_turn_input(session, data)
+
+                # process_turn_return_update_params()로 즉시 처리 결과와 업데이트 파라미터 획득
+                turn_result, update_params = scheduler.run_foreground(
+                    profiling.section, "turn", session.process_turn_return_update_params, input, game_status)
+                audio_file = traffic.timed("tts", generate_tts_audio, turn_result["translated_npc_response"])
+            if traffic.recorder is not None:
+                update_params["capture_session"] = client_id
+
+            payload = {
+                'client_id': client_id,
+                'audio_file': audio_file,
+                'Expression': turn_result["facial_expression"],
+                'Talk': turn_result["npc_response"],
+                'Action': turn_result["action"],
+                'remaining_tokens': remaining_tokens
+            }
+            if profile is not None:
+                payload['profile_id'] = profile_store.save(profile)["profile_id"]
+            response = jsonify(payload)
+        finally:
+            admission.release()
+
+        # 응답 전송 완료 후 업데이트 실행
+        def update_callback():
+            schedule_update(session, update_params)
         response.call_on_close(update_callback)
         return response
 
     except Exception as e:
-        logger.error(f"An error occurred: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"An error occurred: {str(e)}")
         return jsonify({
             'npc_response': "Error",
             'Talk': f"[System: An error occurred: {str(e)}]",
@@ -499,12 +850,353 @@ def handle_game_state():
             'facial_expression': "sorrow",
             'remaining_tokens': 0
         }), 500
-    
+
+
+# ----------------------------------------------------------------
+# 턴 프로파일링 (디버깅용)
+#   POST /api/profile {"api_key", "client_id", "turns": 1, "mode": "sample" | "cprofile"} -> 다음 N턴 프로파일링 예약
+#   GET  /api/profile?client_id=...&api_key=...                 -> 세션의 최근 프로파일 목록
+#   GET  /api/profile/<profile_id>?client_id=...&api_key=...[&format=collapsed]
+# ----------------------------------------------------------------
+def session_for_request(client_id, client_api):
+    session = client_sessions.get(client_id)
+    if session is None or not admission.is_valid_key(client_api) or session.client_api != client_api:
+        return None
+    return session
+
+@app.route('/api/profile', methods=['POST'])
+def handle_profile_request():
+    data = request.json or {}
+    session = session_for_request(data.get('client_id'), data.get('api_key'))
+    if session is None:
+        return jsonify({'error': 'Unknown session or API key.'}), 404
+    mode = data.get('mode', 'sample')
+    if mode not in profiling.PROFILE_MODES:
+        return jsonify({'error': f"Unknown profile mode '{mode}'."}), 400
+    session.profile_mode = mode
+    session.profile_turns = max(0, int(data.get('turns', 1)))
+    return jsonify({'mode': mode, 'turns': session.profile_turns})
+
+@app.route('/api/profile', methods=['GET'])
+def handle_profile_list():
+    client_id = request.args.get('client_id')
+    if session_for_request(client_id, request.args.get('api_key')) is None:
+        return jsonify({'error': 'Unknown session or API key.'}), 404
+    return jsonify({'profiles': profile_store.list(session=client_id)})
+
+@app.route('/api/profile/<profile_id>', methods=['GET'])
+def handle_profile_get(profile_id):
+    client_id = request.args.get('client_id')
+    result = profile_store.load(profile_id)
+    if session_for_request(client_id, request.args.get('api_key')) is None or result is None \
+            or result["meta"]["session"] != client_id:
+        return jsonify({'error': 'Unknown profile, session or API key.'}), 404
+    if request.args.get('format') == 'collapsed':
+        # flamegraph.pl / speedscope 에 바로 넣을 수 있는 텍스트
+        return result.get("collapsed", ""), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    return jsonify(result)
+
+
+# ----------------------------------------------------------------
+# 여러 NPC가 있는 장면: 사용자 입력 하나에 대한 모든 NPC의 반응을 한 번에 처리
+#   {"api_key", "client_id", "userInput", "request_situation", "world_status", "knowledge_namespaces",
+#    "npcs": [{"npc_id", "npc_status", "status_delta", "reset", "knowledge_namespaces"}, ...]}
+# NPC마다 별도의 GameSession("client_id/npc_id")을 사용한다.
+# 지식 검색은 global + 장면 공통 namespace + NPC namespace(생략 시 "npc:<npc_id>")를 대상으로 한다.
+# ----------------------------------------------------------------
+MAX_SCENE_NPCS = 8
+
+def prefetch_scene_embeddings(sessions, inputs):
+    """
+    모든 NPC의 observation 임베딩과 각 NPC 그래프의 최근 트리플릿 임베딩을 한 번의 배치로 계산합니다.
+    :return: NPC별 RetrievalContext (observation 임베딩이 채워짐)
+    """
+    from memory.retriever import RetrievalContext
+    # 그래프 검색(graph_retr_search)이 읽는 임베딩 캐시는 arigraph가 import한 retriever 모듈의 것이다
+    from memory.arigraph import get_cached_embeddings
+    retriever = get_knowledge_retriever()
+    observations, recent_triplets = [], []
+    for session, input in zip(sessions, inputs):
+        # 단일 턴 경로와 같은 세션 잠금으로 background 업데이트 중인 그래프를 읽지 않는다
+        with session.lock:
+            observations.append(session.observation_for(input))
+            recent_triplets.extend(session.graph.triplets_to_str(session.graph.triplets[-5:]))
+    contexts = [RetrievalContext() for _ in sessions]
+    for context, observation, embedding in zip(contexts, observations, retriever.embed(observations)):
+        context.store(observation, retriever, embedding)
+    if recent_triplets:
+        get_cached_embeddings(list(dict.fromkeys(recent_triplets)), retriever)
+    return contexts
+
+def run_scene_turn(sessions, inputs, game_statuses):
+    """
+    1) 임베딩: 모든 NPC의 쿼리를 한 번에 배치 임베딩 (foreground 작업 1개)
+    2) 검색: NPC별 foreground 작업으로 동시에 실행 (각 세션의 잠금 안에서)
+    3) choose_action: NPC별 foreground 작업으로 동시에 실행
+    4) TTS: NPC별로 동시에 실행
+    :return: [(turn_result, update_params, audio_file)]
+    """
+    retrieval_contexts = scheduler.run_foreground(prefetch_scene_embeddings, sessions, inputs)
+    retrieve_futures = [scheduler.submit_foreground(session.retrieve_turn_context, input, game_status, context)
+                        for session, input, game_status, context in zip(sessions, inputs, game_statuses, retrieval_contexts)]
+    turn_contexts = [future.result() for future in retrieve_futures]
+    action_futures = [scheduler.submit_foreground(session.select_turn_action, input, game_status, context)
+                      for session, input, game_status, context in zip(sessions, inputs, game_statuses, turn_contexts)]
+    actions = [future.result() for future in action_futures]
+    audio_futures = [scheduler.submit_foreground(generate_tts_audio, turn_result["translated_npc_response"])
+                     for turn_result, _ in actions]
+    return [(turn_result, update_params, future.result()) for (turn_result, update_params), future in zip(actions, audio_futures)]
+
+@app.route('/api/scene', methods=['POST'])
+def handle_scene():
+    try:
+        data = request.json
+        npcs = data.get('npcs') or []
+        if not npcs or len(npcs) > MAX_SCENE_NPCS:
+            return jsonify({'error': f'npcs must contain between 1 and {MAX_SCENE_NPCS} entries.'}), 400
+        # 같은 npc_id가 두 번 오면 같은 GameSession에서 턴이 동시에 두 번 실행되므로 거부
+        npc_ids = [npc.get('npc_id', '') for npc in npcs]
+        if len(set(npc_ids)) != len(npc_ids):
+            return jsonify({'error': 'npc_id values must be unique within a scene.'}), 400
+        if any(invalid_namespaces(item.get('knowledge_namespaces')) for item in [data, *npcs]):
+            return jsonify({'error': NAMESPACES_ERROR}), 400
+        if any(invalid_status(item) for item in [data, *npcs]):
+            return jsonify({'error': STATUS_ERROR}), 400
+
+        # NPC 수만큼 토큰 차감 (속도 제한/동시 처리 슬롯도 NPC 수만큼 사용)
+        client_api = data.get('api_key')
+        if data.get('client_id') and not all(owns_session(f"{data['client_id']}/{npc_id}", client_api) for npc_id in npc_ids):
+            return jsonify({'error': SESSION_OWNER_ERROR}), 403
+        remaining_tokens, error = admission.admit(client_api, cost=len(npcs))
+        if error:
+            return error_response(error)
+
+        try:
+            client_id = data.get('client_id') or str(uuid.uuid4())
+            sessions, inputs, game_statuses = [], [], []
+            for npc in npcs:
+                session = get_or_create_session(f"{client_id}/{npc.get('npc_id', '')}", client_api)
+                # 사용자 입력/상황/world_status는 공통, npc_status와 델타 옵션은 NPC별
+                npc_namespaces = npc.get('knowledge_namespaces')
+                if npc_namespaces is None:
+                    npc_namespaces = [f"npc:{npc.get('npc_id', '')}"]
+                input, game_status = build_turn_input(session, {
+                    **data, **npc,
+                    'knowledge_namespaces': [*(data.get('knowledge_namespaces') or []), *npc_namespaces]
+                })
+                sessions.append(session)
+                inputs.append(input)
+                game_statuses.append(game_status)
+            results = run_scene_turn(sessions, inputs, game_statuses)
+            response = jsonify({
+                'client_id': client_id,
+                'npcs': [{
+                    'npc_id': npc.get('npc_id'),
+                    'audio_file': audio_file,
+                    'Expression': turn_result["facial_expression"],
+                    'Talk': turn_result["npc_response"],
+                    'Action': turn_result["action"]
+                } for npc, (turn_result, _, audio_file) in zip(npcs, results)],
+                'remaining_tokens': remaining_tokens
+            })
+        finally:
+            admission.release(len(npcs))
+
+        def update_callback():
+            for session, (_, update_params, _) in zip(sessions, results):
+                schedule_update(session, update_params)
+        response.call_on_close(update_callback)
+        return response
+
+    except Exception as e:
+        logger.exception(f"An error occurred: {str(e)}")
+        return jsonify({'error': f"[System: An error occurred: {str(e)}]", 'remaining_tokens': 0}), 500
+
+
+def collect_stats():
+    """
+    스케줄러 큐 길이/대기 시간 및 admission 통계 (재생 스텁 모드에서는 녹화 응답 적중 수 포함).
+    Flask와 ASGI(server_asgi.py)의 /api/stats가 함께 사용합니다.
+    """
+    stats = {**scheduler.stats(), "admission": admission.stats(), "logging": logging_stats(),
+             "knowledge": knowledge_base.stats(), "llm_usage": llm_usage.stats()}
+    if traffic.replay_stub is not None:
+        stats["replay_stub"] = traffic.replay_stub.stats()
+    return stats
+
+@app.route('/api/stats', methods=['GET'])
+def handle_stats():
+    return jsonify(collect_stats())
+
+
+@app.route('/api/ready', methods=['GET'])
+def handle_ready():
+    # warmup 진행 상황 (모든 단계가 끝나기 전에는 503 - 로드밸런서 readiness probe용)
+    status = warmup.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+@app.route('/api/graph', methods=['GET'])
+def handle_graph():
+    # 세션 메모리 그래프를 클라이언트 렌더링용 JSON(nodes/edges/positions)으로 반환 (디버깅용)
+    #   ?client_id=...&api_key=...&max_nodes=150
+    session = session_for_request(request.args.get('client_id'), request.args.get('api_key'))
+    if session is None:
+        return jsonify({'error': 'Unknown session or API key.'}), 404
+    from memory.graph_plot import GraphView
+    if session.graph_view is None:
+        session.graph_view = GraphView()
+    max_nodes = request.args.get('max_nodes', type=int)
+    return jsonify(session.graph_view.export(session.graph, max_nodes=max_nodes))
+
+
+# ----------------------------------------------------------------
+# WebSocket 엔드포인트: 연결을 유지한 채 같은 턴 프로토콜을 주고받는다
+#   client -> {"type": "hello", "api_key", "client_id"}   (연결당 1회, client_id로 세션 재개)
+#   client -> {"type": "turn", "turn_id", "userInput", "request_situation", "npc_status", "world_status", ...}
+#   client -> {"type": "ping"}
+#   server -> welcome / action / expression / text / audio / done / heartbeat / pong / error
+# ----------------------------------------------------------------
+def send_frame(ws, frame_type, **fields):
+    fields["type"] = frame_type
+    ws.send(json.dumps(fields, ensure_ascii=False))
+
+def send_frames(ws, frames):
+    """
+    frames를 순서대로 보냅니다. 연결이 끊기면 예외를 던지지 않고 ConnectionClosed를 반환합니다 (전부 보냈으면 None).
+    """
+    for frame_type, fields in frames:
+        try:
+            send_frame(ws, frame_type, **fields)
+        except ConnectionClosed as e:
+            return e
+    return None
+
+def ws_turn(ws, session, client_api, data):
+    turn_id = data.get('turn_id')
+    if invalid_namespaces(data.get('knowledge_namespaces')):
+        send_frame(ws, "error", turn_id=turn_id, error=NAMESPACES_ERROR, status=400)
+        return
+    if invalid_status(data):
+        send_frame(ws, "error", turn_id=turn_id, error=STATUS_ERROR, status=400)
+        return
+    remaining_tokens, error = admission.admit(client_api)
+    if error:
+        send_frame(ws, "error", turn_id=turn_id, error=error[0], status=error[1], retry_after=error[2])
+        return
+
+    update_params = None
+    try:
+        try:
+            input, game_status = build_turn_input(session, data)
+            turn_result, update_params = scheduler.run_foreground(session.process_turn_return_update_params, input, game_status)
+
+            # 재연결한 클라이언트가 놓친 결과를 다시 받을 수 있도록 보내기 전에 먼저 보관한다
+            frames = session.last_turn_frames = [
+                ("action", {"turn_id": turn_id, "Action": turn_result["action"]}),
+                ("expression", {"turn_id": turn_id, "Expression": turn_result["facial_expression"]}),
+                ("text", {"turn_id": turn_id, "Talk": turn_result["npc_response"]}),
+            ]
+            # 행동/표정/대사는 TTS를 기다리지 않고 바로 보낸다 (연결이 끊겨도 나머지 프레임은 만들어 보관)
+            closed = send_frames(ws, frames)
+            audio_file = generate_tts_audio(turn_result["translated_npc_response"])
+        finally:
+            admission.release()
+        tail = [("audio", {"turn_id": turn_id, "audio_file": audio_file}),
+                ("done", {"turn_id": turn_id, "remaining_tokens": remaining_tokens})]
+        frames.extend(tail)
+        if closed is None:
+            closed = send_frames(ws, tail)
+        if closed is not None:
+            raise closed
+    finally:
+        # 클라이언트가 끊겨도 이 턴의 메모리 업데이트는 실행한다 (세션별 background 큐가 순서를 보장)
+        if update_params is not None:
+            schedule_update(session, update_params)
+
+@sock.route('/ws/game')
+def ws_game(ws):
+    session, client_id, client_api = None, None, None
+    while True:
+        message = ws.receive(timeout=ws_heartbeat_interval)
+        if message is None:
+            send_frame(ws, "heartbeat", time=time.time())
+            continue
+        try:
+            data = json.loads(message)
+            message_type = data.get('type')
+            if message_type == 'ping':
+                send_frame(ws, "pong", time=time.time())
+            elif message_type == 'hello':
+                client_api = data.get('api_key')
+                if not admission.is_valid_key(client_api):
+                    send_frame(ws, "error", error='Invalid or missing API key.', status=401)
+                    continue
+                if not owns_session(data.get('client_id'), client_api):
+                    send_frame(ws, "error", error=SESSION_OWNER_ERROR, status=403)
+                    continue
+                resumed = data.get('client_id') in client_sessions
+                client_id = data.get('client_id') or str(uuid.uuid4())
+                session = get_or_create_session(client_id, client_api)
+                send_frame(ws, "welcome", client_id=client_id, resumed=resumed)
+                if resumed and data.get('last_turn_id') is not None:
+                    for frame_type, fields in session.last_turn_frames:
+                        if fields["turn_id"] != data.get('last_turn_id'):
+                            send_frame(ws, frame_type, **fields)
+            elif message_type == 'turn':
+                if session is None:
+                    send_frame(ws, "error", turn_id=data.get('turn_id'), error='Send hello first.', status=400)
+                    continue
+                with turn_context():
+                    log_event("request", "Received ws turn", level=logging.DEBUG, sample=LARGE_PAYLOAD_SAMPLE,
+                              client_id=client_id, data=data)
+                    ws_turn(ws, session, client_api, data)
+            else:
+                send_frame(ws, "error", error=f"Unknown message type: {message_type}", status=400)
+        except ConnectionClosed:
+            raise
+        except Exception as e:
+            logger.exception(f"An error occurred: {str(e)}")
+            send_frame(ws, "error", error=f"[System: An error occurred: {str(e)}]", status=500)
+
+
+def reinit_after_fork():
+    """
+    pre-fork 워커(server_prefork.py)에서 fork 직후 호출합니다.
+    fork로 복제되지 않는 백그라운드 스레드(스케줄러, 로그 출력, 지식 파일 감시)와 sqlite 연결을 새로 만듭니다.
+    로드된 모델/지식 색인/world graph는 마스터의 것을 copy-on-write로 그대로 사용합니다.
+    """
+    global scheduler
+    scheduler = TurnScheduler(foreground_workers, background_workers, background_queue_per_session)
+    admission.load_fn = scheduler.foreground_load
+    admission.quotas.local = threading.local()
+    restart_logging_after_fork()
+    # 마스터는 fork 전에 지식 파일 감시를 멈추므로 (server_prefork.py) reload는 워커에서만 일어난다.
+    # 잠금은 혹시 fork 순간 잡혀 있었더라도 자식에서 풀리지 않으므로 새로 만든다.
+    knowledge_base.reload_lock = threading.Lock()
+    if knowledge_base.retriever is not None:
+        knowledge_base.watcher = None
+        knowledge_base.start_watching()
+
+
+# warmup 스레드는 import 시점이 아니라 각 실행 진입점(아래 메인 실행부, server_asgi, server_prefork)에서 시작한다.
+# 시작하지 않은 채 모듈만 import 하면 warmup.get()이 필요한 단계를 호출한 스레드에서 바로 실행한다.
+server_import_seconds = time.perf_counter() - server_import_started
+
 
 # ----------------------------------------------------------------
 # 메인 실행부
 # ----------------------------------------------------------------
 if __name__ == '__main__':
+    warmup.start()
+    # --startup-report: warmup이 끝날 때까지 기다린 뒤 단계별 시작 시간을 출력하고 종료 (콜드 스타트 추적용)
+    # import 단위의 상세 내역은 python -X importtime server.py --startup-report 2> importtime.log
+    if "--startup-report" in sys.argv:
+        warmup.wait()
+        print(warmup.report(import_seconds=server_import_seconds))
+        sys.exit(0 if warmup.ready() else 1)
+
+    from pyngrok import ngrok
     try:
         print("Establishing Ngrok tunnel...")
         public_url = ngrok.connect(5003)
@@ -0,0 +1,169 @@
+# ASGI 서버 모드
+# server.py와 같은 /api/game 계약을 Starlette(ASGI) 위에서 제공한다.
+# 턴의 검색/행동 선택은 Flask 경로와 같은 스케줄러의 foreground 실행기에서 실행하므로 background 메모리 업데이트보다
+# 우선하고, admission의 대기열 길이/대기 시간 검사도 이 경로의 대기열을 그대로 본다.
+# TTS만 크기가 정해진 별도 executor에서 실행하며, 요청 자체는 이벤트 루프에서 await 하므로
+# 진행 중인 요청마다 스레드를 잡아두지 않는다.
+#
+# 실행: python server_asgi.py  (또는 uvicorn server_asgi:app --port 5003)
+
+import os
+import uuid
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from structured_logging import log_event, new_turn_id, current_turn, LARGE_PAYLOAD_SAMPLE
+from server import admission, build_turn_input, schedule_update, client_sessions, get_or_create_session, scheduler, warmup
+from server import invalid_namespaces, NAMESPACES_ERROR, invalid_status, STATUS_ERROR, collect_stats, owns_session, SESSION_OWNER_ERROR
+from tts import generate_tts_audio
+
+logger = logging.getLogger(__name__)
+
+# TTS executor 크기 (동시에 실행되는 TTS 수의 상한; 초과분은 이벤트 루프에서 대기)
+TTS_WORKERS = int(os.environ.get("GOALLM_TTS_WORKERS", 32))
+
+tts_executor = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+tts_lock = threading.Lock()
+tts_pending, tts_running = 0, 0   # /api/stats 용 TTS 대기/실행 수
+
+# 같은 client_id로 동시에 들어온 첫 요청이 세션을 두 번 만들지 않도록 한다
+session_create_lock = asyncio.Lock()
+
+
+async def run_foreground(func, *args):
+    # 스케줄러의 foreground 실행기에서 실행 (요청 컨텍스트는 submit_foreground가 넘겨준다)
+    return await asyncio.wrap_future(scheduler.submit_foreground(func, *args))
+
+
+def run_tts(context, text):
+    global tts_pending, tts_running
+    with tts_lock:
+        tts_pending -= 1
+        tts_running += 1
+    try:
+        return context.run(generate_tts_audio, text)
+    finally:
+        with tts_lock:
+            tts_running -= 1
+
+
+async def tts(text):
+    global tts_pending
+    with tts_lock:
+        tts_pending += 1
+    loop = asyncio.get_running_loop()
+    # 요청의 컨텍스트(로그 turn_id 등)를 executor 스레드에서도 사용한다
+    return await loop.run_in_executor(tts_executor, run_tts, contextvars.copy_context(), text)
+
+
+async def get_session(client_id, client_api):
+    session = client_sessions.get(client_id)
+    if session is not None:
+        return session
+    async with session_create_lock:
+        # GameSession 생성은 그래프/색인을 만드므로 이벤트 루프가 아닌 foreground 실행기에서 실행
+        return await run_foreground(get_or_create_session, client_id, client_api)
+
+
+async def handle_game_state(request):
+    try:
+        data = await request.json()
+        current_turn.set(new_turn_id())
+        log_event("request", "Received turn", level=logging.DEBUG, sample=LARGE_PAYLOAD_SAMPLE, data=data)
+        if invalid_namespaces(data.get('knowledge_namespaces')):
+            return JSONResponse({'error': NAMESPACES_ERROR}, status_code=400)
+        if invalid_status(data):
+            return JSONResponse({'error': STATUS_ERROR}, status_code=400)
+
+        # API 키 검증 및 토큰 차감
+        client_api = data.get('api_key')
+        if not owns_session(data.get('client_id'), client_api):
+            return JSONResponse({'error': SESSION_OWNER_ERROR}, status_code=403)
+        remaining_tokens, error = admission.admit(client_api)
+        if error:
+            message, status, retry_after = error
+            headers = {'Retry-After': str(retry_after)} if retry_after is not None else None
+            return JSONResponse({'error': message}, status_code=status, headers=headers)
+
+        try:
+            client_id = data.get('client_id') or str(uuid.uuid4())
+            session = await get_session(client_id, client_api)
+
+            input, game_status = build_turn_input(session, data)
+
+            # 1) 메모리/지식 검색 (CPU) + 2) choose_action (LLM I/O): Flask 경로와 같은 foreground 작업 하나
+            # -> 3) TTS (I/O)
+            turn_result, update_params = await run_foreground(
+                session.process_turn_return_update_params, input, game_status)
+            audio_file = await tts(turn_result["translated_npc_response"])
+        finally:
+            admission.release()
+
+        # 응답 전송 완료 후 업데이트를 스케줄러의 세션별 background 큐에 넣음 (이벤트 루프는 막지 않음)
+        return JSONResponse({
+            'client_id': client_id,
+            'audio_file': audio_file,
+            'Expression': turn_result["facial_expression"],
+            'Talk': turn_result["npc_response"],
+            'Action': turn_result["action"],
+            'remaining_tokens': remaining_tokens
+        }, background=BackgroundTask(schedule_update, session, update_params))
+
+    except Exception as e:
+        logger.exception(f"An error occurred: {str(e)}")
+        return JSONResponse({
+            'npc_response': "Error",
+            'Talk': f"[System: An error occurred: {str(e)}]",
+            'action': "Error",
+            'facial_expression': "sorrow",
+            'remaining_tokens': 0
+        }, status_code=500)
+
+
+async def handle_stats(request):
+    with tts_lock:
+        tts_stats = {"pending": tts_pending, "running": tts_running, "workers": TTS_WORKERS}
+    return JSONResponse({**collect_stats(), "tts": tts_stats})
+
+
+async def handle_ready(request):
+    status = warmup.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+app = Starlette(
+    # 모델 로드(warmup)는 import가 아니라 서버 시작 시점에 백그라운드에서 시작 (uvicorn server_asgi:app 포함)
+    on_startup=[warmup.start],
+    routes=[Route('/api/game', handle_game_state, methods=['POST']),
+            Route('/api/stats', handle_stats, methods=['GET']),
+            Route('/api/ready', handle_ready, methods=['GET'])],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+)
+
+
+# ----------------------------------------------------------------
+# 메인 실행부
+# ----------------------------------------------------------------
+if __name__ == '__main__':
+    from pyngrok import ngrok
+    try:
+        print("Establishing Ngrok tunnel...")
+        public_url = ngrok.connect(5003)
+        logger.info(f' * ngrok tunnel "{public_url}" -> "http://127.0.0.1:5003"')
+        print(f'Ngrok tunnel established: {public_url} -> http://127.0.0.1:5003')
+    except Exception as e:
+        logger.error(f"Failed to establish Ngrok tunnel: {e}")
+        print("Failed to establish Ngrok tunnel.")
+
+    uvicorn.run(app, port=5003)
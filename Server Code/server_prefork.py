@@ -0,0 +1,231 @@
+# Pre-fork 서빙 모드
+# 마스터 프로세스가 warmup(임베딩 모델, 지식 베이스, world graph 로드)을 한 번 끝낸 뒤 워커를 fork 한다.
+# 워커는 모델 가중치와 색인을 copy-on-write로 공유하므로 호스트 전체에서 모델은 한 번만 로드되고,
+# 새 워커는 fork 직후(모델 로드 없이) 바로 요청을 받는다.
+#
+# 실행: python server_prefork.py --workers 4 [--host 127.0.0.1] [--port 5003] [--threads 2] [--shared-socket]
+#   kill -TTIN <마스터 pid> : 워커 하나 추가,  kill -TTOU <마스터 pid> : 워커 하나 종료
+#   죽은 워커는 마스터가 같은 번호로 다시 fork 한다.
+#   워커는 SIGTERM을 받으면 새 연결을 받지 않고, 진행 중인 요청과 예약된 메모리 업데이트가 끝나기를
+#   DRAIN_TIMEOUT까지 기다린 뒤 종료한다 (TTOU로 줄어드는 워커도 같다).
+#
+# 세션(GameSession)과 API 키별 속도 제한은 워커 메모리에 있으므로 같은 client_id는 같은 워커로 가야 한다.
+# 그래서 기본값은 워커마다 포트(port + 1 + 워커 번호)를 여는 것이며, 앞단 프록시에서 client_id로 라우팅한다.
+#   --shared-socket: 모든 워커가 port 하나를 함께 듣는다 (커널이 연결을 아무 워커에나 준다).
+#   세션이 워커마다 갈라지고 속도 제한이 워커 수만큼 늘어나므로, 연결이 끊기지 않는 /ws/game 만 쓰는 경우에만 사용한다.
+# 남은 토큰(quota)은 sqlite에 있으므로 워커 간에 공유된다.
+
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import argparse
+import threading
+
+# 마스터는 단일 스레드로 추론한다: GNU OpenMP 스레드 풀을 만든 뒤 fork 하면 자식의 torch 연산이 멈출 수 있으므로
+# 스레드 풀은 fork 이후 워커에서 처음 만들어지게 한다 (torch import 전에 설정해야 함)
+os.environ["OMP_NUM_THREADS"] = "1"
+os.environ["MKL_NUM_THREADS"] = "1"
+
+import server
+import structured_logging
+from werkzeug.wsgi import ClosingIterator
+
+DRAIN_TIMEOUT = 30.0                # 워커가 종료 전에 진행 중인 요청/메모리 업데이트를 기다리는 시간 (초)
+STOP_TIMEOUT = DRAIN_TIMEOUT + 5.0  # 마스터가 종료 시 워커가 끝나기를 기다리는 시간 (초), 넘으면 SIGKILL
+
+
+def listen(host, port):
+    return socket.create_server((host, port), backlog=128, reuse_port=False)
+
+
+class InFlight:
+    """
+    처리 중인 요청(웹소켓 연결 포함) 수를 세는 WSGI 미들웨어: 워커 종료 시 요청이 끝나기를 기다리는 데 씁니다.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self.done = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self.done:
+            self.count += 1
+        try:
+            return ClosingIterator(self.app(environ, start_response), self.finish)
+        except BaseException:
+            self.finish()
+            raise
+
+    def finish(self):
+        with self.done:
+            self.count -= 1
+            self.done.notify_all()
+
+    def wait(self, timeout):
+        with self.done:
+            return self.done.wait_for(lambda: self.count == 0, timeout)
+
+
+def run_worker(index, listen_socket, threads):
+    """
+    fork된 워커 본체: 백그라운드 스레드를 다시 띄우고, 마스터가 열어 둔 소켓으로 요청을 받습니다.
+    """
+    from werkzeug.serving import make_server
+
+    server.reinit_after_fork()
+    torch = sys.modules.get("torch")
+    if torch is not None and threads:
+        torch.set_num_threads(threads)
+
+    host, port = listen_socket.getsockname()[:2]
+    app = InFlight(server.app)
+    httpd = make_server(host, port, app, threaded=True, fd=listen_socket.fileno())
+    # server_close()가 요청 스레드를 시간 제한 없이 join 하지 않도록 하고, 아래에서 DRAIN_TIMEOUT까지만 기다린다
+    httpd.block_on_close = False
+    # shutdown()은 serve_forever를 실행 중인 스레드가 아닌 곳에서 호출해야 한다
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=httpd.shutdown, daemon=True).start())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server.logger.info(f"Pre-fork worker {index} (pid {os.getpid()}) serving on {host}:{port}")
+    httpd.serve_forever()
+
+    # 종료: 리스너를 닫고, 진행 중인 요청과 스케줄러에 남은 턴/메모리 업데이트를 기다린 뒤 로그를 비운다
+    deadline = time.time() + DRAIN_TIMEOUT
+    httpd.server_close()
+    requests_done = app.wait(DRAIN_TIMEOUT)
+    scheduler_done = server.scheduler.shutdown(max(0.0, deadline - time.time()))
+    if not (requests_done and scheduler_done):
+        server.logger.warning(f"Pre-fork worker {index} stopped before draining "
+                              f"({app.count} requests in flight, scheduler: {server.scheduler.stats()})")
+    else:
+        server.logger.info(f"Pre-fork worker {index} drained and stopped")
+    if structured_logging.listener is not None:
+        structured_logging.listener.stop()
+
+
+class Master:
+    def __init__(self, host, port, workers, threads, sticky):
+        self.host, self.port = host, port
+        self.target = workers
+        self.threads = threads
+        self.sticky = sticky
+        self.sockets = {}      # 워커 번호 -> 소켓 (--shared-socket이면 모두 같은 소켓)
+        self.workers = {}      # pid -> 워커 번호
+        self.stopping = False
+
+    def socket_for(self, index):
+        if not self.sticky:
+            index = 0
+        if index not in self.sockets:
+            port = self.port + 1 + index if self.sticky else self.port
+            self.sockets[index] = listen(self.host, port)
+        return self.sockets[index]
+
+    def spawn(self, index):
+        listen_socket = self.socket_for(index)
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(index, listen_socket, self.threads)
+            except BaseException:
+                server.logger.exception(f"Pre-fork worker {index} crashed")
+                status = 1
+            finally:
+                os._exit(status)
+        self.workers[pid] = index
+        return pid
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.workers.clear()
+                return
+            if pid == 0:
+                return
+            index = self.workers.pop(pid, None)
+            if index is not None and not self.stopping and index < self.target:
+                server.logger.warning(f"Pre-fork worker {index} (pid {pid}) exited; restarting")
+
+    def scale(self):
+        running = set(self.workers.values())
+        for index in range(self.target):
+            if index not in running:
+                self.spawn(index)
+        for pid, index in list(self.workers.items()):
+            if index >= self.target:
+                os.kill(pid, signal.SIGTERM)
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def add_worker(self, *_):
+        self.target += 1
+
+    def remove_worker(self, *_):
+        self.target = max(1, self.target - 1)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTTIN, self.add_worker)
+        signal.signal(signal.SIGTTOU, self.remove_worker)
+        while not self.stopping:
+            self.reap()
+            self.scale()
+            time.sleep(0.2)
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + STOP_TIMEOUT
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            os.kill(pid, signal.SIGKILL)
+        for listen_socket in self.sockets.values():
+            listen_socket.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the game API from pre-forked workers sharing loaded models.")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5003)
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch intra-op threads per worker (default: cpu_count / workers)")
+    parser.add_argument("--shared-socket", action="store_true",
+                        help="let all workers accept on one port instead of one port per worker (port + 1 + index); "
+                             "HTTP sessions and rate limits are then split across workers")
+    args = parser.parse_args()
+    sticky = not args.shared_socket
+    if not sticky and args.workers > 1:
+        server.logger.warning("--shared-socket: HTTP sessions and per-key rate limits are split across workers; "
+                              "use it only for /ws/game clients")
+
+    if server.embedding_workers:
+        sys.exit("Pre-fork mode shares the in-process model; set embedding_workers = 0 in server.py.")
+
+    # 모델/지식/world graph 로드가 끝날 때까지 기다린 뒤에만 fork 한다
+    server.warmup.start()
+    server.warmup.wait()
+    print(server.warmup.report(import_seconds=server.server_import_seconds))
+    if not server.warmup.ready():
+        sys.exit(1)
+
+    # 마스터는 지식 파일을 reload 하지 않는다: 감시 스레드가 fork 도중 reload_lock을 잡고 있거나,
+    # 워커를 만든 뒤 마스터만 새 스냅샷을 갖게 되지 않도록 fork 전에 멈춘다 (워커가 각자 감시한다)
+    server.knowledge_base.stop_watching()
+
+    # 마스터가 만든 객체들을 GC 추적 대상에서 빼서, 워커의 GC가 공유 페이지를 건드려 복사가 일어나지 않게 한다
+    gc.collect()
+    gc.freeze()
+
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    Master(args.host, args.port, args.workers, threads, sticky).run()
@@ -0,0 +1,104 @@
+# npc_status / world_status 델타 인코딩
+# 매 턴 전체 상태를 str()로 붙이는 대신, 세션이 마지막 상태를 기억하고 바뀐 필드만 짧게 인코딩한다.
+
+import json
+
+REMOVED = None  # 클라이언트 델타에서 None 값은 해당 필드 삭제를 의미
+
+
+def flatten_state(state, prefix=""):
+    """
+    중첩 dict를 "a.b.c" 경로를 키로 하는 평탄한 dict로 변환합니다.
+    """
+    flat = {}
+    for key, value in state.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict) and value:
+            flat.update(flatten_state(value, path + "."))
+        else:
+            flat[path] = value
+    return flat
+
+
+def merge_state(prev, changes):
+    """
+    클라이언트가 보낸 변경 필드(changes)를 이전 상태(prev)에 병합한 새 dict를 반환합니다.
+    중첩 dict는 재귀적으로 병합하고, 값이 None인 필드는 삭제합니다.
+    """
+    merged = dict(prev)
+    for key, value in changes.items():
+        if value is REMOVED:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_state(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def diff_state(prev, curr):
+    """
+    두 상태의 차이를 평탄한 경로 기준 dict로 반환합니다. 삭제된 경로의 값은 None입니다.
+    """
+    prev_flat, curr_flat = flatten_state(prev), flatten_state(curr)
+    changes = {path: value for path, value in curr_flat.items() if prev_flat.get(path, object()) != value}
+    for path in prev_flat:
+        if path not in curr_flat:
+            changes[path] = REMOVED
+    return changes
+
+
+def encode_value(value):
+    if value is REMOVED:
+        return "<removed>"
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def encode_state(flat):
+    """
+    평탄한 상태/델타를 경로 순으로 정렬된 "path=value; ..." 문자열로 인코딩합니다.
+    같은 상태는 항상 같은 문자열이 되도록 정렬 및 직렬화 방식을 고정합니다.
+    """
+    return "; ".join(f"{path}={encode_value(flat[path])}" for path in sorted(flat))
+
+
+class StatusTracker:
+    """
+    한 세션의 마지막 npc_status/world_status를 보관하고,
+    매 턴 전체 스냅샷 또는 델타 문자열을 만들어 줍니다.
+    스냅샷은 첫 턴, reset 요청, 그리고 snapshot_interval 턴마다 한 번 생성합니다.
+    """
+    def __init__(self, snapshot_interval=5):
+        self.snapshot_interval = snapshot_interval
+        self.npc_status, self.world_status = {}, {}
+        self.turns_since_snapshot = None
+
+    def update(self, npc_status, world_status, is_delta=False, reset=False):
+        if reset:
+            self.npc_status, self.world_status = {}, {}
+            self.turns_since_snapshot = None
+        if is_delta:
+            new_npc = merge_state(self.npc_status, npc_status)
+            new_world = merge_state(self.world_status, world_status)
+        else:
+            new_npc, new_world = dict(npc_status), dict(world_status)
+
+        snapshot = self.turns_since_snapshot is None or self.turns_since_snapshot + 1 >= self.snapshot_interval
+        if snapshot:
+            game_status = ("NPC Status: " + encode_state(flatten_state(new_npc)) + "\n" +
+                           "World Status: " + encode_state(flatten_state(new_world)) + "\n")
+            self.turns_since_snapshot = 0
+        else:
+            npc_changes = diff_state(self.npc_status, new_npc)
+            world_changes = diff_state(self.world_status, new_world)
+            game_status = ""
+            if npc_changes:
+                game_status += "NPC Status Changes: " + encode_state(npc_changes) + "\n"
+            if world_changes:
+                game_status += "World Status Changes: " + encode_state(world_changes) + "\n"
+            self.turns_since_snapshot += 1
+
+        self.npc_status, self.world_status = new_npc, new_world
+        return game_status
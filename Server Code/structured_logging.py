@@ -0,0 +1,182 @@
+# 구조화 로깅
+# 모든 로그는 "goallm.<category>" 로거를 거쳐 한 줄짜리 JSON 레코드로 출력된다.
+# - 호출한 스레드는 레코드를 큐에 넣기만 하고, 포맷/출력은 QueueListener 스레드가 한다 (큐가 차면 버리고 개수만 센다)
+# - 카테고리별 레벨: GOALLM_LOG_LEVELS="memory=DEBUG,request=WARNING" (기본 레벨은 GOALLM_LOG_LEVEL)
+# - 큰 필드(그래프, 플랜 JSON, 요청 본문 등)는 MAX_FIELD_CHARS로 자르고, sample 비율만큼만 기록
+# - 턴마다 correlation id(turn_id)를 붙여 foreground/background 로그를 한 턴으로 묶는다
+#
+# log_event("memory", "Retrieved subgraph", level=logging.DEBUG, sample=LARGE_PAYLOAD_SAMPLE, subgraph=retrieved_subgraph)
+
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import random
+import logging
+import contextlib
+import contextvars
+import logging.handlers
+
+LOG_LEVEL = os.environ.get("GOALLM_LOG_LEVEL", "INFO")
+CATEGORY_LEVELS = {
+    "turn": "INFO",
+    "plan": "INFO",
+    "status": "INFO",
+    "memory": "INFO",
+    "knowledge": "INFO",
+    "request": "INFO",
+    "tts": "INFO",
+    "startup": "INFO",
+}
+MAX_FIELD_CHARS = int(os.environ.get("GOALLM_LOG_MAX_FIELD", 1000))          # 필드 하나의 최대 길이
+LARGE_PAYLOAD_SAMPLE = float(os.environ.get("GOALLM_LOG_PAYLOAD_SAMPLE", 0.05))  # 큰 필드를 담은 로그의 기록 비율
+LOG_QUEUE_SIZE = 10000
+REDACTED_KEYS = {"api_key"}   # dict 필드를 기록할 때 값을 가리는 키
+
+# 현재 턴의 correlation id (스케줄러 foreground 작업은 요청 스레드의 컨텍스트를 이어받는다)
+current_turn = contextvars.ContextVar("current_turn", default=None)
+
+dropped_records = 0
+listener = None
+
+
+def parse_levels(spec):
+    levels = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            category, level = item.split("=", 1)
+            levels[category.strip()] = level.strip().upper()
+    return levels
+
+
+def truncate(value, limit=MAX_FIELD_CHARS):
+    if isinstance(value, dict) and REDACTED_KEYS & value.keys():
+        value = {key: "***" if key in REDACTED_KEYS else item for key, item in value.items()}
+    if not isinstance(value, (str, int, float, bool)) and value is not None:
+        value = str(value)
+    if isinstance(value, str) and len(value) > limit:
+        return value[:limit] + f"...(+{len(value) - limit} chars)"
+    return value
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    큐가 가득 차면 호출 스레드를 막지 않고 레코드를 버립니다.
+    """
+    def prepare(self, record):
+        # 메시지 보간과 예외 문자열화만 호출 스레드에서 하고, JSON 포맷은 출력 스레드에 맡긴다
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global dropped_records
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records += 1
+
+
+class TurnFilter(logging.Filter):
+    def filter(self, record):
+        record.turn_id = current_turn.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "category": record.name.rsplit(".", 1)[-1] if record.name.startswith("goallm.") else record.name,
+            "turn": getattr(record, "turn_id", None),
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(stream=None):
+    """
+    루트 로거에 큐 핸들러를 달고 출력 스레드(QueueListener)를 시작합니다. 여러 번 호출해도 한 번만 설정됩니다.
+    """
+    global listener
+    if listener is not None:
+        return listener
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(TurnFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    levels = {**CATEGORY_LEVELS, **parse_levels(os.environ.get("GOALLM_LOG_LEVELS"))}
+    for category, level in levels.items():
+        logging.getLogger(f"goallm.{category}").setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def restart_after_fork():
+    """
+    fork된 자식 프로세스에서 호출: 출력 스레드는 fork로 복제되지 않으므로 큐와 QueueListener를 새로 만듭니다.
+    """
+    global listener
+    listener = None
+    return setup_logging()
+
+
+def log_event(category, message, level=logging.INFO, sample=1.0, **fields):
+    """
+    category 로거로 구조화 레코드를 남깁니다. 레벨이 꺼져 있거나 샘플링에서 빠지면 필드를 문자열로 만들지도 않습니다.
+    """
+    logger = logging.getLogger(f"goallm.{category}")
+    if not logger.isEnabledFor(level):
+        return
+    if sample < 1.0 and random.random() >= sample:
+        return
+    logger.log(level, truncate(message), extra={"fields": {key: truncate(value) for key, value in fields.items()}})
+
+
+def category_logger(category, level=logging.INFO, sample=1.0):
+    """
+    메시지 문자열 하나를 받는 log(msg) 형태의 함수를 반환합니다 (ContrieverGraph.update_without_retrieve 등 기존 인터페이스용).
+    """
+    def log_func(msg):
+        log_event(category, msg, level=level, sample=sample)
+    return log_func
+
+
+def new_turn_id():
+    return f"{int(time.time() * 1000):x}-{random.getrandbits(24):06x}"
+
+
+@contextlib.contextmanager
+def turn_context(turn_id=None):
+    """
+    with 블록 안의 로그에 turn_id를 붙입니다. turn_id가 없으면 새로 만듭니다.
+    """
+    turn_id = turn_id or new_turn_id()
+    token = current_turn.set(turn_id)
+    try:
+        yield turn_id
+    finally:
+        current_turn.reset(token)
+
+
+def stats():
+    return {"dropped": dropped_records, "queued": listener.queue.qsize() if listener is not None else 0}
@@ -104,6 +104,19 @@ If you determine that progress is stalled or that essential information is missi
 Do not write anything else.
 """
 
+# choose_action 사용자 메시지의 고정 출력 형식 (prompt-prefix 캐싱을 위해 프롬프트 맨 앞에 둔다)
+action_output_format = """Use context, reactive plan, and any additional information as needed.
+Generate a JSON object exactly in the following format:
+{
+  "action": "One selected action from the provided list.",
+  "npc_response": "A concise dialogue line that is context-aware.",
+  "translated_npc_response": "Korean version of npc_response. All letters must be Korean.",
+  "facial_expression": "One of neutral, fun, surprised, angry, joy, sorrow.",
+  "completed_step": <number>,
+  "exception_flag": <boolean>
+}
+Do not write anything else."""
+
 # 상태 관리 agent를 위한 system prompt (정신적 에너지는 "매우낮음/낮음/보통/높음/매우높음" 사용)
 system_status_agent = """
 You are a status management agent designed to evaluate an agent's internal state based on recent conversation and context.
@@ -147,6 +160,28 @@ status_prompts = {
     }
 }
 
+# choose_action이 deadline 안에 유효한 응답을 받지 못했을 때 사용하는 템플릿 응답
+fallback_action_responses = [
+    {
+        "action": "Do Thinking",
+        "npc_response": "Hmm... give me a second, let me think about that.",
+        "translated_npc_response": "음... 잠깐만, 생각 좀 해볼게.",
+        "facial_expression": "neutral"
+    },
+    {
+        "action": "Do Look Around",
+        "npc_response": "Wait, what was that? Say it again.",
+        "translated_npc_response": "잠깐, 방금 뭐라고? 다시 말해줄래?",
+        "facial_expression": "surprised"
+    },
+    {
+        "action": "Do Bashful",
+        "npc_response": "Sorry, I got distracted for a moment.",
+        "translated_npc_response": "미안, 잠깐 딴생각했어.",
+        "facial_expression": "neutral"
+    }
+]
+
 predefined_knowledge = [
     ("세계관 개요", "인류는 먼 미래에 고향 행성을 떠나 수많은 성계로 퍼져 나갔다. 인공 블랙홀을 이용한 \"게이트\" 기술의 개발로 별과 별 사이의 이동이 가능해지면서 우주 개척 시대가 열렸다.\n                    여러 식민지들이 성장하여 서로 다른 이념과 체제를 가진 거대 세력들이 등장했고, 한때 은하 전역에 평화를 가져온 중앙 정부가 붕괴한 후 인류 사회는 분열 상태에 빠졌다. 이렇게 탄생한 네 개의 강대 세력은 서로 패권을 다투며 대전쟁을 벌이게 되는데, 그 와중에 예상치 못한 새로운 위협이 인류 앞에 나타나게 된다."),
     ("게이트와 우주 진출", "\"게이트\"는 인공적으로 만든 중력 왜곡 통로로, 먼 우주를 순식간에 연결하는 이동 수단이다. 이 기술 덕분에 인류는 빛의 속도를 넘어서 성간 여행을 실현했고, 수많은 행성과 성계를 식민지로 개척할 수 있었다.\n                    하지만 게이트로 확장된 영역이 넓어지면서 각 지역 간의 통제는 어려워졌고, 결국 각 성계는 자체적인 정부와 군대를 가지게 되었다. 게이트를 둘러싼 자원과 주도권 싸움은 이후 등장할 4대 세력 간 긴장의 불씨가 되었다."),
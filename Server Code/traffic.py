@@ -0,0 +1,194 @@
+# 트래픽 녹화(record) / 재생(replay)
+# 실제 플레이 트래픽을 압축된 append-only JSONL 파일로 녹화하고, 같은 세션들을 재생해서
+# 실제와 같은 모양의 부하로 서버를 테스트한다.
+#
+# 녹화: GOALLM_CAPTURE=capture.jsonl python server.py
+#   /api/game 턴마다 한 줄({"type": "turn"})을, 그 턴의 background 메모리 업데이트마다 한 줄({"type": "update"})을 쓴다.
+#   각 줄에는 요청 본문(api_key 제외), 단계별 소요 시간, 그 턴에서 일어난 LLM 응답과 TTS 호출이 들어간다.
+#   프롬프트는 sha1 해시만, TTS 오디오는 길이만 저장한다 (재생에는 응답 텍스트와 오디오 크기만 필요).
+#   임베딩은 외부 서비스가 아니라 서버 안에서 계산되므로 응답을 녹화하지 않고, 재생 때 실제로 다시 계산한다.
+#
+# 재생: GOALLM_REPLAY_STUB=capture.jsonl python server.py  (LLM/TTS를 녹화된 응답으로 대체하는 스텁 모드)
+#       python replay.py capture.jsonl --url http://127.0.0.1:5003 --api-key 1 --speed 4
+
+import os
+import json
+import time
+import gzip
+import hashlib
+import threading
+import contextvars
+from collections import defaultdict, deque
+
+CAPTURE_PATH = os.environ.get("GOALLM_CAPTURE")            # 녹화 파일 경로 (없으면 녹화하지 않음)
+REPLAY_STUB_PATH = os.environ.get("GOALLM_REPLAY_STUB")    # 재생용 스텁이 읽을 녹화 파일 경로
+STUB_LATENCY_SCALE = float(os.environ.get("GOALLM_STUB_LATENCY_SCALE", 1.0))  # 녹화된 외부 호출 지연에 곱할 배율 (0이면 지연 없음)
+
+# 현재 스레드(컨텍스트)에서 진행 중인 턴 캡처. 스케줄러/hedge 스레드 풀은 제출 시점의 컨텍스트를 이어받는다.
+current_capture = contextvars.ContextVar("current_capture", default=None)
+
+
+def prompt_hash(prompt):
+    return hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def open_capture(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class TrafficRecorder:
+    """
+    캡처 레코드를 한 줄씩 파일 끝에 추가합니다. 여러 스레드에서 동시에 써도 줄이 섞이지 않습니다.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open_capture(path, "a")
+        self.started_at = time.time()
+
+    def start(self, record_type, session, **fields):
+        return TurnCapture(self, record_type, session, **fields)
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+
+class TurnCapture:
+    """
+    한 턴(또는 한 번의 background 업데이트) 동안의 요청, 단계별 시간, 외부 호출을 모읍니다.
+    """
+    def __init__(self, recorder, record_type, session, **fields):
+        self.recorder = recorder
+        self.started = time.time()
+        self.record = {"type": record_type, "session": session,
+                       "offset": round(self.started - recorder.started_at, 3), **fields,
+                       "timings": {}, "calls": []}
+        self.lock = threading.Lock()
+        self.token = None
+
+    def __enter__(self):
+        self.token = current_capture.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current_capture.reset(self.token)
+        if exc_type is not None:
+            self.record["error"] = f"{exc_type.__name__}: {exc}"
+        self.finish()
+
+    def timing(self, name, seconds):
+        self.record["timings"][name] = round(seconds, 4)
+
+    def add_call(self, call):
+        with self.lock:
+            self.record["calls"].append(call)
+
+    def finish(self):
+        self.record["timings"]["total"] = round(time.time() - self.started, 4)
+        self.recorder.write(self.record)
+
+
+def record_llm(model, prompt, response, seconds):
+    capture = current_capture.get()
+    if capture is not None:
+        capture.add_call({"kind": "llm", "model": model, "prompt": prompt_hash(prompt),
+                          "response": response, "seconds": round(seconds, 4)})
+
+
+def record_tts(text, audio, seconds):
+    capture = current_capture.get()
+    if capture is not None:
+        capture.add_call({"kind": "tts", "text": prompt_hash(text or ""),
+                          "size": len(audio) if audio else 0, "seconds": round(seconds, 4)})
+
+
+def timed(name, func, *args):
+    """
+    func(*args)를 실행하고, 진행 중인 캡처가 있으면 소요 시간을 name 단계로 기록합니다.
+    """
+    capture = current_capture.get()
+    if capture is None:
+        return func(*args)
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        capture.timing(name, time.time() - start)
+
+
+def load_capture(path):
+    with open_capture(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ReplayStub:
+    """
+    녹화된 LLM/TTS 응답을 돌려주는 스텁. 같은 프롬프트 해시의 응답을 녹화 순서대로 돌려주고,
+    재생 중 프롬프트가 달라져 해시가 맞지 않으면 같은 모델의 녹화 응답을 순서대로 돌려씁니다.
+    프롬프트 해시 일치는 모델을 구분하지 않습니다 (hedged 요청은 보조 모델의 채택 응답만 녹화되어 있어도
+    재생 때는 주 모델로 요청하므로).
+    응답 전에는 녹화된 호출 지연 x STUB_LATENCY_SCALE 만큼 기다려 실제 호출과 같은 시간 분포를 만듭니다.
+    """
+    def __init__(self, records, latency_scale=STUB_LATENCY_SCALE):
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.exact = defaultdict(deque)      # (kind, key) -> deque[call]
+        self.by_model = defaultdict(list)    # (kind, model) -> [call]
+        self.cursor = defaultdict(int)
+        self.hits, self.misses = 0, 0
+        for record in records:
+            for call in record.get("calls", []):
+                model = call.get("model", "")
+                key = call.get("prompt") or call.get("text")
+                self.exact[(call["kind"], key)].append(call)
+                self.by_model[(call["kind"], model)].append(call)
+
+    def _next(self, kind, model, key):
+        with self.lock:
+            calls = self.exact.get((kind, key))
+            if calls:
+                self.hits += 1
+                # 마지막 응답은 남겨 두어 같은 프롬프트가 다시 와도 응답할 수 있게 한다
+                return calls.popleft() if len(calls) > 1 else calls[0]
+            self.misses += 1
+            calls = self.by_model.get((kind, model)) or self.by_model.get((kind, ""))
+            if not calls:
+                # 녹화에 없는 모델이면 같은 종류의 아무 응답이나 사용
+                calls = next((c for (k, _), c in self.by_model.items() if k == kind), None)
+            if not calls:
+                return None
+            index = self.cursor[(kind, model)]
+            self.cursor[(kind, model)] = index + 1
+            return calls[index % len(calls)]
+
+    def _wait(self, call):
+        if self.latency_scale > 0:
+            time.sleep(call.get("seconds", 0.0) * self.latency_scale)
+
+    def llm(self, model, prompt):
+        call = self._next("llm", model, prompt_hash(prompt))
+        if call is None:
+            return "{}"
+        self._wait(call)
+        return call["response"]
+
+    def tts(self, text):
+        call = self._next("tts", "", prompt_hash(text or ""))
+        if call is None or not call.get("size"):
+            return None
+        self._wait(call)
+        # 오디오 내용 대신 같은 크기의 base64 문자열을 돌려줘 응답 크기를 맞춘다
+        return "A" * call["size"]
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+recorder = TrafficRecorder(CAPTURE_PATH) if CAPTURE_PATH else None
+replay_stub = ReplayStub(load_capture(REPLAY_STUB_PATH)) if REPLAY_STUB_PATH else None
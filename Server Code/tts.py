@@ -5,7 +5,10 @@ import io
 import base64
 import time
 import os
-from pydub import AudioSegment
+import logging
+import traffic
+from structured_logging import log_event
+# pydub은 첫 TTS 변환 때 import (서버 시작 시간 단축)
 
 # Constants
 ELEVENLABS_VOICE_ID = "z6Kj0hecH20CdetSElRT"           # Replace with your desired voice ID from ElevenLabs
@@ -16,6 +19,15 @@ AUDIO_SAVE_PATH = "saved_audios"  # Directory to save TTS audio files
 os.makedirs(AUDIO_SAVE_PATH, exist_ok=True)
 
 def generate_tts_audio(text, voice_id=None):
+    # 재생 스텁 모드에서는 녹화된 오디오 크기만큼의 응답을 돌려주고, 녹화 중이면 호출을 기록한다
+    if traffic.replay_stub is not None:
+        return traffic.replay_stub.tts(text)
+    start = time.time()
+    audio = request_tts_audio(text, voice_id)
+    traffic.record_tts(text, audio, time.time() - start)
+    return audio
+
+def request_tts_audio(text, voice_id=None):
     #Send text to ElevenLabs TTS API, save the audio file, and return its Base64-encoded string.
 
     #Args:
@@ -24,7 +36,7 @@ def generate_tts_audio(text, voice_id=None):
     # Returns:
     #    str: Base64-encoded audio string or None if an error occurs.
     
-    print('Generating TTS using ElevenLabs API...')
+    log_event("tts", "Generating TTS using ElevenLabs API", level=logging.DEBUG, chars=len(text or ""))
      # Use default voice_id if not provided
     if voice_id is None:
         voice_id = ELEVENLABS_VOICE_ID
@@ -47,17 +59,15 @@ def generate_tts_audio(text, voice_id=None):
     try:
         response = requests.post(ELEVENLABS_API_URL, headers=headers, json=payload)
 
-        # Debugging: Print response status and headers
-        print(f"Response Status Code: {response.status_code}")
-        print(f"Response Headers: {response.headers}")
+        # Debugging: response status and headers
+        log_event("tts", "TTS response", level=logging.DEBUG, status=response.status_code, headers=dict(response.headers))
 
         if response.status_code == 200:
             content_type = response.headers.get('Content-Type', '')
-            print(f"Content-Type: {content_type}")
 
             if 'audio' not in content_type:
-                print("Error: The response does not contain audio data.")
-                print(f"Response Content: {response.text}")
+                log_event("tts", "The response does not contain audio data", level=logging.WARNING,
+                          content_type=content_type, content=response.text)
                 return None
 
             # Save raw audio for inspection
@@ -67,14 +77,15 @@ def generate_tts_audio(text, voice_id=None):
             raw_audio_path = os.path.join(AUDIO_SAVE_PATH, raw_audio_filename)
             with open(raw_audio_path, "wb") as f:
                 f.write(response.content)
-            print(f"Raw audio saved to {raw_audio_path}")
+            log_event("tts", "Raw audio saved", level=logging.DEBUG, path=raw_audio_path)
 
             # Proceed with pydub processing
             try:
                 # Specify the correct format here
+                from pydub import AudioSegment
                 audio = AudioSegment.from_file(io.BytesIO(response.content), format="mp3")
             except Exception as e:
-                print(f"pydub failed to parse audio: {e}")
+                log_event("tts", "pydub failed to parse audio", level=logging.WARNING, error=str(e))
                 return None
 
             # Process audio: convert to mono, set sample width and frame rate
@@ -92,7 +103,7 @@ def generate_tts_audio(text, voice_id=None):
             processed_audio_path = os.path.join(AUDIO_SAVE_PATH, processed_audio_filename)
             with open(processed_audio_path, "wb") as f:
                 f.write(linear16_io.read())
-            print(f"Processed audio saved to {processed_audio_path}")
+            log_event("tts", "Processed audio saved", level=logging.DEBUG, path=processed_audio_path)
 
             # Reset the buffer to read for Base64 encoding
             linear16_io.seek(0)
@@ -102,11 +113,11 @@ def generate_tts_audio(text, voice_id=None):
             return pcm_base64
 
         else:
-            print(f"Error: {response.status_code}, {response.text}")
+            log_event("tts", "TTS request failed", level=logging.WARNING, status=response.status_code, content=response.text)
             return None
 
     except Exception as e:
-        print(f"An error occurred while requesting TTS: {e}")
+        log_event("tts", "An error occurred while requesting TTS", level=logging.WARNING, error=str(e))
         return None
 
 # Example usage
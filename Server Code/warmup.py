@@ -0,0 +1,109 @@
+# 모델 warmup / 준비 상태(readiness)
+# 무거운 모듈 import와 모델 로드를 서버 시작 직후 백그라운드 스레드에서 순서대로 실행한다.
+# 각 단계의 상태와 소요 시간은 /api/ready 와 시작 리포트(python server.py --startup-report)로 확인한다.
+# 단계가 끝나기 전에 요청이 그 결과를 필요로 하면 get()이 완료될 때까지 기다린다.
+
+import time
+import threading
+import traceback
+from collections import OrderedDict
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+
+class Warmup:
+    def __init__(self):
+        self.steps = OrderedDict()   # name -> {"status", "seconds", "error"}
+        self.funcs = {}
+        self.results = {}
+        self.cond = threading.Condition()
+        self.thread = None
+        self.started_at = None
+        self.finished_at = None
+
+    def add(self, name, func):
+        self.steps[name] = {"status": PENDING, "seconds": None, "error": None}
+        self.funcs[name] = func
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.started_at = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        for name in list(self.steps):
+            self._run_step(name)
+        self.finished_at = time.perf_counter()
+
+    def _run_step(self, name):
+        step = self.steps[name]
+        with self.cond:
+            if step["status"] != PENDING:
+                return
+            step["status"] = RUNNING
+        start = time.perf_counter()
+        result, error = None, None
+        try:
+            result = self.funcs[name]()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+        with self.cond:
+            self.results[name] = result
+            step["seconds"] = time.perf_counter() - start
+            step["status"], step["error"] = (FAILED, error) if error else (DONE, None)
+            self.cond.notify_all()
+
+    def get(self, name, timeout=None):
+        """
+        name 단계의 결과를 반환합니다. warmup이 시작되지 않았으면 현재 스레드에서 바로 실행하고,
+        실행 중이거나 대기 중이면 끝날 때까지 기다립니다.
+        """
+        step = self.steps[name]
+        if self.thread is None:
+            self._run_step(name)
+        with self.cond:
+            if not self.cond.wait_for(lambda: step["status"] in (DONE, FAILED), timeout):
+                raise TimeoutError(f"Warmup step '{name}' is not ready yet.")
+            if step["status"] == FAILED:
+                raise RuntimeError(f"Warmup step '{name}' failed: {step['error']}")
+            return self.results[name]
+
+    def ready(self):
+        with self.cond:
+            return all(step["status"] == DONE for step in self.steps.values())
+
+    def wait(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: all(step["status"] in (DONE, FAILED) for step in self.steps.values()), timeout)
+
+    def status(self):
+        with self.cond:
+            elapsed = None
+            if self.started_at is not None:
+                elapsed = (self.finished_at or time.perf_counter()) - self.started_at
+            return {
+                "ready": all(step["status"] == DONE for step in self.steps.values()),
+                "elapsed": elapsed,
+                "steps": {name: dict(step) for name, step in self.steps.items()},
+            }
+
+    def report(self, import_seconds=None):
+        """
+        -X importtime 출력과 비슷한 형태의 시작 시간 리포트 문자열을 반환합니다.
+        """
+        status = self.status()
+        lines = ["startup time: seconds | cumulative | step"]
+        cumulative = 0.0
+        if import_seconds is not None:
+            cumulative += import_seconds
+            lines.append(f"startup time: {import_seconds:7.3f} | {cumulative:10.3f} | import server")
+        for name, step in status["steps"].items():
+            seconds = step["seconds"] or 0.0
+            cumulative += seconds
+            suffix = "" if step["status"] == DONE else f" ({step['status']}{': ' + step['error'] if step['error'] else ''})"
+            lines.append(f"startup time: {seconds:7.3f} | {cumulative:10.3f} | {name}{suffix}")
+        return "\n".join(lines)